@@ -1,9 +1,10 @@
 import json
-import requests
+import os
+import sys
 import functools
-from requests.structures import CaseInsensitiveDict
-headers = CaseInsensitiveDict()
-headers["Content-Type"] = "application/json"
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from gdc_client import default_client
 
 endpoint = "https://api.gdc.cancer.gov/graphql"
 
@@ -20,7 +21,7 @@ with open("mutationRequest.json") as json_file:
 # get mutations from list of case ids. Returns a dictionart where keys are case_ids which contain their mutation count
 def get_mutations(case_ids: list()):
     mutation_request["variables"]["ssmCountsfilters"]["content"][1]["content"]["value"] = case_ids
-    resp_json = requests.post(endpoint, headers=headers, data=json.dumps(mutation_request)).json()
+    resp_json = default_client().post_json(endpoint, mutation_request)
     mutations = resp_json["data"]["ssmsAggregationsViewer"]["explore"]["ssms"]["aggregations"]["occurrence__case__case_id"]["buckets"]
     def merge(dict1: dict, dict2: dict):
         dict1.update(dict2)
@@ -31,7 +32,7 @@ def get_mutations(case_ids: list()):
 # get genes from all case ids (2875 cases on 09/02/2020). Count specifies how many results to get back (should ideally be set to the number of case ids that we have)
 def get_genes(count: int):
     gene_request["variables"]["cases_size"] = count # default is 100
-    resp_json = requests.post(endpoint, headers=headers, data=json.dumps(gene_request)).json()
+    resp_json = default_client().post_json(endpoint, gene_request)
     data = resp_json["data"]["exploreCasesTableViewer"]["explore"]["cases"]["hits"]["edges"]
     genes = dict()
     for record in data:
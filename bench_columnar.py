@@ -0,0 +1,62 @@
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import pandas as pd
+
+from bench_flatten import synthetic_output
+from cohort_table import read_patients, write_cohort
+from flatten_cases import flatten_hits
+
+# load time and size of the cohort as reconstructedData.json, as the flattened CSV parallelise.py used to read, and
+# as the cohort_table Parquet/Feather tables, loading everything and loading just the columns the tilers need.
+# Sizes are for everything written in each format (both tables for Parquet/Feather); loads are of the patients.
+
+COLUMNS = ["file_id", "years_survived", "biopsy_tissue_type"]
+
+
+def size_of(*paths):
+    return sum(os.path.getsize(path) for path in paths)
+
+
+def timed(fn):
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark loading the cohort from JSON, CSV and columnar tables.")
+    ap.add_argument("-N", "--num_cases", type=int, default=100000)
+    args = ap.parse_args()
+
+    records, _ = flatten_hits(synthetic_output(args.num_cases)["data"]["hits"])
+    directory = tempfile.mkdtemp()
+
+    json_path = os.path.join(directory, "reconstructedData.json")
+    with open(json_path, "w") as f:
+        print(json.dumps({"data": records}, indent=2), file=f)
+
+    csv_path = os.path.join(directory, "reconstructedData.csv")
+    pd.json_normalize(records, sep="__").rename(columns={"slides__file_id": "file_id"}).to_csv(csv_path)
+
+    write_cohort(records, os.path.join(directory, "parquet"), "parquet")
+    write_cohort(records, os.path.join(directory, "feather"), "feather")
+
+    rows = [
+        ("json", size_of(json_path), timed(lambda: json.load(open(json_path))), None),
+        ("csv", size_of(csv_path), timed(lambda: pd.read_csv(csv_path)),
+         timed(lambda: pd.read_csv(csv_path, usecols=COLUMNS))),
+    ]
+    for format in ("parquet", "feather"):
+        table_dir = os.path.join(directory, format)
+        rows.append((format, size_of(*[os.path.join(table_dir, name) for name in os.listdir(table_dir)]),
+                     timed(lambda: read_patients(table_dir)), timed(lambda: read_patients(table_dir, COLUMNS))))
+
+    print(f"{len(records)} records")
+    print(f"{'format':>8} {'size MB':>9} {'load all s':>11} {'load 3 cols s':>14}")
+    for format, size, load_all, load_columns in rows:
+        columns = f"{load_columns:14.3f}" if load_columns is not None else f"{'-':>14}"
+        print(f"{format:>8} {size / 1e6:9.1f} {load_all:11.3f} {columns}")
@@ -0,0 +1,86 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+from PIL import Image
+
+from bench_tile_dataset import write_tiles
+from embedding_cache import EmbeddingCache, full_model, head_model, inception_backbone, tile_ids
+from tile_dataset import LABELS, build_index, tile_dataset
+
+# CPU time to train traindata.py's head for some epochs: through the frozen InceptionV3 backbone every epoch, vs
+# embedding every tile once with embedding_cache.py and training the head from the cache. Then adds tiles and checks
+# that updating the cache only embeds the new ones, and that tiles from an index mixing image files and tile store
+# rows are stored under their own IDs. The backbone has random weights (nothing is downloaded), which
+# does not change its cost.
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark training the head from cached backbone embeddings.")
+    ap.add_argument("-n", "--tiles", type=int, default=64)
+    ap.add_argument("-t", "--tile_size", type=int, default=512)
+    ap.add_argument("-s", "--image_size", type=int, default=299)
+    ap.add_argument("-e", "--epochs", type=int, default=10)
+    ap.add_argument("-a", "--added", type=int, default=8, help="tiles added before the incremental update")
+    ap.add_argument("-b", "--batch_size", type=int, default=16)
+    args = ap.parse_args()
+    tf.keras.utils.set_random_seed(0)
+
+    root, store_root = write_tiles(tempfile.mkdtemp(), args.tiles, args.tile_size)
+    index = build_index(root, "lymph")
+    backbone = inception_backbone(args.image_size, weights=None)
+    print(f"{len(index)} tiles of {args.tile_size}px at {args.image_size}px, {args.epochs} epochs, "
+          f"{os.cpu_count()} CPUs")
+
+    head = head_model(backbone.output.shape[1])
+    model = full_model(backbone, head)
+    model.compile(optimizer="rmsprop", loss="binary_crossentropy")
+    dataset = tile_dataset(index, batch_size=args.batch_size, image_size=args.image_size, cache="")
+    epoch, _ = timed(lambda: model.fit(dataset, epochs=1, verbose=0))
+    print(f"{'through the backbone':>28}: {epoch:7.2f}s per epoch, {args.epochs * epoch:8.1f}s for {args.epochs} "
+          f"epochs (measured on 1)")
+
+    with EmbeddingCache(os.path.join(root, "embeddings.h5"), backbone, args.image_size) as cache:
+        extract, (features, labels) = timed(lambda: cache.features(index, root))
+        head = head_model(features.shape[1])
+        head.compile(optimizer="rmsprop", loss="binary_crossentropy")
+        head.fit(features, labels, batch_size=args.batch_size, epochs=1, verbose=0)  # builds the training step
+        train, _ = timed(lambda: head.fit(features, labels, batch_size=args.batch_size, epochs=args.epochs,
+                                          verbose=0))
+        print(f"{'from the embedding cache':>28}: {train / args.epochs:7.3f}s per epoch, {extract + train:8.1f}s for "
+              f"{args.epochs} epochs ({extract:.1f}s embedding {cache.stats['computed']} tiles once)")
+
+        # new tiles arrive
+        directory = os.path.join(root, "lymph_train_dir", "early")
+        for n in range(args.added):
+            Image.fromarray(np.full((args.tile_size, args.tile_size, 3), 200 - n, dtype=np.uint8)).save(
+                os.path.join(directory, f"new_{n}.png"))
+        index = build_index(root, "lymph")
+        update, computed = timed(lambda: cache.update(index, root))
+        assert computed == args.added and len(cache) == len(index)
+        print(f"{'update after adding tiles':>28}: {computed} of {len(index)} tiles embedded, {update:.1f}s")
+
+    with EmbeddingCache(os.path.join(root, "embeddings.h5"), backbone, args.image_size) as cache:
+        assert cache.update(index, root) == 0
+        print(f"{'reopened cache':>28}: {len(cache)} embeddings, nothing to compute")
+
+    # the same tiles as image files and as tile store rows, embedded together from one index that mixes them: each
+    # row's embedding has to land on its own ID, so every store row matches the file holding the same pixels
+    store_index = build_index(store_root, "lymph")
+    mixed = pd.concat([index, store_index]).sort_values("label", kind="stable")
+    with EmbeddingCache(os.path.join(root, "mixed.h5"), backbone, args.image_size) as cache:
+        assert cache.update(mixed, root) == len(mixed)
+        numbers = 2 * store_index["row"].to_numpy() + store_index["label"].to_numpy()  # as write_tiles deals them
+        files = [os.path.join("lymph_train_dir", LABELS[n % 2], f"slide_{n}.png") for n in numbers]
+        assert np.allclose(cache.embeddings(tile_ids(store_index, root)), cache.embeddings(files), atol=1e-2)
+        print(f"{'mixed files and store rows':>28}: {len(store_index)} store rows embedded under their own IDs")
@@ -0,0 +1,175 @@
+import argparse
+import json
+import time
+
+from flatten_cases import flatten_hits
+from mock_gdc import synthetic_cases, synthetic_files
+
+# flattening a synthetic cohort with the table-driven flatten_cases.flatten_hits vs the loop query.py used to run
+# (kept below as legacy_flatten, reading the query output back from disk first as it did), checking that both
+# produce the same reconstructedData.json and case_ids.json contents.
+
+
+def synthetic_output(num_cases):
+    cases = synthetic_cases(num_cases)
+    files = {}
+    for file_hit in synthetic_files(cases):
+        slide_id = file_hit.pop("cases")[0]["samples"][0]["portions"][0]["slides"][0]["slide_id"]
+        files[slide_id] = [file_hit]
+    for hit in cases:
+        hit["slides"] = {slide: files[slide] for slide in hit["slide_ids"]}
+    return {"data": {"hits": cases}, "warnings": {}}
+
+
+def legacy_flatten(output):
+    alive = 0
+    dead = 0
+    numberOfSlides = 0
+    agesAtDiagnosis = []
+    timeTillDeath = []
+    dict_data = {"data": []}
+    mutation_genes_data = {"case_ids": []}
+    tempSlide = 0
+    totalSize = 0
+    for i in range(0, len(output["data"]["hits"])):  # constructing json
+        if "slide_ids" in output["data"]["hits"][i]:
+            for slide_ids in output["data"]["hits"][i]["slide_ids"]:
+                mutation_genes_data["case_ids"].append(slide_ids)
+        if "demographic" in output["data"]["hits"][i]:
+            if output["data"]["hits"][i]["demographic"]["vital_status"] == "Alive":
+                alive += 1
+            else:
+                dead += 1
+        for data in output["data"]["hits"][i]["samples"]:
+            patient = {}
+            death_years = 0
+            alive_years = 0
+            patient["patient_id"] = output["data"]["hits"][i]["id"]
+            if "slide_ids" in output["data"]["hits"][i]:
+                numberOfSlides += len(output["data"]["hits"][i]["slide_ids"])
+
+            if "demographic" in output["data"]["hits"][i]:
+                if output["data"]["hits"][i]["demographic"]["vital_status"] == "Alive":
+                    patient["vital_status"] = "Alive"
+                else:
+                    patient["vital_status"] = "Dead"
+                if "days_to_death" in output["data"]["hits"][i]["demographic"]:
+                    if output["data"]["hits"][i]["demographic"]["days_to_death"] is not None:
+                        death_years = (output["data"]["hits"][i]["demographic"]["days_to_death"] / 365)
+                        timeTillDeath.append(death_years)
+                        patient["years_to_death"] = death_years
+
+            if "diagnoses" in output["data"]["hits"][i]:
+                if "days_to_last_follow_up" in output["data"]["hits"][i]["diagnoses"][0]:
+                    if output["data"]["hits"][i]["diagnoses"][0]["days_to_last_follow_up"] is not None:
+                        alive_years = (output["data"]["hits"][i]["diagnoses"][0]["days_to_last_follow_up"] / 365)
+                        patient["years_to_last_follow_up"] = alive_years
+                if "age_at_diagnosis" in output["data"]["hits"][i]["diagnoses"][0]:
+                    if output["data"]["hits"][i]["diagnoses"][0]["age_at_diagnosis"] is not None:
+                        agesAtDiagnosis.append((output["data"]["hits"][i]["diagnoses"][0]["age_at_diagnosis"] / 365))
+                        patient["age_at_diagnosis"] = (
+                                output["data"]["hits"][i]["diagnoses"][0]["age_at_diagnosis"] / 365)
+                if "year_of_diagnosis" in output["data"]["hits"][i]["diagnoses"][0]:
+                    patient["year_of_diagnosis"] = output["data"]["hits"][i]["diagnoses"][0]["year_of_diagnosis"]
+                if "tumor_stage" in output["data"]["hits"][i]["diagnoses"][0]:
+                    patient["tumor_stage"] = output["data"]["hits"][i]["diagnoses"][0]["tumor_stage"]
+                if "tissue_or_organ_of_origin" in output["data"]["hits"][i]["diagnoses"][0]:
+                    patient["tissue_or_organ_of_origin"] = output["data"]["hits"][i]["diagnoses"][0][
+                        "tissue_or_organ_of_origin"]
+                if "site_of_resection_or_biopsy" in output["data"]["hits"][i]["diagnoses"][0]:
+                    site = output["data"]["hits"][i]["diagnoses"][0]["site_of_resection_or_biopsy"]
+                    patient["site_of_resection_or_biopsy"] = site
+                    if "lymph" in site.lower():
+                        patient["biopsy_tissue_type"] = "Lymph"
+                    elif "skin" in site.lower():
+                        patient["biopsy_tissue_type"] = "Skin"
+                    else:
+                        patient["biopsy_tissue_type"] = "N/A"
+                if "prior_malignancy" in output["data"]["hits"][i]["diagnoses"][0]:
+                    patient["prior_malignancy"] = output["data"]["hits"][i]["diagnoses"][0]["prior_malignancy"]
+                if "primary_diagnosis" in output["data"]["hits"][i]["diagnoses"][0]:
+                    patient["primary_diagnosis"] = output["data"]["hits"][i]["diagnoses"][0]["primary_diagnosis"]
+            patient["years_survived"] = max(death_years, alive_years)
+            # if "days_to_recurrence" in output["data"]["hits"][i]["diagnoses"][0]:
+            #     if output["data"]["hits"][i]["diagnoses"][0]["days_to_recurrence"] is not None:
+            #         patient["years_to_recurrence"] = (output["data"]["hits"][i]["diagnoses"][0]["days_to_recurrence"] / 365)
+            sample = data["portions"][0]["slides"][0]
+            patient["slides"] = {}
+            currentSlideID = sample["slide_id"]
+            patient["slides"]["slide_id"] = currentSlideID
+            if "slides" in output["data"]["hits"][i]:
+                slideData = output["data"]["hits"][i]["slides"][currentSlideID]
+                if len(slideData) >= 1:
+                    if "file_id" in slideData[0]:
+                        fileID = slideData[0]["file_id"]
+                        patient["slides"]["file_id"] = fileID
+                    if "file_size" in slideData[0]:
+                        fileSize = slideData[0]["file_size"]
+                        patient["slides"]["file_size"] = fileSize
+                        totalSize += fileSize
+                    if "md5sum" in slideData[0]:
+                        patient["slides"]["md5sum"] = slideData[0]["md5sum"]
+            if "case_id" in output["data"]["hits"][i]:
+                patient["slides"]["case_id"] = output["data"]["hits"][i]["case_id"]
+            if "percent_stromal_cells" in sample:
+                patient["slides"]["percent_stromal_cells"] = sample["percent_stromal_cells"]
+            if "section_location" in sample:
+                patient["slides"]["section_location"] = sample["section_location"]
+            if "percent_tumor_cells" in sample:
+                patient["slides"]["percent_tumor_cells"] = sample["percent_tumor_cells"]
+            if "percent_neutrophil_infiltration" in sample:
+                patient["slides"]["percent_neutrophil_infiltration"] = sample["percent_neutrophil_infiltration"]
+            if "percent_lymphocyte_infiltration" in sample:
+                patient["slides"]["percent_lymphocyte_infiltration"] = sample["percent_lymphocyte_infiltration"]
+            if "percent_necrosis" in sample:
+                patient["slides"]["percent_necrosis"] = sample["percent_necrosis"]
+            if "percent_normal_cells" in sample:
+                patient["slides"]["percent_normal_cells"] = sample["percent_normal_cells"]
+            if "percent_monocyte_infiltration" in sample:
+                patient["slides"]["percent_monocyte_infiltration"] = sample["percent_monocyte_infiltration"]
+            if "percent_tumor_nuclei" in sample:
+                patient["slides"]["percent_tumor_nuclei"] = sample["percent_tumor_nuclei"]
+            if "submitter_id" in sample:
+                patient["slides"]["submitter_id"] = sample["submitter_id"]
+            codes = (sample["submitter_id"]).split("-", )
+            if codes[0] == "TCGA":
+                sampleCode = (codes[3][0:2])
+                patient["slides"]["SampleCode"] = sampleCode
+                if sampleCode == "01":
+                    patient["slides"]["sample_type"] = "Primary Solid Tumor"
+                if sampleCode == "06":
+                    patient["slides"]["sample_type"] = "Metastatic"
+                if sampleCode == "07":
+                    patient["slides"]["sample_type"] = "Additional Metastatic"
+                if sampleCode == "11":
+                    patient["slides"]["sample_type"] = "Solid Tissue Normal"
+            dict_data["data"].append(patient)
+    return dict_data, mutation_genes_data
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark flattening of case hits.")
+    ap.add_argument("-N", "--num_cases", type=int, default=100000)
+    args = ap.parse_args()
+
+    output = synthetic_output(args.num_cases)
+
+    start = time.perf_counter()
+    legacy_data, legacy_ids = legacy_flatten(json.loads(json.dumps(output, indent=2)))
+    legacy_disk = time.perf_counter() - start
+
+    start = time.perf_counter()
+    legacy_flatten(output)
+    legacy_memory = time.perf_counter() - start
+
+    start = time.perf_counter()
+    records, slide_ids = flatten_hits(output["data"]["hits"])
+    table = time.perf_counter() - start
+
+    print(f"{args.num_cases} cases, {len(records)} records")
+    print(f"legacy, re-read from disk: {legacy_disk:7.3f} s")
+    print(f"legacy, in memory:         {legacy_memory:7.3f} s")
+    print(f"table driven, in memory:   {table:7.3f} s")
+
+    assert json.dumps({"data": records}, indent=2) == json.dumps(legacy_data, indent=2), "reconstructedData differs"
+    assert json.dumps({"case_ids": slide_ids}, indent=2) == json.dumps(legacy_ids, indent=2), "case_ids differ"
@@ -0,0 +1,79 @@
+import argparse
+import asyncio
+import time
+
+import requests
+
+from gdc_client import AsyncGDCClient, GDCClient
+from mock_gdc import MockGDC, serve, synthetic_cases
+
+# throughput and retry behaviour of gdc_client against the local mock GDC server: bare serial requests.get (what
+# the scripts used to do) vs the pooled client run serially, through map(), and through the asyncio front end.
+# With --fail_rate > 0 the mock answers that fraction of requests with 429/503, which the bare path reports as
+# errors and the client should absorb with retries.
+
+
+def bare(url, pages):
+    errors = 0
+    for params in pages:
+        if requests.get(url, params=params).status_code != 200:
+            errors += 1
+    return errors
+
+
+def pooled_serial(client, url, pages):
+    for params in pages:
+        client.get_json(url, params=params)
+    return 0
+
+
+def pooled_map(client, url, pages):
+    client.map(lambda params: client.get_json(url, params=params), pages)
+    return 0
+
+
+def pooled_async(client, url, pages):
+    async_client = AsyncGDCClient(client)
+
+    async def fetch_all():
+        return await asyncio.gather(*[async_client.get_json(url, params) for params in pages])
+
+    loop = asyncio.new_event_loop()
+    try:
+        loop.run_until_complete(fetch_all())
+    finally:
+        loop.close()
+        async_client.close()
+    return 0
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark gdc_client against a mock GDC server.")
+    ap.add_argument("-r", "--num_requests", type=int, default=200)
+    ap.add_argument("-c", "--concurrency", type=int, default=8)
+    ap.add_argument("-l", "--latency", type=float, default=0.02, help="seconds added to every mock request")
+    ap.add_argument("-f", "--fail_rate", type=float, default=0.1, help="fraction of mock requests that fail")
+    ap.add_argument("--rate", type=float, default=0, help="per host request rate limit (0 = unlimited)")
+    args = ap.parse_args()
+
+    mock = MockGDC(synthetic_cases(200), latency=args.latency, fail_rate=args.fail_rate)
+    pages = [{"size": 10, "from": (n * 10) % 200} for n in range(args.num_requests)]
+
+    with serve(mock) as base_url:
+        url = base_url + "cases"
+        runs = [("bare requests", None, bare)]
+        for label, run in [("client serial", pooled_serial), ("client map", pooled_map),
+                           ("client async", pooled_async)]:
+            client = GDCClient(max_concurrency=args.concurrency, rate=args.rate, backoff=0.01)
+            runs.append((label, client, lambda u, p, run=run, client=client: run(client, u, p)))
+
+        for label, client, run in runs:
+            mock.requests = mock.failures = 0
+            start = time.perf_counter()
+            errors = run(url, pages)
+            elapsed = time.perf_counter() - start
+            retries = client.stats["retries"] if client else 0
+            print(f"{label:>14}: {len(pages) / elapsed:8.1f} req/s, {mock.requests} sent, "
+                  f"{mock.failures} failed at server, {retries} retried, {errors} errors returned")
+            if client:
+                client.close()
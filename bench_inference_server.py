@@ -0,0 +1,91 @@
+import argparse
+import os
+import tempfile
+import threading
+import time
+from concurrent import futures
+
+import numpy as np
+import requests
+import tensorflow as tf
+
+from embedding_cache import full_model, head_model, inception_backbone
+from inference_server import InferenceService, serve
+from synthetic_slide import synthetic_image
+from tile_store import TileShard
+
+# load test of inference_server.py on the CPU: concurrent clients each POST tile stores (small slides, or the chunks
+# a client would send) to /score, against a server predicting one tile at a time (batch size 1) and one that
+# microbatches tiles from every request in flight. Client-side latency and throughput, and the server's batch fill.
+# The model is the backbone (random weights) and head of traindata.py, at a small input size.
+
+
+def write_stores(root, stores, tiles, tile_size):
+    """stores tile stores of tiles tiles each, as single shards under root; returns their paths."""
+    side = int(np.ceil(np.sqrt(tiles)))
+    paths = []
+    for s in range(stores):
+        image = synthetic_image(side * tile_size, side * tile_size, blobs=side * 3, seed=s)
+        path = os.path.join(root, f"slide{s:03d}", "rows_00000-00000.h5")
+        os.makedirs(os.path.dirname(path))
+        shard = TileShard(path, "w")
+        for n in range(tiles):
+            y, x = divmod(n, side)
+            shard.append(n, x, y, 100.0, image[y * tile_size:(y + 1) * tile_size, x * tile_size:(x + 1) * tile_size])
+        shard.close()
+        paths.append(path)
+    return paths
+
+
+def load_test(base_url, paths, clients, requests_per_client):
+    """Client-side latencies and the wall time of clients threads each sending requests_per_client requests."""
+    local = threading.local()
+
+    def client(n):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        latencies = []
+        for r in range(requests_per_client):
+            start = time.perf_counter()
+            response = local.session.post(f"{base_url}score", json={"path": paths[(n + r) % len(paths)],
+                                                                     "tiles": False})
+            response.raise_for_status()
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    start = time.perf_counter()
+    with futures.ThreadPoolExecutor(clients) as pool:
+        latencies = np.concatenate(list(pool.map(client, range(clients))))
+    return latencies, time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Load test the inference server on the CPU.")
+    ap.add_argument("-n", "--stores", type=int, default=8)
+    ap.add_argument("-m", "--tiles", type=int, default=8, help="tiles per request")
+    ap.add_argument("-t", "--tile_size", type=int, default=256)
+    ap.add_argument("-s", "--image_size", type=int, default=128)
+    ap.add_argument("-b", "--batch_size", type=int, default=32)
+    ap.add_argument("-c", "--clients", type=int, nargs="+", default=[1, 8])
+    ap.add_argument("-r", "--requests", type=int, default=8, help="requests per client")
+    args = ap.parse_args()
+    tf.keras.utils.set_random_seed(0)
+
+    paths = write_stores(tempfile.mkdtemp(), args.stores, args.tiles, args.tile_size)
+    backbone = inception_backbone(args.image_size, weights=None)
+    model = full_model(backbone, head_model(backbone.output.shape[1]))
+    print(f"requests of {args.tiles} tiles of {args.tile_size}px at {args.image_size}px, {os.cpu_count()} CPUs")
+
+    for batch_size in [1, args.batch_size]:
+        for clients in args.clients:
+            service = InferenceService(model, batch_size=batch_size)
+            with serve(service) as base_url:
+                load_test(base_url, paths[:1], 1, 1)  # traces the model
+                service.metrics.__init__(batch_size)
+                latencies, wall = load_test(base_url, paths, clients, args.requests)
+                metrics = requests.get(f"{base_url}metrics").json()
+            service.close()
+            p50, p95 = np.percentile(latencies, [50, 95])
+            print(f"batch {batch_size:3d}, {clients:2d} clients: {len(latencies) * args.tiles / wall:7.1f} tiles/s, "
+                  f"{len(latencies) / wall:6.2f} requests/s, latency p50 {p50:.2f}s p95 {p95:.2f}s, "
+                  f"batch fill {metrics['batch_fill']:.2f}")
@@ -0,0 +1,63 @@
+import argparse
+import os
+import tempfile
+
+import openslide
+from openslide import deepzoom
+
+from synthetic_slide import write_synthetic_slide
+from tiler import FolderWriter, format_level_stats, format_stats, tile_slide, tile_slide_levels
+
+# tiling several levels of a slide with one tile_slide run per level (each re-reading the slide, with its own tissue
+# mask pre-pass) vs tile_slide_levels' single pass, where coarse tiles gate the finer levels: tiles read, wall time,
+# and a check that gating loses no tile the per-level runs keep. --no_mask turns the tissue mask off in both, leaving
+# gating as the only thing that saves reads.
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark tiling several levels of a slide in one pass.")
+    ap.add_argument("-W", "--width", type=int, default=16384)
+    ap.add_argument("-H", "--height", type=int, default=12288)
+    ap.add_argument("-t", "--tile_size", type=int, default=512)
+    ap.add_argument("-l", "--levels", type=int, default=3, help="number of levels, from the highest down")
+    ap.add_argument("-T", "--threshold", type=int, default=50, help="tissue percentage above which tiles are kept")
+    ap.add_argument("-w", "--workers", type=int, default=1)
+    ap.add_argument("--no_mask", action="store_true", help="read every tile instead of skipping background with the "
+                                                          "low resolution tissue mask")
+    ap.add_argument("-s", "--slide", help="existing slide to use instead of a synthetic one", default=None)
+    args = ap.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    slide_path = args.slide or write_synthetic_slide(os.path.join(work_dir, "synthetic.tiff"), args.width, args.height)
+    highest = deepzoom.DeepZoomGenerator(openslide.OpenSlide(slide_path), tile_size=args.tile_size).level_count - 1
+    levels = list(range(highest - args.levels + 1, highest + 1))
+
+    kept, wall, read = {}, 0.0, 0
+    for level in levels:
+        output = os.path.join(work_dir, "separate", str(level))
+        os.makedirs(output)
+        stats = tile_slide(slide_path, args.tile_size, level, args.threshold, FolderWriter(output),
+                           workers=args.workers, native=True, skip_background=not args.no_mask)
+        kept[level] = set(os.listdir(output))
+        wall, read = wall + stats["wall"], read + stats["tiles"]
+        print(f"level {level} on its own: {format_stats(stats)}")
+    print(f"one run per level: {read} tiles read, {wall:.1f}s")
+
+    writers = {}
+    for level in levels:
+        writers[level] = FolderWriter(os.path.join(work_dir, "single", str(level)))
+        os.makedirs(writers[level].folder)
+    stats = tile_slide_levels(slide_path, args.tile_size, levels, args.threshold, writers, workers=args.workers,
+                              native=True, skip_background=not args.no_mask)
+    print(f"single pass: {format_level_stats(stats)}")
+    print(f"single pass: {stats['tiles']} tiles read, {stats['wall']:.1f}s")
+
+    index = stats["index"]
+    for level in levels:
+        single = set(os.listdir(writers[level].folder))
+        print(f"level {level}: {len(kept[level])} tiles kept per level, {len(single)} in the single pass, "
+              f"{len(kept[level] - single)} lost to gating")
+    read_tiles = set(zip(index["level"].tolist(), index["tile_number"].tolist()))
+    children = index[index["level"] > levels[0]]
+    linked = sum((levels[levels.index(level) - 1], parent) in read_tiles
+                 for level, parent in zip(children["level"].tolist(), children["parent"].tolist()))
+    print(f"{len(children)} finer tiles read, {linked} with their parent in the index")
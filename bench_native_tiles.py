@@ -0,0 +1,58 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from synthetic_slide import write_synthetic_slide
+from tiler import native_level, open_slide, read_row
+
+# reading every full tile of a DeepZoom level through DeepZoomGenerator.get_tile vs straight from the slide level
+# that stores it (tiler.read_row with a slide level: one read_region per REGION_COLUMNS tiles, no rescaling), for
+# each DeepZoom level below the full resolution that the slide stores natively. Reports tiles/sec and whether both give
+# the same pixels. The synthetic slide's levels are exact halvings; give it odd dimensions (-W 16383 -H 12287), as real
+# scans often have, and its lower levels are not exactly half the size of the one above, DeepZoom rescales every tile it
+# reads from them, and tiler.native_level leaves them to DeepZoom.
+
+
+def read_level(slide, generator, level, tile_size, slide_level):
+    columns, rows = generator.level_tiles[level]
+    tiles = {}
+    start = time.perf_counter()
+    for y in range(rows):
+        full = [x for x in range(columns) if generator.get_tile_dimensions(level, (x, y)) == (tile_size, tile_size)]
+        for x, tile in read_row(slide, generator, level, y, full, slide_level):
+            tiles[x, y] = np.asarray(tile)
+    return time.perf_counter() - start, tiles
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark reading tiles from native slide levels vs DeepZoom.")
+    ap.add_argument("-W", "--width", type=int, default=16384)
+    ap.add_argument("-H", "--height", type=int, default=12288)
+    ap.add_argument("-t", "--tile_size", type=int, default=512)
+    ap.add_argument("-s", "--slide", help="existing slide to use instead of a synthetic one", default=None)
+    args = ap.parse_args()
+
+    slide_path = args.slide or write_synthetic_slide(os.path.join(tempfile.mkdtemp(), "synthetic.tiff"),
+                                                     args.width, args.height)
+    slide, generator = open_slide(slide_path, args.tile_size)
+    for level in reversed(range(generator.level_count)):
+        slide_level = native_level(slide, generator, level)
+        if slide_level is None or not any(generator.level_tiles[level]):
+            continue
+        deepzoom_time, expected = read_level(slide, generator, level, args.tile_size, None)
+        native_time, tiles = read_level(slide, generator, level, args.tile_size, slide_level)
+        if not expected:
+            continue
+        identical = sum(np.array_equal(tiles[key], expected[key]) for key in expected)
+        # DeepZoom's rescaling keeps the aspect ratio, so its tiles can come out a pixel or two short
+        short = sum(expected[key].shape != tiles[key].shape for key in expected)
+        difference = np.mean([np.abs(tiles[key][:expected[key].shape[0], :expected[key].shape[1]].astype(int) -
+                                     expected[key]).mean() for key in expected])
+        print(f"DeepZoom level {level} = slide level {slide_level} (downsample "
+              f"{slide.level_downsamples[slide_level]:.4f}), {len(expected)} tiles: "
+              f"{len(expected) / deepzoom_time:6.1f} tiles/s via DeepZoom, {len(tiles) / native_time:6.1f} tiles/s "
+              f"native ({deepzoom_time / native_time:.1f}x), {identical}/{len(expected)} pixel-identical, "
+              f"mean difference {difference:.2f}/255, {short} DeepZoom tiles short of {args.tile_size}px")
@@ -0,0 +1,87 @@
+import argparse
+import os
+import tempfile
+import threading
+import time
+from concurrent import futures
+
+from slide_pipeline import DiskBudget, SlidePipeline, disk_usage, format_pipeline_stats, remove
+
+# the old process_slice_upload main (8 threads, each downloading, tiling and uploading one slide after another)
+# vs slide_pipeline.SlidePipeline with a disk budget, on simulated stages: downloads and uploads share a link of a
+# fixed number of connections and tiling shares a fixed number of cores, each taking time proportional to slide
+# size. Reports wall time and peak scratch disk.
+
+
+class SimulatedStages:
+    def __init__(self, work_dir, slide_mb, seconds_per_mb, connections, cores, tiles_fraction=0.1):
+        self.work_dir = work_dir
+        self.slide_bytes = int(slide_mb * 1024 ** 2)
+        self.seconds = slide_mb * seconds_per_mb
+        self.network = threading.Semaphore(connections)
+        self.cpu = threading.Semaphore(cores)
+        self.uplink = threading.Semaphore(connections)
+        self.tiles_bytes = int(self.slide_bytes * tiles_fraction)
+        self.disk = DiskBudget(float("inf"))  # only used to track the peak
+
+    def _write(self, path, size):
+        with open(path, "wb") as f:
+            f.truncate(size)
+        self.disk.charge(size)
+        return path
+
+    def _remove(self, path):
+        self.disk.release(disk_usage(path))
+        remove(path)
+
+    def download(self, job):
+        with self.network:
+            time.sleep(self.seconds)
+        return self._write(os.path.join(self.work_dir, f"{job}.svs"), self.slide_bytes)
+
+    def tile(self, job, slide_path):
+        with self.cpu:
+            time.sleep(self.seconds)
+        return self._write(os.path.join(self.work_dir, f"{job}_tiles"), self.tiles_bytes)
+
+    def upload(self, job, tiles_path):
+        with self.uplink:
+            time.sleep(self.seconds * 0.5)
+
+
+def run_threads(stages, jobs, threads):
+    def one_slide(job):
+        slide_path = stages.download(job)
+        tiles_path = stages.tile(job, slide_path)
+        stages._remove(slide_path)
+        stages.upload(job, tiles_path)
+        stages._remove(tiles_path)
+
+    start = time.perf_counter()
+    with futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(one_slide, jobs))
+    return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark the download -> tile -> upload pipeline on simulated stages.")
+    ap.add_argument("-n", "--slides", type=int, default=24)
+    ap.add_argument("-m", "--slide_mb", type=float, default=20)
+    ap.add_argument("-s", "--seconds_per_mb", type=float, default=0.01)
+    ap.add_argument("-c", "--connections", type=int, default=4)
+    ap.add_argument("-C", "--cores", type=int, default=2)
+    ap.add_argument("-b", "--budget_mb", type=float, default=100)
+    args = ap.parse_args()
+
+    jobs = list(range(args.slides))
+    stages = SimulatedStages(tempfile.mkdtemp(), args.slide_mb, args.seconds_per_mb, args.connections, args.cores)
+    wall = run_threads(stages, jobs, 8)
+    print(f"8 threads, one slide each: {wall:.1f}s, peak scratch disk {stages.disk.peak / 1024 ** 2:.0f} MB")
+
+    stages = SimulatedStages(tempfile.mkdtemp(), args.slide_mb, args.seconds_per_mb, args.connections, args.cores)
+    pipeline = SlidePipeline(stages.download, stages.tile, stages.upload, size=lambda job: stages.slide_bytes,
+                             download_workers=args.connections, tile_workers=args.cores,
+                             upload_workers=args.connections, disk_budget=args.budget_mb * 1024 ** 2)
+    stats = pipeline.run(jobs)
+    print(f"pipeline, {args.budget_mb:.0f} MB budget: {format_pipeline_stats(stats)} "
+          f"({stats['peak_disk'] / 1024 ** 2:.0f} MB)")
@@ -0,0 +1,102 @@
+import argparse
+import os
+import tempfile
+import time
+
+import requests
+
+from gdc_client import GDCClient
+from mock_gdc import MockGDC, serve, synthetic_cases, synthetic_content
+from slide_downloader import ChecksumError, SlideDownloader, file_md5
+
+# slide downloads from the local mock GDC server, with each connection limited to --bandwidth and a fraction of
+# responses (--cut_rate) dropped half way through: one stream per file that starts again from byte zero when it is
+# cut (what download_slides.download_slide does), vs slide_downloader with 1 and --segments connections per file.
+# Reports wall time and bytes served per byte of slide, then checks that a run killed part way resumes rather than
+# restarts, that a re-run downloads nothing (also once the slides are deleted, with skip_if_recorded), and that a
+# corrupted file fails its md5 check.
+
+
+def restart_from_zero(client, url, path):
+    while True:
+        try:
+            with client.get(url, stream=True) as response, open(path, "wb") as f:
+                expected = int(response.headers["Content-Length"])
+                for chunk in response.iter_content(1024 * 1024):
+                    f.write(chunk)
+            if os.path.getsize(path) == expected:
+                return path
+        except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+            pass
+
+
+def timed(mock, fn):
+    mock.bytes_sent = 0
+    start = time.perf_counter()
+    fn()
+    return time.perf_counter() - start, mock.bytes_sent
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark resumable segmented slide downloads against a mock server.")
+    ap.add_argument("-n", "--files", type=int, default=4)
+    ap.add_argument("-m", "--file_mb", type=float, default=32)
+    ap.add_argument("-b", "--bandwidth", type=float, default=32, help="MB/s of each connection")
+    ap.add_argument("-c", "--cut_rate", type=float, default=0.5, help="fraction of responses dropped half way")
+    ap.add_argument("-s", "--segments", type=int, default=4)
+    args = ap.parse_args()
+
+    cases = synthetic_cases(args.files, slides_per_case=1)
+    mock = MockGDC(cases, bandwidth=args.bandwidth * 1024 ** 2, cut_rate=args.cut_rate)
+    size = int(args.file_mb * 1024 ** 2)
+    for n, file_hit in enumerate(mock.files):
+        mock.add_data(file_hit["file_id"], synthetic_content(size, seed=n))
+    files = [(hit["file_id"], hit["file_size"], hit["md5sum"]) for hit in mock.files]
+    total = size * len(files)
+    client = GDCClient(stream_concurrency=4 * args.segments, backoff=0.01)
+
+    with serve(mock) as base_url:
+        endpoint = base_url + "data/"
+        print(f"{len(files)} files of {args.file_mb:.0f} MB, {args.bandwidth:.0f} MB/s per connection, "
+              f"{args.cut_rate:.0%} of responses cut")
+        directory = tempfile.mkdtemp()
+        seconds, sent = timed(mock, lambda: [restart_from_zero(client, endpoint + file_id,
+                                                               os.path.join(directory, file_id))
+                                             for file_id, _, _ in files])
+        assert all(file_md5(os.path.join(directory, file_id)) == md5 for file_id, _, md5 in files)
+        print(f"{'one stream, restart from zero':>32}: {seconds:6.2f}s, {sent / total:.2f} bytes served per byte")
+        for segments in [1, args.segments]:
+            downloader = SlideDownloader(tempfile.mkdtemp(), endpoint, client, segments=segments,
+                                         min_segment=1024 ** 2)
+            seconds, sent = timed(mock, lambda: [downloader.download(*file) for file in files])
+            print(f"{f'slide_downloader, {segments} segments':>32}: {seconds:6.2f}s, "
+                  f"{sent / total:.2f} bytes served per byte, {downloader.stats['reconnects']} reconnects")
+
+        # a run that gives up on every cut connection, then a second run over the same directory
+        directory = tempfile.mkdtemp()
+        mock.cut_rate = 0.5
+        first = SlideDownloader(directory, endpoint, client, segments=args.segments, min_segment=1024 ** 2, retries=0)
+        failed = first.download_many(files)
+        mock.cut_rate = 0
+        second = SlideDownloader(directory, endpoint, client, segments=args.segments, min_segment=1024 ** 2)
+        seconds, sent = timed(mock, lambda: second.download_many(files))
+        print(f"first run: {len(failed)} of {len(files)} files interrupted; second run: {second.stats['resumed']} "
+              f"resumed, {second.stats['bytes'] / 1024 ** 2:.0f} MB fetched, {seconds:.2f}s")
+        third = SlideDownloader(directory, endpoint, client)
+        seconds, sent = timed(mock, lambda: third.download_many(files))
+        assert sent == 0 and third.stats["skipped"] == len(files)
+        print(f"third run: {third.stats['skipped']} skipped from the manifest, nothing fetched")
+        # as download_slides.py runs: every slide deleted once it is uploaded
+        for file_id, _, _ in files:
+            os.remove(third.path(file_id))
+        fourth = SlideDownloader(directory, endpoint, client, skip_if_recorded=True)
+        seconds, sent = timed(mock, lambda: fourth.download_many(files))
+        assert sent == 0 and fourth.stats["skipped"] == len(files)
+        print(f"slides deleted, run with skip_if_recorded: {fourth.stats['skipped']} skipped, nothing fetched")
+
+        file_id, size, _ = files[0]
+        try:
+            SlideDownloader(tempfile.mkdtemp(), endpoint, client).download(file_id, size, "0" * 32)
+            raise AssertionError("a wrong md5 was accepted")
+        except ChecksumError as error:
+            print(f"wrong md5 rejected: {error}")
@@ -0,0 +1,47 @@
+import argparse
+import time
+
+import query
+from gdc_client import GDCClient, set_default_client
+from mock_gdc import MockGDC, serve, synthetic_cases
+
+# compares resolving slide -> SVS files one request per slide (slide_to_files) against the batched
+# slides_to_files, using a local mock GDC server. Use --latency to emulate the round trip to the real API.
+
+
+def run(mock, label, resolve):
+    mock.requests = 0
+    start = time.perf_counter()
+    result = resolve()
+    elapsed = time.perf_counter() - start
+    return label, mock.requests, elapsed, result
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark slide to file resolution against a mock GDC server.")
+    ap.add_argument("-n", "--num_slides", type=int, default=1000)
+    ap.add_argument("-b", "--batch_size", type=int, default=query.SLIDES_PER_REQUEST)
+    ap.add_argument("-l", "--latency", type=float, default=0.02, help="seconds added to every mock request")
+    ap.add_argument("--rate", type=float, default=0, help="per host request rate limit (0 = unlimited)")
+    args = ap.parse_args()
+    set_default_client(GDCClient(rate=args.rate))
+
+    mock = MockGDC(synthetic_cases(-(-args.num_slides // 2), slides_per_case=2), latency=args.latency)
+    slide_ids = [slide for case in mock.cases for slide in case["slide_ids"]][:args.num_slides]
+
+    with serve(mock) as base_url:
+        files_endpoint = base_url + "files"
+        results = [
+            run(mock, "per slide", lambda: {slide: query.slide_to_files(slide, endpoint=files_endpoint)["data"]["hits"]
+                                            for slide in slide_ids}),
+            run(mock, "batched", lambda: query.slides_to_files(slide_ids, batch_size=args.batch_size,
+                                                                endpoint=files_endpoint)),
+        ]
+
+    per_k = 1000 / len(slide_ids)
+    print(f"{len(slide_ids)} slides, {args.latency * 1000:.0f} ms mock latency")
+    for label, requests_issued, elapsed, _ in results:
+        print(f"{label:>10}: {requests_issued * per_k:8.1f} requests / 1k slides, {elapsed * per_k:8.3f} s / 1k slides")
+
+    serial, batched = results[0][3], results[1][3]
+    assert serial == batched, "batched resolution returned different files"
@@ -0,0 +1,84 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from embedding_cache import EmbeddingCache, head_model, inception_backbone
+from slide_inference import SlideScorer, slide_metrics
+from synthetic_slide import synthetic_image
+from tile_dataset import LABELS, build_index
+
+# CPU time to score whole slides with slide_inference.py: tiles through the frozen backbone in batches of 32 (as
+# traindata.py trains) vs larger batches, how many tiles early stopping saves with mean and top-k pooling, and
+# scoring from an embedding cache. The backbone has random weights and the head's output bias is raised so tiles
+# score around 0.88, as a confident model's would; neither changes the cost of scoring.
+
+
+def write_slides(root, slides, tiles, tile_size):
+    """tiles PNG tiles <slide>_<n>.png for each of slides slides under root/lymph_validation_dir/<label>/."""
+    side = int(np.ceil(np.sqrt(tiles)))
+    for s in range(slides):
+        image = synthetic_image(side * tile_size, side * tile_size, blobs=side * 3, seed=s)
+        directory = os.path.join(root, "lymph_validation_dir", LABELS[s % 2])
+        os.makedirs(directory, exist_ok=True)
+        for n in range(tiles):
+            y, x = divmod(n, side)
+            tile = image[y * tile_size:(y + 1) * tile_size, x * tile_size:(x + 1) * tile_size]
+            Image.fromarray(tile).save(os.path.join(directory, f"slide{s:03d}_{n}.png"))
+    return root
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark slide-level inference on the CPU.")
+    ap.add_argument("-n", "--slides", type=int, default=4)
+    ap.add_argument("-m", "--tiles", type=int, default=128, help="tiles per slide")
+    ap.add_argument("-t", "--tile_size", type=int, default=256)
+    ap.add_argument("-s", "--image_size", type=int, default=128)
+    ap.add_argument("-b", "--batch_size", type=int, default=256)
+    ap.add_argument("-k", "--top_k", type=int, default=16)
+    args = ap.parse_args()
+    tf.keras.utils.set_random_seed(0)
+
+    root = write_slides(tempfile.mkdtemp(), args.slides, args.tiles, args.tile_size)
+    index = build_index(root, "lymph")
+    backbone = inception_backbone(args.image_size, weights=None)
+    head = head_model(backbone.output.shape[1])
+    head.layers[-1].bias.assign([2.0])
+    print(f"{args.slides} slides of {args.tiles} tiles of {args.tile_size}px at {args.image_size}px, "
+          f"{os.cpu_count()} CPUs")
+    first_slide = index.iloc[:args.tiles]
+
+    def run(name, scorer, **kwargs):
+        scorer.score_slides(first_slide, root_dir=root, **kwargs)  # traces the batch shapes
+        seconds, predictions = timed(lambda: scorer.score_slides(index, root_dir=root, **kwargs))
+        metrics = slide_metrics(predictions)
+        scored = int(predictions["tiles_scored"].sum())
+        print(f"{name:>34}: {seconds:7.1f}s, {scored / seconds:6.1f} tiles/s, {scored} of {len(index)} tiles "
+              f"scored, accuracy {metrics['accuracy']:.2f}")
+        return predictions
+
+    for batch_size in sorted({32, args.batch_size}):
+        run(f"batch {batch_size}, mean, no early stop", SlideScorer(backbone, head, args.image_size, batch_size),
+            early_stop=False)
+    scorer = SlideScorer(backbone, head, args.image_size, 32)
+    full = scorer.score_slides(index, pooling="topk", k=args.top_k, early_stop=False)
+    for pooling in ["mean", "topk"]:
+        predictions = run(f"batch 32, {pooling}, early stop", scorer, pooling=pooling, k=args.top_k)
+        expected = full if pooling == "topk" else scorer.score_slides(index, early_stop=False)
+        assert (predictions["prediction"] == expected["prediction"]).all()
+
+    with EmbeddingCache(os.path.join(root, "embeddings.h5"), backbone, args.image_size) as cache:
+        extract, _ = timed(lambda: cache.update(index, root, batch_size=args.batch_size))
+        print(f"{'embedding cache, built once':>34}: {extract:7.1f}s")
+        run("from the cache, mean", SlideScorer(backbone, head, args.image_size, args.batch_size, cache=cache),
+            early_stop=False)
@@ -0,0 +1,54 @@
+import argparse
+import io
+import time
+
+import numpy as np
+from PIL import Image
+
+from synthetic_slide import synthetic_image
+from tile_codec import EncoderPool, decode, encode
+
+# encode time, bytes per tile and fidelity (PSNR; inf for lossless) of each output codec on RGBA tiles like the ones
+# DeepZoom/read_region hand over, and the throughput of an EncoderPool with more threads.
+
+CODECS = ["png", "png:1", "png:0", "jpeg:95", "jpeg:90", "jpeg:75", "webp:90", "webp:75", "raw"]
+
+
+def psnr(a, b):
+    mse = np.mean((a.astype(np.float64) - b) ** 2)
+    return float("inf") if mse == 0 else 10 * np.log10(255 ** 2 / mse)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark tile encoding codecs.")
+    ap.add_argument("-n", "--tiles", type=int, default=16)
+    ap.add_argument("-t", "--tile_size", type=int, default=1024)
+    ap.add_argument("-T", "--threads", type=int, nargs="+", default=[1, 2, 4])
+    args = ap.parse_args()
+
+    image = synthetic_image(args.tile_size * args.tiles, args.tile_size, blobs=args.tiles * 3)
+    tiles = [Image.fromarray(image[:, i * args.tile_size:(i + 1) * args.tile_size]).convert("RGBA")
+             for i in range(args.tiles)]
+    rgb = [np.asarray(tile.convert("RGB")) for tile in tiles]
+
+    start = time.perf_counter()
+    for tile in tiles:
+        tile.save(io.BytesIO(), "png")
+    rgba_png = (time.perf_counter() - start) / len(tiles)
+    print(f"{len(tiles)} tiles of {args.tile_size}px; PNG of the RGBA tile as before: {1000 * rgba_png:.1f} ms/tile")
+
+    for codec in CODECS:
+        start = time.perf_counter()
+        encoded = [encode(tile, codec) for tile in tiles]
+        seconds = (time.perf_counter() - start) / len(tiles)
+        size = np.mean([data.nbytes if isinstance(data, np.ndarray) else len(data) for data in encoded])
+        quality = min(psnr(decode(data, codec), pixels) for data, pixels in zip(encoded, rgb))
+        print(f"{codec:>8}: {1000 * seconds:7.1f} ms/tile, {size / 1024:8.1f} KB/tile, PSNR {quality:5.1f} dB")
+
+    for threads in args.threads:
+        with EncoderPool("png", threads) as pool:
+            start = time.perf_counter()
+            for encoded in [pool.submit(tile) for tile in tiles]:
+                encoded.result()
+            seconds = time.perf_counter() - start
+        print(f"EncoderPool png, {threads} thread(s): {len(tiles) / seconds:6.1f} tiles/s")
@@ -0,0 +1,85 @@
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from synthetic_slide import synthetic_image
+from tile_dataset import LABELS, build_index, tile_dataset
+from tile_store import TileShard
+
+# CPU-only images/sec feeding a model from tiles on disk: a single-threaded PIL loop handing over one image at a time
+# (what traindata.py's flow_from_directory(batch_size=1, target_size=(1024, 1024)) does), vs tile_dataset.py with
+# batch size 1 and 1 decoding worker, batched with parallel decoding and downscaling, a second, cached epoch, and
+# reading raw tiles from an HDF5 tile store instead of PNG files.
+
+
+def write_tiles(root, count, tile_size):
+    """count PNG tiles under root/lymph_train_dir/<label>/ and the same tiles in a tile store under
+    root/store/lymph_train_dir/<label>/slide/; returns the two roots."""
+    side = int(np.ceil(np.sqrt(count)))
+    image = synthetic_image(side * tile_size, side * tile_size, blobs=side * 3)
+    store_root = os.path.join(root, "store")
+    shards = {}
+    for n in range(count):
+        y, x = divmod(n, side)
+        tile = image[y * tile_size:(y + 1) * tile_size, x * tile_size:(x + 1) * tile_size]
+        label = LABELS[n % 2]
+        directory = os.path.join(root, "lymph_train_dir", label)
+        os.makedirs(directory, exist_ok=True)
+        Image.fromarray(tile).save(os.path.join(directory, f"slide_{n}.png"))
+        if label not in shards:
+            store = os.path.join(store_root, "lymph_train_dir", label, "slide")
+            os.makedirs(store, exist_ok=True)
+            shards[label] = TileShard(os.path.join(store, "rows_00000-00000.h5"), "w")
+        shards[label].append(n, x, y, 100.0, tile)
+    for shard in shards.values():
+        shard.close()
+    return root, store_root
+
+
+def pil_loop(paths, image_size):
+    for path in paths:
+        image = Image.open(path).convert("RGB")
+        if image.size != (image_size, image_size):
+            image = image.resize((image_size, image_size), Image.NEAREST)
+        yield np.asarray(image, dtype=np.float32)[None]
+
+
+def images_per_second(batches):
+    start = time.perf_counter()
+    images = sum(len(batch[0]) if isinstance(batch, tuple) else len(batch) for batch in batches)
+    return images / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark the tile input pipeline on the CPU.")
+    ap.add_argument("-n", "--tiles", type=int, default=128)
+    ap.add_argument("-t", "--tile_size", type=int, default=1024)
+    ap.add_argument("-b", "--batch_size", type=int, default=32)
+    ap.add_argument("-s", "--image_size", type=int, default=299, help="size tiles are downscaled to")
+    args = ap.parse_args()
+
+    root, store_root = write_tiles(tempfile.mkdtemp(), args.tiles, args.tile_size)
+    index = build_index(root, "lymph")
+    store_index = build_index(store_root, "lymph")
+    print(f"{len(index)} PNG tiles of {args.tile_size}px, {os.cpu_count()} CPUs")
+
+    def run(index, **kwargs):
+        return images_per_second(iter(tile_dataset(index, **kwargs)))
+
+    cached = tile_dataset(index, args.batch_size, args.image_size, cache="")
+    images_per_second(iter(cached))
+    for name, rate in [
+        ("PIL loop, batch 1", images_per_second(pil_loop(index["path"], args.tile_size))),
+        ("tf.data, batch 1, 1 worker", run(index, batch_size=1, image_size=args.tile_size, parallel=1)),
+        (f"tf.data, batch 1, autotune", run(index, batch_size=1, image_size=args.tile_size)),
+        (f"batch {args.batch_size}, {args.image_size}px", run(index, batch_size=args.batch_size,
+                                                              image_size=args.image_size)),
+        (f"batch {args.batch_size}, {args.image_size}px, cached", images_per_second(iter(cached))),
+        (f"tile store, batch {args.batch_size}, {args.image_size}px", run(store_index, batch_size=args.batch_size,
+                                                                           image_size=args.image_size)),
+    ]:
+        print(f"{name:>36}: {rate:8.1f} images/s")
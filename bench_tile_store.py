@@ -0,0 +1,62 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image
+
+from synthetic_slide import write_synthetic_slide
+from tile_store import TileStore, TileStoreWriter
+from tiler import FolderWriter, open_deepzoom, tile_slide
+
+# one PNG per tile vs tile_store.py's HDF5 shards (lzf, gzip, uncompressed): files and bytes written, tiling wall time,
+# and the time to read random tiles back. Every store must give back the same pixels as the PNGs.
+
+
+def directory_size(directory):
+    names = os.listdir(directory)
+    return len(names), sum(os.path.getsize(os.path.join(directory, name)) for name in names)
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark writing tiles to PNG files vs HDF5 tile stores.")
+    ap.add_argument("-W", "--width", type=int, default=16384)
+    ap.add_argument("-H", "--height", type=int, default=12288)
+    ap.add_argument("-t", "--tile_size", type=int, default=512)
+    ap.add_argument("-T", "--threshold", type=int, default=10, help="tissue percentage above which tiles are kept")
+    ap.add_argument("-w", "--workers", type=int, default=None)
+    ap.add_argument("-r", "--reads", type=int, default=200, help="random tiles to read back")
+    ap.add_argument("-s", "--slide", help="existing slide to use instead of a synthetic one", default=None)
+    args = ap.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    slide_path = args.slide or write_synthetic_slide(os.path.join(work_dir, "synthetic.tiff"), args.width, args.height)
+    level = open_deepzoom(slide_path, args.tile_size).level_count - 1
+
+    png_dir = os.path.join(work_dir, "png")
+    os.makedirs(png_dir)
+    stats = tile_slide(slide_path, args.tile_size, level, args.threshold, FolderWriter(png_dir), workers=args.workers)
+    files, size = directory_size(png_dir)
+    names = random.Random(0).choices(sorted(os.listdir(png_dir)), k=args.reads)
+    start = time.perf_counter()
+    expected = {name: np.asarray(Image.open(os.path.join(png_dir, name))) for name in names}
+    read_time = time.perf_counter() - start
+    print(f"{stats['kept']} tiles of {args.tile_size}px kept")
+    print(f"{'png files':>16}: {files:6d} files, {size / 2 ** 20:8.1f} MB, tiled in {stats['wall']:5.1f}s, "
+          f"{1000 * read_time / args.reads:6.2f} ms per random read")
+
+    for compression in ["lzf", "gzip", None]:
+        store_dir = os.path.join(work_dir, f"hdf5_{compression}")
+        stats = tile_slide(slide_path, args.tile_size, level, args.threshold, TileStoreWriter(store_dir, compression),
+                           workers=args.workers)
+        files, size = directory_size(store_dir)
+        with TileStore(store_dir) as store:
+            start = time.perf_counter()
+            tiles = {name: store.tile(int(name[len("tile"):-len(".png")])) for name in names}
+            read_time = time.perf_counter() - start
+            assert len(store) == stats["kept"]
+            assert all(np.array_equal(tiles[name], expected[name]) for name in names)
+        print(f"{'hdf5 ' + str(compression):>16}: {files:6d} files, {size / 2 ** 20:8.1f} MB, tiled in "
+              f"{stats['wall']:5.1f}s, {1000 * read_time / args.reads:6.2f} ms per random read")
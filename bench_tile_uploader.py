@@ -0,0 +1,57 @@
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+from tile_uploader import FakeUploader, RcloneUploader, TileSpool, format_upload_stats
+
+# tiles/sec uploaded one uploader call per tile (what RcloneWriter did, one `rclone copyto` per tile) vs batched
+# through a TileSpool. The default backend is FakeUploader, with --latency standing in for rclone's start-up and remote
+# handshake on each call and --per_file for the transfer of each tile; --rclone copies with a real rclone to a local
+# directory instead. --fail_rate makes that fraction of calls fail, to exercise retries.
+
+
+def upload(uploader, destination, tiles, batch_size, retries=3):
+    spool = TileSpool(tempfile.mkdtemp(), destination, uploader, batch_size=batch_size, retries=retries,
+                      backoff=0.01)
+    start = time.perf_counter()
+    for name, data in tiles:
+        spool.add(name, data)
+    spool.close()
+    assert spool.uploaded() == {name for name, _ in tiles}
+    return time.perf_counter() - start, spool.stats
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark per-tile vs batched tile uploads.")
+    ap.add_argument("-n", "--tiles", type=int, default=2000)
+    ap.add_argument("-p", "--per_tile", type=int, default=40, help="tiles to time per-tile uploads on")
+    ap.add_argument("-k", "--tile_kb", type=int, default=64)
+    ap.add_argument("-l", "--latency", type=float, default=0.25, help="seconds of overhead per uploader call")
+    ap.add_argument("-f", "--per_file", type=float, default=0.005, help="seconds to transfer each tile")
+    ap.add_argument("-t", "--transfers", type=int, default=16)
+    ap.add_argument("--fail_rate", type=float, default=0.3)
+    ap.add_argument("--rclone", action="store_true", help="upload with rclone to a local directory")
+    args = ap.parse_args()
+
+    tiles = [(f"file_{n}.png", os.urandom(args.tile_kb * 1024)) for n in range(args.tiles)]
+
+    def uploader(fail_rate=0.0):
+        # (uploader, destination); rclone is given a plain local path as its destination
+        if args.rclone:
+            return RcloneUploader(args.transfers), tempfile.mkdtemp()
+        return FakeUploader(tempfile.mkdtemp(), args.latency, args.per_file, args.transfers, fail_rate), "remote:tiles"
+
+    if args.rclone and shutil.which("rclone") is None:
+        raise SystemExit("rclone is not installed")
+    print(f"{args.tiles} tiles of {args.tile_kb} KB" +
+          ("" if args.rclone else f", {args.latency}s per call, {args.per_file}s per tile, {args.transfers} transfers"))
+    for name, tile_count, batch_size, fail_rate in [("per tile", args.per_tile, 1, 0.0),
+                                                    ("batches of 64", args.tiles, 64, 0.0),
+                                                    ("batches of 256", args.tiles, 256, 0.0),
+                                                    ("batches of 1024", args.tiles, 1024, 0.0),
+                                                    (f"batches of 256, {args.fail_rate:.0%} fail", args.tiles, 256,
+                                                     args.fail_rate)]:
+        seconds, stats = upload(*uploader(fail_rate), tiles[:tile_count], batch_size)
+        print(f"{name:>26}: {tile_count / seconds:8.1f} tiles/s  ({format_upload_stats(stats)})")
@@ -0,0 +1,67 @@
+import argparse
+import os
+import tempfile
+import time
+from concurrent import futures
+
+import openslide
+from openslide import deepzoom
+
+from image_processing import calculate_tissue_percentage
+from synthetic_slide import write_synthetic_slide
+from tiler import open_deepzoom
+
+# tiles/sec reading and classifying every tile of the top DeepZoom level of a synthetic pyramidal TIFF, opening the
+# slide for every tile (what classify_tile2/classify_tile_rclone used to do) vs reusing one handle per worker thread
+# (tiler.open_deepzoom). Tiles are not saved, so this measures only what the handle reuse affects.
+
+
+def classify_fresh(job):
+    slide_path, x, y, tile_size, level = job
+    slide = deepzoom.DeepZoomGenerator(openslide.OpenSlide(slide_path), tile_size=tile_size, overlap=0)
+    return calculate_tissue_percentage(slide.get_tile(level, (x, y)))
+
+
+def classify_reused(job):
+    slide_path, x, y, tile_size, level = job
+    slide = open_deepzoom(slide_path, tile_size)
+    return calculate_tissue_percentage(slide.get_tile(level, (x, y)))
+
+
+def tiles_per_second(classify, jobs, workers, repeat):
+    best = 0
+    for _ in range(repeat):
+        start = time.perf_counter()
+        if workers == 1:
+            results = [classify(job) for job in jobs]
+        else:
+            with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                results = list(executor.map(classify, jobs))
+        best = max(best, len(jobs) / (time.perf_counter() - start))
+    return best, results
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark reusing slide handles across tiles.")
+    ap.add_argument("-W", "--width", type=int, default=16384)
+    ap.add_argument("-H", "--height", type=int, default=12288)
+    ap.add_argument("-t", "--tile_size", type=int, default=1024)
+    ap.add_argument("-w", "--workers", type=int, nargs="+", default=[1, 8])
+    ap.add_argument("-r", "--repeat", type=int, default=3, help="report the best of this many runs")
+    ap.add_argument("-s", "--slide", help="existing slide to use instead of a synthetic one", default=None)
+    args = ap.parse_args()
+
+    slide_path = args.slide or write_synthetic_slide(os.path.join(tempfile.mkdtemp(), "synthetic.tiff"),
+                                                     args.width, args.height)
+    generator = deepzoom.DeepZoomGenerator(openslide.OpenSlide(slide_path), tile_size=args.tile_size, overlap=0)
+    level = generator.level_count - 1
+    columns, rows = generator.level_tiles[level]
+    jobs = [(slide_path, x, y, args.tile_size, level) for x in range(columns) for y in range(rows)]
+    print(f"{len(jobs)} tiles of {args.tile_size}px at DeepZoom level {level}")
+
+    for workers in args.workers:
+        before, expected = tiles_per_second(classify_fresh, jobs, workers, args.repeat)
+        after, results = tiles_per_second(classify_reused, jobs, workers, args.repeat)
+        assert results == expected
+        print(f"{workers} worker(s): {before:7.1f} tiles/s opening per tile, {after:7.1f} tiles/s reusing handles "
+              f"({after / before:.1f}x)")
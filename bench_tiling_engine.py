@@ -0,0 +1,55 @@
+import argparse
+import hashlib
+import os
+import tempfile
+
+import openslide
+from openslide import deepzoom
+
+from synthetic_slide import write_synthetic_slide
+from tiler import FolderWriter, format_stats, tile_slide
+
+# scaling of tiler.tile_slide with the number of worker processes: tiles/sec, speedup over one worker and where the
+# worker time goes (read, classify, encode, write), tiling the top DeepZoom level of a synthetic slide. Every run
+# must write the same tiles.
+
+
+def folder_digest(folder):
+    digest = hashlib.sha256()
+    for name in sorted(os.listdir(folder)):
+        digest.update(name.encode())
+        with open(os.path.join(folder, name), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark the process-pool tiling engine.")
+    ap.add_argument("-W", "--width", type=int, default=16384)
+    ap.add_argument("-H", "--height", type=int, default=12288)
+    ap.add_argument("-t", "--tile_size", type=int, default=512)
+    ap.add_argument("-T", "--threshold", type=int, default=50, help="tissue percentage above which tiles are kept")
+    ap.add_argument("-w", "--workers", type=int, nargs="+", default=[1, 2, 4, 8, 16, 32])
+    ap.add_argument("-b", "--band_rows", type=int, default=None, help="rows of tiles per task (default: automatic)")
+    ap.add_argument("-s", "--slide", help="existing slide to use instead of a synthetic one", default=None)
+    args = ap.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    slide_path = args.slide or write_synthetic_slide(os.path.join(work_dir, "synthetic.tiff"), args.width, args.height)
+    generator = deepzoom.DeepZoomGenerator(openslide.OpenSlide(slide_path), tile_size=args.tile_size, overlap=0)
+    level = generator.level_count - 1
+    columns, rows = generator.level_tiles[level]
+    print(f"{columns}x{rows} tiles of {args.tile_size}px at DeepZoom level {level}, {os.cpu_count()} CPUs")
+
+    baseline = digest = None
+    for workers in args.workers:
+        output = os.path.join(work_dir, f"tiles_{workers}")
+        os.makedirs(output)
+        stats = tile_slide(slide_path, args.tile_size, level, args.threshold, FolderWriter(output),
+                           workers=workers, band_rows=args.band_rows)
+        if digest is None:
+            digest = folder_digest(output)
+        assert folder_digest(output) == digest, f"{workers} workers wrote different tiles"
+        rate = stats["tiles"] / stats["wall"]
+        baseline = baseline or rate
+        print(f"{workers:3d} worker(s), {stats['bands']} bands: {rate / baseline:5.2f}x  {format_stats(stats)}")
@@ -0,0 +1,98 @@
+import argparse
+import time
+
+import numpy as np
+from PIL import Image
+
+from image_processing import keep_tiles, pen_fractions, tiles_to_array, tissue_fractions
+from synthetic_slide import synthetic_image
+
+# tissue percentage of N tiles: the per-pixel getpixel loop parallelise.py used to carry (timed on a few tiles and
+# scaled up), the one-tile-at-a-time numpy version image_processing used to have, and one batched call. Also times
+# the optional criteria of keep_tiles (saturation, pen marks, blur), and checks the pen criterion on an H&E-like tile
+# (dense hematoxylin nuclei must not count as pen) with and without a stroke of blue and green marker.
+
+HEMATOXYLIN = (0.650, 0.704, 0.286)  # optical density per unit stain in R, G, B (Ruifrok & Johnston)
+EOSIN = (0.072, 0.990, 0.105)
+PEN_INKS = [(30, 60, 150), (40, 50, 130), (40, 120, 80), (30, 110, 130)]  # blue, navy, green and teal marker
+
+
+def getpixel_percentage(img, threshold):
+    img = img.copy().convert("L")
+    tissue_pixels = 0
+    for x in range(img.width):
+        for y in range(img.height):
+            if img.getpixel((x, y)) < threshold:
+                tissue_pixels += 1
+    return tissue_pixels / (img.width * img.height) * 100
+
+
+def per_tile_percentage(img, threshold):
+    img = np.array(img.convert("L"))
+    return np.count_nonzero(img < threshold) / img.size * 100
+
+
+def he_tile(size, seed=0):
+    # eosin-stained stroma with round nuclei of up to three units of hematoxylin, mixed by optical density
+    rng = np.random.default_rng(seed)
+    ys, xs = np.mgrid[0:size, 0:size]
+    hematoxylin = np.full((size, size), 0.1)
+    for _ in range(size // 4):
+        cy, cx, r = rng.uniform(0, size), rng.uniform(0, size), rng.uniform(4, 10)
+        hematoxylin[(ys - cy) ** 2 + (xs - cx) ** 2 < r * r] = rng.uniform(1, 3)
+    eosin = rng.uniform(0.1, 0.6, size=(size, size))
+    density = hematoxylin[..., None] * HEMATOXYLIN + eosin[..., None] * EOSIN
+    return np.clip(255 * np.exp(-density), 0, 255).astype(np.uint8)
+
+
+def pen_marked(tile, width=8):
+    tile = tile.copy()
+    for i, ink in enumerate(PEN_INKS):
+        tile[:, (2 * i + 1) * width:(2 * i + 2) * width] = ink
+    return tile
+
+
+def timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark batched tissue classification.")
+    ap.add_argument("-n", "--tiles", type=int, default=64)
+    ap.add_argument("-t", "--tile_size", type=int, default=512)
+    ap.add_argument("-g", "--getpixel_tiles", type=int, default=2, help="tiles to time the getpixel loop on")
+    args = ap.parse_args()
+
+    side = int(np.ceil(np.sqrt(args.tiles)))
+    image = synthetic_image(side * args.tile_size, side * args.tile_size, blobs=side * 2)
+    tiles = [Image.fromarray(image[y:y + args.tile_size, x:x + args.tile_size])
+             for y in range(0, side * args.tile_size, args.tile_size)
+             for x in range(0, side * args.tile_size, args.tile_size)][:args.tiles]
+
+    getpixel_time, slow = timed(lambda: [getpixel_percentage(tile, 210) for tile in tiles[:args.getpixel_tiles]])
+    per_tile_time, expected = timed(lambda: [per_tile_percentage(tile, 210) for tile in tiles])
+    batch_time, batch = timed(lambda: tissue_fractions(tiles_to_array(tiles, "L")) * 100)
+    assert np.allclose(batch, expected) and np.allclose(slow, expected[:args.getpixel_tiles])
+
+    getpixel_time *= len(tiles) / args.getpixel_tiles
+    print(f"{len(tiles)} tiles of {args.tile_size}px")
+    rgb = tiles_to_array(tiles)
+    stacked_time, stacked = timed(lambda: tissue_fractions(rgb) * 100)
+    assert np.allclose(stacked, expected)
+    for name, seconds in [("getpixel loop (scaled)", getpixel_time), ("per tile", per_tile_time),
+                          ("batched", batch_time), ("batched, RGB stack given", stacked_time)]:
+        print(f"{name:>24}: {1000 * seconds / len(tiles):8.2f} ms/tile")
+    for filters in [{}, {"saturation": True}, {"pen": True}, {"blur": True},
+                    {"saturation": True, "pen": True, "blur": True}]:
+        seconds, (keep, _) = timed(lambda: keep_tiles(rgb, 50, **filters))
+        print(f"{'keep_tiles ' + ','.join(filters):>24}: {1000 * seconds / len(tiles):8.2f} ms/tile, "
+              f"{keep.sum()} kept")
+
+    he = he_tile(args.tile_size)
+    marked = pen_marked(he)
+    stroke = (marked != he).any(axis=-1).mean() * 100
+    he_pen, marked_pen = pen_fractions(np.stack([he, marked])) * 100
+    assert he_pen < 1 and marked_pen >= stroke
+    print(f"pen on an H&E-like tile: {he_pen:.2f}%, with {stroke:.2f}% marker on it: {marked_pen:.2f}%")
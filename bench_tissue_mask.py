@@ -0,0 +1,40 @@
+import argparse
+import os
+import tempfile
+
+import openslide
+from openslide import deepzoom
+
+from synthetic_slide import write_synthetic_slide
+from tiler import FolderWriter, format_stats, tile_slide, tissue_tiles
+
+# how many get_tile calls the low resolution tissue mask saves on a slide, what that does to the wall time, and
+# whether it loses any tile the full resolution check would have kept (it should not)
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="Benchmark skipping background tiles with a low resolution tissue mask.")
+    ap.add_argument("-W", "--width", type=int, default=16384)
+    ap.add_argument("-H", "--height", type=int, default=12288)
+    ap.add_argument("-t", "--tile_size", type=int, default=512)
+    ap.add_argument("-T", "--threshold", type=int, default=50, help="tissue percentage above which tiles are kept")
+    ap.add_argument("-w", "--workers", type=int, default=1)
+    ap.add_argument("-s", "--slide", help="existing slide to use instead of a synthetic one", default=None)
+    args = ap.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    slide_path = args.slide or write_synthetic_slide(os.path.join(work_dir, "synthetic.tiff"), args.width, args.height)
+    level = deepzoom.DeepZoomGenerator(openslide.OpenSlide(slide_path), tile_size=args.tile_size).level_count - 1
+
+    for mask_threshold in [210, "otsu"]:
+        candidates = tissue_tiles(slide_path, args.tile_size, level, args.threshold, mask_threshold)
+        print(f"mask threshold {mask_threshold}: {candidates.sum()}/{candidates.size} tiles to read")
+
+    kept = {}
+    for skip_background in [False, True]:
+        output = os.path.join(work_dir, f"tiles_{skip_background}")
+        os.makedirs(output)
+        stats = tile_slide(slide_path, args.tile_size, level, args.threshold, FolderWriter(output),
+                           workers=args.workers, skip_background=skip_background)
+        kept[skip_background] = set(os.listdir(output))
+        print(f"{'with' if skip_background else 'without'} mask: {format_stats(stats)}")
+    print(f"tiles lost to the mask: {len(kept[False] - kept[True])}")
@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+
+# cohort statistics and the labels every stage agrees on: the biopsy tissue type (Skin/Lymph, from the site of
+# resection or biopsy) and the survival label (early: survived at most EARLY_SURVIVAL_YEARS, late: longer).
+# Everything works on whole columns of the cohort table (cohort_table.read_patients, or cohort_frame for the
+# patients and slides tables side by side); tissue_type and survival_label are the one-value versions.
+
+EARLY_SURVIVAL_YEARS = 3
+TISSUE_KEYWORDS = [("lymph", "Lymph"), ("skin", "Skin")]  # first match wins
+NO_TISSUE_TYPE = "N/A"
+TILED_TISSUE_TYPES = ["Skin", "Lymph"]
+
+
+def tissue_type(site):
+    site = (site or "").lower()
+    for keyword, label in TISSUE_KEYWORDS:
+        if keyword in site:
+            return label
+    return NO_TISSUE_TYPE
+
+
+def survival_label(years_survived):
+    return "early" if years_survived <= EARLY_SURVIVAL_YEARS else "late"
+
+
+def tissue_types(sites):
+    sites = sites.astype(object).fillna("").str.lower()
+    conditions = [sites.str.contains(keyword, regex=False) for keyword, _ in TISSUE_KEYWORDS]
+    labels = np.select(conditions, [label for _, label in TISSUE_KEYWORDS], NO_TISSUE_TYPE)
+    return pd.Series(labels, index=sites.index, dtype="category")
+
+
+def survival_labels(years_survived):
+    labels = np.where(years_survived <= EARLY_SURVIVAL_YEARS, "early", "late")
+    return pd.Series(labels, index=years_survived.index).where(years_survived.notna()).astype("category")
+
+
+def label_cohort(df):
+    """df with biopsy_tissue_type (re)derived from site_of_resection_or_biopsy, when present, and survival_label."""
+    labels = {}
+    if "site_of_resection_or_biopsy" in df:
+        labels["biopsy_tissue_type"] = tissue_types(df["site_of_resection_or_biopsy"])
+    if "years_survived" in df:
+        labels["survival_label"] = survival_labels(df["years_survived"])
+    return df.assign(**labels)
+
+
+def cohort_frame(patients, slides):
+    """The patients and slides tables side by side; their rows line up, as both come from the same records."""
+    if len(patients) != len(slides):
+        raise ValueError("patients and slides tables are not from the same records")
+    extra = [column for column in slides.columns if column not in patients.columns]
+    return pd.concat([patients.reset_index(drop=True), slides[extra].reset_index(drop=True)], axis=1)
+
+
+def _iqr(values):
+    values = values.dropna()
+    if values.empty:
+        return np.nan
+    q3, q1 = np.percentile(values, [75, 25])
+    return q3 - q1
+
+
+def cohort_summary(df):
+    """Headline numbers for the cohort. Alive/dead counts are per patient, ages and times are per record."""
+    patients = df.drop_duplicates("patient_id")
+    vital_status = patients["vital_status"].dropna()
+    summary = {
+        "records": len(df),
+        "patients": len(patients),
+        "alive": int((vital_status == "Alive").sum()),
+        "dead": int((vital_status != "Alive").sum()),
+        "median_age": df["age_at_diagnosis"].median(),
+        "iqr_age": _iqr(df["age_at_diagnosis"]),
+        "median_years_to_death": df["years_to_death"].median() if "years_to_death" in df else np.nan,
+    }
+    if "file_size" in df:
+        summary["total_file_size"] = int(df["file_size"].fillna(0).sum())
+    return summary
+
+
+def grouped_summary(df, by):
+    """Per group of `by`: records, patients, alive/dead patients, median and IQR age, median years survived and the
+    number of records labelled early and late. A patient with records in several groups counts once in each."""
+    df = label_cohort(df) if "survival_label" not in df else df
+    keys = [by] if isinstance(by, str) else list(by)
+    patients = df.drop_duplicates(keys + ["patient_id"])
+    patient_keys, record_keys = [patients[key] for key in keys], [df[key] for key in keys]
+    groups = df.groupby(by, observed=True, dropna=False)
+    summary = pd.DataFrame({
+        "records": groups.size(),
+        "patients": groups["patient_id"].nunique(),
+        "alive": (patients["vital_status"] == "Alive").groupby(patient_keys, observed=True, dropna=False).sum(),
+        "dead": (patients["vital_status"] == "Dead").groupby(patient_keys, observed=True, dropna=False).sum(),
+        "median_age": groups["age_at_diagnosis"].median(),
+        "iqr_age": groups["age_at_diagnosis"].agg(_iqr),
+        "median_years_survived": groups["years_survived"].median(),
+        "early": (df["survival_label"] == "early").groupby(record_keys, observed=True, dropna=False).sum(),
+        "late": (df["survival_label"] == "late").groupby(record_keys, observed=True, dropna=False).sum(),
+    })
+    return summary.fillna({"alive": 0, "dead": 0}).astype({"alive": int, "dead": int})
+
+
+def label_dirs(df, split):
+    """The directory each record's tiles go to for the given split ('train' or 'validation'), e.g.
+    'lymph_train_dir/early/'; None for records that are not Skin/Lymph or have no survival time."""
+    df = label_cohort(df)
+    tissue = df["biopsy_tissue_type"].astype(object)
+    dirs = tissue.str.lower() + f"_{split}_dir/" + df["survival_label"].astype(object) + "/"
+    return dirs.where(tissue.isin(TILED_TISSUE_TYPES))
+
+
+def label_dir(tissue_type, years_survived, split):
+    if tissue_type not in TILED_TISSUE_TYPES:
+        return None
+    return f"{tissue_type.lower()}_{split}_dir/{survival_label(years_survived)}/"
@@ -0,0 +1,117 @@
+import os
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from flatten_cases import PATIENT_COLUMNS, SLIDE_COLUMNS
+
+# columnar copy of reconstructedData.json: one patients table with a row per record (the per-patient fields plus
+# the slide_id/file_id of its slide) and one slides table with the nested "slides" block, keyed by file_id.
+# Column order follows the flatten_cases tables. Readers can ask for just the columns they need:
+#
+#   write_cohort(records, "cohort")
+#   df = read_patients("cohort", columns=["file_id", "years_survived", "biopsy_tissue_type"])
+
+PATIENTS = "patients"
+SLIDES = "slides"
+
+CATEGORY = pa.dictionary(pa.int32(), pa.string())
+
+COLUMN_TYPES = {
+    "patient_id": pa.string(),
+    "vital_status": CATEGORY,
+    "years_to_death": pa.float64(),
+    "years_to_last_follow_up": pa.float64(),
+    "age_at_diagnosis": pa.float64(),
+    "year_of_diagnosis": pa.int32(),
+    "tumor_stage": CATEGORY,
+    "tissue_or_organ_of_origin": CATEGORY,
+    "site_of_resection_or_biopsy": CATEGORY,
+    "biopsy_tissue_type": CATEGORY,
+    "prior_malignancy": CATEGORY,
+    "primary_diagnosis": CATEGORY,
+    "years_survived": pa.float64(),
+
+    "slide_id": pa.string(),
+    "file_id": pa.string(),
+    "file_size": pa.int64(),
+    "md5sum": pa.string(),
+    "case_id": pa.string(),
+    "percent_stromal_cells": pa.float64(),
+    "section_location": CATEGORY,
+    "percent_tumor_cells": pa.float64(),
+    "percent_neutrophil_infiltration": pa.float64(),
+    "percent_lymphocyte_infiltration": pa.float64(),
+    "percent_necrosis": pa.float64(),
+    "percent_normal_cells": pa.float64(),
+    "percent_monocyte_infiltration": pa.float64(),
+    "percent_tumor_nuclei": pa.float64(),
+    "submitter_id": pa.string(),
+    "SampleCode": CATEGORY,
+    "sample_type": CATEGORY,
+}
+
+# the patients table carries the keys of its slide so the two tables can be joined
+PATIENT_SCHEMA = pa.schema([(column[0], COLUMN_TYPES[column[0]]) for column in PATIENT_COLUMNS] +
+                           [("slide_id", pa.string()), ("file_id", pa.string())])
+SLIDE_SCHEMA = pa.schema([(column[0], COLUMN_TYPES[column[0]]) for column in SLIDE_COLUMNS])
+
+
+def records_to_tables(records):
+    """(patients, slides) Arrow tables for a list of reconstructedData.json records."""
+    patients = {name: [] for name in PATIENT_SCHEMA.names}
+    slides = {name: [] for name in SLIDE_SCHEMA.names}
+    for record in records:
+        slide = record.get("slides", {})
+        for name, values in patients.items():
+            values.append(record.get(name) if name in record else slide.get(name))
+        for name, values in slides.items():
+            values.append(slide.get(name))
+    return pa.Table.from_pydict(patients, schema=PATIENT_SCHEMA), pa.Table.from_pydict(slides, schema=SLIDE_SCHEMA)
+
+
+def _path(directory, name, format):
+    return os.path.join(directory, f"{name}.{format}")
+
+
+def write_tables(patients, slides, directory, format="parquet"):
+    """Write the patients and slides tables to directory as Parquet (compressed) or Feather (uncompressed, so
+    reads are memory mapped without a decode step)."""
+    os.makedirs(directory, exist_ok=True)
+    for name, table in ((PATIENTS, patients), (SLIDES, slides)):
+        for stale in ("parquet", "feather"):
+            if stale != format and os.path.exists(_path(directory, name, stale)):
+                os.remove(_path(directory, name, stale))
+        if format == "parquet":
+            pq.write_table(table, _path(directory, name, format), compression="zstd")
+        elif format == "feather":
+            feather.write_feather(table, _path(directory, name, format), compression="uncompressed")
+        else:
+            raise ValueError(f"unknown cohort table format {format}")
+
+
+def write_cohort(records, directory, format="parquet"):
+    patients, slides = records_to_tables(records)
+    write_tables(patients, slides, directory, format)
+
+
+def read_table(directory, name, columns=None):
+    """An Arrow table, memory mapped; prefers Feather over Parquet when both are present."""
+    path = _path(directory, name, "feather")
+    if os.path.exists(path):
+        return feather.read_table(path, columns=columns, memory_map=True)
+    return pq.read_table(_path(directory, name, "parquet"), columns=columns, memory_map=True)
+
+
+# integer columns with missing values stay integers rather than turning into floats
+PANDAS_TYPES = {pa.int32(): pd.Int32Dtype(), pa.int64(): pd.Int64Dtype()}
+
+
+def read_patients(directory, columns=None):
+    return read_table(directory, PATIENTS, columns).to_pandas(types_mapper=PANDAS_TYPES.get)
+
+
+def read_slides(directory, columns=None):
+    return read_table(directory, SLIDES, columns).to_pandas(types_mapper=PANDAS_TYPES.get)
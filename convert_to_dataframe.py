@@ -1,73 +1,44 @@
 import pandas as pd
-import json
-import copy
+import os
+from cohort_table import PANDAS_TYPES, read_patients, read_slides, records_to_tables
+from metadata_store import MetadataStore
 
 json_data_path: str = "./reconstructedData.json"
+table_dir: str = "./cohort"  # written by query.py next to reconstructedData.json
 
-with open(json_data_path, 'r') as f:
-    json_data = json.load(f)
 
-# with open("test3.json", 'r') as f:
-#     slide_data = json.load(f)
+def load_tables():
+    # the columnar tables if query.py wrote them, otherwise built from the JSON
+    if os.path.isdir(table_dir):
+        return read_patients(table_dir), read_slides(table_dir)
 
-def clean_slide_data(data: dict):
-    hits = copy.deepcopy(data["data"])
-    result = list()
-    for hit in hits:
-        # add useful field for when reading data visually
-        sample_code = hit["slides"]["SampleCode"] if "slides" in hit and "SampleCode" in hit["slides"] else None
-        if sample_code == None:
-            hit["slides"]["sample_type"] = "No sample_type"
-        if sample_code == "01":
-            hit["slides"]["sample_type"] = "Primary Solid Tumor"
-        elif sample_code == "06":
-            hit["slides"]["sample_type"] = "Metastatic"
-        elif sample_code == "07":
-            hit["slides"]["sample_type"] = "Additional Metastatic"
-        elif sample_code == "11":
-            hit["slides"]["sample_type"] = "Solid Tissue Normal"
+    patients, slides = records_to_tables(MetadataStore(json_data_path).records())
+    return patients.to_pandas(types_mapper=PANDAS_TYPES.get), slides.to_pandas(types_mapper=PANDAS_TYPES.get)
 
-        result.append(hit["slides"])
-    return result
 
+def clean_slide_data(slides: pd.DataFrame):
+    # add useful field for when reading data visually
+    sample_type = slides["sample_type"].astype(object)
+    sample_type[slides["SampleCode"].isna()] = "No sample_type"
+    return slides.assign(sample_type=sample_type)
 
-# works on reconstructedData.json
-def clean_data(data: dict):
-    hits = copy.deepcopy(data["data"])
-    result = list()
-    for hit in hits:
-        # make data more readable
-        # hit.update(hit["slides"])
 
-        # # add useful field for when reading data visually
-        # sample_code = hit["slides"]["SampleCode"]
-        # if sample_code == "01":
-        #     hit["sample_type"] = "Primary Solid Tumor"
-        # elif sample_code == "06":
-        #     hit["sample_type"] = "Metastatic"
+# works on the patients table
+def clean_data(patients: pd.DataFrame):
+    # remove unnecessary data
+    return patients.drop(columns=["slide_id", "file_id"])
 
-        # remove unnecessary data
-        hit.pop("slides")
 
-        # print(hit)
-        result.append(hit)
-    return result
+if __name__ == "__main__":
+    patients, slides = load_tables()
 
+    # reconstructed Data dataframe
+    dataframe: pd.DataFrame = clean_data(patients)
+    print(dataframe)
+    print("saving main dataframe to csv")
+    dataframe.to_csv(path_or_buf="readable_data.csv")
 
-def to_dataframe(data: dict):
-    dataframe = pd.DataFrame(data)
-    return dataframe
-
-
-# reconstructed Data dataframe
-cleaned_data = clean_data(json_data)
-dataframe: pd.DataFrame = to_dataframe(cleaned_data)
-print(dataframe)
-print("saving main dataframe to csv")
-dataframe.to_csv(path_or_buf="readable_data.csv")
-
-# slides dataframe
-slide_cleaned_data = clean_slide_data(json_data)
-slide_dataframe = to_dataframe(slide_cleaned_data)
-print("saving slide dataframe to csv")
-slide_dataframe.to_csv("slide_data.csv")
\ No newline at end of file
+    # slides dataframe
+    slide_dataframe = clean_slide_data(slides)
+    print("saving slide dataframe to csv")
+    slide_dataframe.to_csv("slide_data.csv")
@@ -1,68 +1,38 @@
-import requests
-import json
 import subprocess
 import os
 from tqdm import tqdm
 import concurrent.futures
-import tempfile
+from slide_downloader import SlideDownloader, slide_files
+from metadata_store import MetadataStore
 
 path_to_slides_data = "reconstructedData.json"
 endpoint = "https://api.gdc.cancer.gov/data/"
+# resumes partial downloads left in ./_tmp and checks each slide's md5sum, see slide_downloader.py. Slides are deleted
+# once uploaded, so the ones in ./_tmp/manifest.jsonl are skipped whether or not they are still on disk
+downloader = SlideDownloader("./_tmp", endpoint, skip_if_recorded=True)
 
 
-def fetch_slides(slides_path):
-    output_list = []
-    with open(slides_path, 'r') as infile:
-        slides_data = json.load(infile)
+def download_slide(file_id, size=None, md5=None):
+    return downloader.download(file_id, size, md5)
 
-    patients = slides_data["data"]  # all slides
-    for patient in patients:
-        patient_id = patient["patient_id"]
-        data = patient["slides"]
-        if "slide_id" not in data:
-            print("slide ID for " + patient_id + " is missing")
-            continue
-        if "case_id" not in data:
-            print("case ID for " + patient_id + " is missing")
-            continue
-        if "file_id" not in data:
-            print("file ID for " + patient_id + " is missing")
-            continue
-        output_list.append((data["case_id"], data["slide_id"], data["file_id"]))
-    return output_list
 
+def download_and_upload(file_id, size=None, md5=None):
+    slide_path = download_slide(file_id, size, md5)
+    if not os.path.exists(slide_path):
+        return  # uploaded and deleted by an earlier run
 
-def download_slide(file_id):
-    if not os.path.exists("./_tmp"):
-        os.makedirs("./_tmp")
-    temporary_file = tempfile.NamedTemporaryFile(dir="./_tmp")
-
-    r = requests.get(endpoint + file_id, stream=True)
-    total_length = r.headers.get('content-length')
-
-    if total_length is None:  # no content length header
-        temporary_file.write(r.content)
-    else:
-        chunk_size = 1024 * 1024
-        for content_chunk in r.iter_content(chunk_size=chunk_size):
-            temporary_file.write(content_chunk)
-
-    return temporary_file
-
-
-def download_and_upload(file_id):
-    slide_file = download_slide(file_id)
-
-    subprocess.run(["rclone", "copyto", slide_file.name, f"GCDData:/Data/{file_id}.svs", "-q", "--transfers=1"])
-    slide_file.close()
+    # a failed upload raises before the slide is deleted, so the next run uploads it again
+    subprocess.run(["rclone", "copyto", slide_path, f"GCDData:/Data/{file_id}.svs", "-q", "--transfers=1"],
+                   check=True)
+    os.remove(slide_path)
 
 
 if __name__ == "__main__":
-    # list of tuples. each tuple contains case_id, slide_id, and file_id
-    slides = fetch_slides(path_to_slides_data)
+    # list of tuples. each tuple contains file_id, file_size and md5sum
+    slides = slide_files(MetadataStore(path_to_slides_data))
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
-        future_to_slide = {executor.submit(download_and_upload, slide_meta[2]): slide_meta for slide_meta in slides}
+        future_to_slide = {executor.submit(download_and_upload, *slide_meta): slide_meta for slide_meta in slides}
         pbar = tqdm(total=len(future_to_slide))
         for future in concurrent.futures.as_completed(future_to_slide):
             pbar.update(1)
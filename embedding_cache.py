@@ -0,0 +1,147 @@
+import os
+import time
+
+import h5py
+import numpy as np
+import tensorflow as tf
+
+from tile_dataset import dataset_order, tile_dataset
+
+# the frozen backbone's output for every tile, computed once and kept in an HDF5 file, so the trainable head can be
+# trained for any number of epochs without pushing a single tile through the backbone again. Each tile's embedding is
+# the backbone's globally average pooled feature map (2048 floats for InceptionV3), stored as float16 and keyed by a
+# tile ID (the tile's path relative to the tile root, plus #<row> for a row of an HDF5 tile store). Updating the cache
+# with a tile index only runs the backbone on tiles it does not have yet.
+#
+#   backbone = inception_backbone(299)
+#   with EmbeddingCache("lymph_embeddings.h5", backbone, 299) as cache:
+#       cache.update(index, root_dir)               # new tiles only
+#       features, labels = cache.features(index, root_dir)
+#   head = head_model(features.shape[1]); head.fit(features, labels, ...)
+
+EMBEDDING_DTYPE = np.float16
+BATCH_SIZE = 32
+FLUSH_ROWS = 1024  # embeddings buffered before they are appended to the file
+
+
+def tile_ids(index, root_dir):
+    """The ID of each row of a tile index (see tile_dataset.build_index)."""
+    paths = [os.path.relpath(path, root_dir) for path in index["path"]]
+    return np.array([path if row < 0 else f"{path}#{row}" for path, row in zip(paths, index["row"])], dtype=object)
+
+
+def inception_backbone(image_size, weights="imagenet"):
+    """InceptionV3 without its top, average pooled to one vector per image, frozen."""
+    backbone = tf.keras.applications.InceptionV3(input_shape=(image_size, image_size, 3), include_top=False,
+                                                 weights=weights, pooling="avg")
+    backbone.trainable = False
+    return backbone
+
+
+def head_model(embedding_size, hidden=64, dropout=0.2):
+    """The trainable part of traindata.py's model, taking a pooled embedding rather than the backbone's feature map."""
+    inputs = tf.keras.Input(shape=(embedding_size,))
+    x = tf.keras.layers.Dense(hidden, activation="relu")(inputs)
+    x = tf.keras.layers.Dropout(dropout)(x)
+    outputs = tf.keras.layers.Dense(1, activation="sigmoid")(x)
+    return tf.keras.Model(inputs, outputs)
+
+
+def full_model(backbone, head):
+    """backbone and a head trained from the cache as one model that takes images, e.g. to save for inference."""
+    return tf.keras.Model(backbone.input, head(backbone.output))
+
+
+class EmbeddingCache:
+    def __init__(self, path, backbone, image_size, preprocess=None):
+        self.path = path
+        self.backbone = backbone
+        self.image_size = image_size
+        self.preprocess = preprocess
+        self.file = h5py.File(path, "a")
+        settings = {"backbone": backbone.name, "image_size": image_size,
+                    "preprocess": getattr(preprocess, "__name__", "none")}
+        for key, value in settings.items():
+            if key in self.file.attrs and self.file.attrs[key] != value:
+                raise ValueError(f"{path} holds embeddings for {key}={self.file.attrs[key]!r}, not {value!r}")
+            self.file.attrs[key] = value
+        ids = self.file["ids"].asstr()[:] if "ids" in self.file else []
+        self.rows = {tile_id: row for row, tile_id in enumerate(ids)}
+        self.stats = {"computed": 0, "cached": 0, "seconds": 0.0}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __contains__(self, tile_id):
+        return tile_id in self.rows
+
+    def _append(self, ids, embeddings):
+        if "embeddings" not in self.file:
+            size = embeddings.shape[1]
+            self.file.create_dataset("embeddings", shape=(0, size), maxshape=(None, size), dtype=EMBEDDING_DTYPE,
+                                     chunks=(min(FLUSH_ROWS, 256), size))
+            self.file.create_dataset("ids", shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=(1024,))
+        start = len(self.rows)
+        for dataset in (self.file["embeddings"], self.file["ids"]):
+            dataset.resize(start + len(ids), axis=0)
+        self.file["embeddings"][start:] = embeddings.astype(EMBEDDING_DTYPE)
+        self.file["ids"][start:] = list(ids)
+        self.rows.update((tile_id, start + n) for n, tile_id in enumerate(ids))
+        self.file.flush()
+
+    def update(self, index, root_dir, batch_size=BATCH_SIZE, progress=None):
+        """Run the backbone on the tiles of index that are not in the cache yet and store their embeddings.
+        Returns the number of tiles embedded."""
+        ids = tile_ids(index, root_dir)
+        new = np.array([tile_id not in self.rows for tile_id in ids], dtype=bool)
+        self.stats["cached"] += int((~new).sum())
+        if not new.any():
+            return 0
+        # the dataset yields image files before tile store rows, so the IDs are put in that order to match
+        index = dataset_order(index[new])
+        ids = tile_ids(index, root_dir)
+        dataset = tile_dataset(index, batch_size=batch_size, image_size=self.image_size, shuffle=False,
+                               preprocess=self.preprocess)
+        start = time.perf_counter()
+        done, pending = 0, []
+        for images, _ in dataset:
+            pending.append(np.asarray(self.backbone.predict_on_batch(images)))
+            if sum(len(batch) for batch in pending) >= FLUSH_ROWS:
+                embeddings = np.concatenate(pending)
+                self._append(ids[done:done + len(embeddings)], embeddings)
+                done, pending = done + len(embeddings), []
+            if progress is not None:
+                progress(len(images))
+        if pending:
+            embeddings = np.concatenate(pending)
+            self._append(ids[done:done + len(embeddings)], embeddings)
+            done += len(embeddings)
+        self.stats["computed"] += done
+        self.stats["seconds"] += time.perf_counter() - start
+        return done
+
+    def embeddings(self, tile_ids):
+        """float32 array of the embeddings of tile_ids, all of which must be in the cache."""
+        rows = np.array([self.rows[tile_id] for tile_id in tile_ids], dtype=np.int64)
+        order = np.argsort(rows)
+        embeddings = np.empty((len(rows), self.file["embeddings"].shape[1]), dtype=np.float32)
+        if len(rows):
+            # h5py wants increasing, unique rows; read those and put them back in the order asked for
+            unique, inverse = np.unique(rows[order], return_inverse=True)
+            embeddings[order] = self.file["embeddings"][unique][inverse]
+        return embeddings
+
+    def features(self, index, root_dir, update=True):
+        """(embeddings, labels) for the rows of a tile index, embedding any tiles not yet cached first."""
+        if update:
+            self.update(index, root_dir)
+        return self.embeddings(tile_ids(index, root_dir)), index["label"].to_numpy()
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,136 @@
+# flattens the case hits returned by query.py (with hit['slides'] filled in) into the per-sample records of
+# reconstructedData.json. What ends up in each record is described by the tables below rather than by code: each
+# column is (target, source, key, transform, skip_none), read as
+#
+#   record[target] = transform(source[key])
+#
+# where source is one of the objects available for the sample being flattened:
+#   'hit'        the case hit
+#   'diagnosis'  hit['diagnoses'][0]
+#   'demographic' hit['demographic']
+#   'sample'     the slide record of the sample, sample['portions'][0]['slides'][0]
+#   'file'       the first SVS file hit found for that slide
+#   'record'     the record built so far, for columns derived from earlier ones (key None passes the whole record)
+#
+# A column is left out when its source or key is missing, or when skip_none is set and the value is None.
+# Columns are filled in table order, which is also the key order of the output JSON.
+
+from cohort_stats import tissue_type
+
+DAYS_PER_YEAR = 365
+
+SAMPLE_TYPES = {
+    "01": "Primary Solid Tumor",
+    "06": "Metastatic",
+    "07": "Additional Metastatic",
+    "11": "Solid Tissue Normal",
+}
+
+
+def days_to_years(days):
+    return days / DAYS_PER_YEAR if days is not None else None
+
+
+def vital_status(status):
+    return "Alive" if status == "Alive" else "Dead"
+
+
+def years_survived(record):
+    return max(record.get("years_to_death", 0), record.get("years_to_last_follow_up", 0))
+
+
+def sample_code(submitter_id):
+    codes = (submitter_id or "").split("-")
+    if codes[0] == "TCGA" and len(codes) > 3:
+        return codes[3][0:2]
+    return None
+
+
+PATIENT_COLUMNS = [
+    ("patient_id", "hit", "id", None, False),
+    ("vital_status", "demographic", "vital_status", vital_status, False),
+    ("years_to_death", "demographic", "days_to_death", days_to_years, True),
+    ("years_to_last_follow_up", "diagnosis", "days_to_last_follow_up", days_to_years, True),
+    ("age_at_diagnosis", "diagnosis", "age_at_diagnosis", days_to_years, True),
+    ("year_of_diagnosis", "diagnosis", "year_of_diagnosis", None, False),
+    ("tumor_stage", "diagnosis", "tumor_stage", None, False),
+    ("tissue_or_organ_of_origin", "diagnosis", "tissue_or_organ_of_origin", None, False),
+    ("site_of_resection_or_biopsy", "diagnosis", "site_of_resection_or_biopsy", None, False),
+    ("biopsy_tissue_type", "record", "site_of_resection_or_biopsy", tissue_type, False),
+    ("prior_malignancy", "diagnosis", "prior_malignancy", None, False),
+    ("primary_diagnosis", "diagnosis", "primary_diagnosis", None, False),
+    ("years_survived", "record", None, years_survived, False),
+]
+
+SLIDE_COLUMNS = [
+    ("slide_id", "sample", "slide_id", None, False),
+    ("file_id", "file", "file_id", None, False),
+    ("file_size", "file", "file_size", None, False),
+    ("md5sum", "file", "md5sum", None, False),
+    ("case_id", "hit", "case_id", None, False),
+    ("percent_stromal_cells", "sample", "percent_stromal_cells", None, False),
+    ("section_location", "sample", "section_location", None, False),
+    ("percent_tumor_cells", "sample", "percent_tumor_cells", None, False),
+    ("percent_neutrophil_infiltration", "sample", "percent_neutrophil_infiltration", None, False),
+    ("percent_lymphocyte_infiltration", "sample", "percent_lymphocyte_infiltration", None, False),
+    ("percent_necrosis", "sample", "percent_necrosis", None, False),
+    ("percent_normal_cells", "sample", "percent_normal_cells", None, False),
+    ("percent_monocyte_infiltration", "sample", "percent_monocyte_infiltration", None, False),
+    ("percent_tumor_nuclei", "sample", "percent_tumor_nuclei", None, False),
+    ("submitter_id", "sample", "submitter_id", None, False),
+    ("SampleCode", "record", "submitter_id", sample_code, True),
+    ("sample_type", "record", "SampleCode", SAMPLE_TYPES.get, True),
+]
+
+
+def compile_columns(columns):
+    """Turn a column table into a function, called with each source the table uses as a keyword argument, that
+    returns the record."""
+    def extract(**sources):
+        record = sources["record"] = {}
+        for target, source, key, transform, skip_none in columns:
+            value = sources[source]
+            if value is None:
+                continue
+            if key is not None:
+                if key not in value:
+                    continue
+                value = value[key]
+            if transform is not None:
+                value = transform(value)
+            if skip_none and value is None:
+                continue
+            record[target] = value
+        return record
+
+    return extract
+
+
+extract_patient = compile_columns(PATIENT_COLUMNS)
+extract_slide = compile_columns(SLIDE_COLUMNS)
+
+
+def flatten_hit(hit):
+    """The records of one case hit, one per sample."""
+    demographic = hit.get("demographic")
+    diagnoses = hit.get("diagnoses")
+    diagnosis = diagnoses[0] if diagnoses else None
+    slide_files = hit.get("slides")
+    records = []
+    for data in hit.get("samples", []):
+        sample = data["portions"][0]["slides"][0]
+        files = slide_files.get(sample["slide_id"]) if slide_files is not None else None
+        patient = extract_patient(hit=hit, demographic=demographic, diagnosis=diagnosis)
+        patient["slides"] = extract_slide(hit=hit, sample=sample, file=files[0] if files else None)
+        records.append(patient)
+    return records
+
+
+def flatten_hits(hits):
+    """Returns (records, slide_ids): the contents of reconstructedData.json's "data" and case_ids.json's "case_ids"."""
+    records = []
+    slide_ids = []
+    for hit in hits:
+        slide_ids += hit.get("slide_ids", [])
+        records += flatten_hit(hit)
+    return records, slide_ids
@@ -0,0 +1,274 @@
+import asyncio
+import contextlib
+import random
+import threading
+import time
+from concurrent import futures
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import EmptyPoolError
+
+from response_cache import OfflineCacheMiss, cache_key
+
+# one HTTP client for everything that talks to the GDC API. It keeps a pool of keep-alive connections per host,
+# caps the number of requests in flight, spaces requests out per host, and retries 429/5xx responses with
+# exponential backoff. All scripts share default_client() so they get the same pool and limits.
+#
+# Streamed requests (stream=True, e.g. slide downloads from /data) have a pool and rate limit of their own: a streamed
+# response keeps its connection until its body is read or it is closed, so they are bounded by stream_concurrency
+# connections per host, held for as long as that, and do not take slots or rate from API requests.
+#
+#   client = default_client()
+#   cases = client.get_json(CASES_ENDPOINT, params=params)
+#   pages = client.map(lambda page: client.get_json(url, params=page), page_params)
+#
+# Given a response_cache.ResponseCache, get_json/post_json answer from the cache when they can, and with
+# offline=True they never touch the network and raise OfflineCacheMiss instead.
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+STREAM_POOL_TIMEOUT = 600  # seconds a streamed request waits for one of its host's connections to be given back
+
+
+class RateLimiter:
+    """Token bucket: at most `rate` requests per second on average, with bursts of up to `burst`; no limit if rate is
+    0 or None."""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate or 0)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class _StreamAdapter(HTTPAdapter):
+    """An HTTPAdapter whose pools block for a free connection (pool_block), for at most pool_timeout seconds, so a
+    connection that is never given back cannot hang every later request."""
+
+    def __init__(self, pool_timeout=STREAM_POOL_TIMEOUT, **kwargs):
+        self.pool_timeout = pool_timeout  # before HTTPAdapter.__init__, which makes the pool manager
+        super().__init__(pool_block=True, **kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        pool_timeout = self.pool_timeout
+
+        def timed(pool_class):
+            class TimedPool(pool_class):
+                def _get_conn(self, timeout=None):
+                    return super()._get_conn(pool_timeout if timeout is None else timeout)
+
+            return TimedPool
+
+        classes = self.poolmanager.pool_classes_by_scheme
+        self.poolmanager.pool_classes_by_scheme = {scheme: timed(cls) for scheme, cls in classes.items()}
+
+
+class GDCClient:
+    def __init__(self, max_concurrency=8, retries=5, backoff=0.5, max_backoff=30.0, rate=20.0, burst=None,
+                 timeout=60, cache=None, offline=False, stream_concurrency=16, stream_rate=None,
+                 stream_pool_timeout=STREAM_POOL_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.stream_concurrency = stream_concurrency
+        self.stream_rate = stream_rate
+        self.stream_pool_timeout = stream_pool_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.rate = rate
+        self.burst = burst
+        self.timeout = timeout
+        self.cache = cache
+        self.offline = offline
+        self.stats = {"requests": 0, "retries": 0}
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max_concurrency, max_retries=0)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        # a streamed request waits (up to stream_pool_timeout) for one of the host's connections to be given back
+        self.stream_session = requests.Session()
+        adapter = _StreamAdapter(stream_pool_timeout, pool_connections=4, pool_maxsize=stream_concurrency,
+                                 max_retries=0)
+        self.stream_session.mount("http://", adapter)
+        self.stream_session.mount("https://", adapter)
+
+        self._slots = threading.BoundedSemaphore(max_concurrency)
+        self._limiters = {}
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def limiter(self, url, stream=False):
+        key = urlparse(url).netloc, stream
+        with self._lock:
+            if key not in self._limiters:
+                self._limiters[key] = RateLimiter(self.stream_rate if stream else self.rate, self.burst)
+            return self._limiters[key]
+
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
+
+    def _delay(self, attempt, response):
+        retry_after = response.headers.get("Retry-After") if response is not None else None
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), self.max_backoff)
+        # full jitter, so that workers backing off together do not retry in lock step
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        stream = kwargs.get("stream", False)
+        limiter = self.limiter(url, stream)
+        session = self.stream_session if stream else self.session
+        # a streamed response is bounded by its session's blocking pool instead, until its body is consumed
+        slots = contextlib.nullcontext() if stream else self._slots
+        attempt = 0
+        while True:
+            limiter.acquire()
+            self._count("requests")
+            response = None
+            try:
+                with slots:
+                    response = session.request(method, url, **kwargs)
+                if response.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                    try:
+                        response.raise_for_status()
+                    except requests.HTTPError:
+                        response.close()  # gives a streamed response's connection back to the pool
+                        raise
+                    return response
+            except EmptyPoolError as e:
+                raise requests.ConnectionError(f"no free connection for {url} after {self.stream_pool_timeout}s") from e
+            except (requests.ConnectionError, requests.Timeout):
+                if attempt >= self.retries:
+                    raise
+            if response is not None:
+                response.close()
+            self._count("retries")
+            time.sleep(self._delay(attempt, response))
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def _cached(self, url, params, fetch):
+        if self.cache is not None:
+            response = self.cache.get(url, params, allow_stale=self.offline)
+            if response is not None:
+                return response
+        if self.offline:
+            raise OfflineCacheMiss(f"no cached response for {url} ({cache_key(url, params)})")
+        response = fetch()
+        if self.cache is not None:
+            self.cache.put(url, params, response)
+        return response
+
+    def get_json(self, url, params=None):
+        return self._cached(url, params, lambda: self.get(url, params=params).json())
+
+    def post_json(self, url, body):
+        return self._cached(url, body, lambda: self.post(url, json=body).json())
+
+    def _pool(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = futures.ThreadPoolExecutor(max_workers=self.max_concurrency)
+            return self._executor
+
+    def map(self, fn, items):
+        """fn(item) for every item on a pool of max_concurrency threads, results in the order of items."""
+        return list(self._pool().map(fn, items))
+
+    def imap_unordered(self, fn, items):
+        """Like map, but yields results as they complete, keeping at most 2 * max_concurrency calls queued."""
+        executor = self._pool()
+        pending = set()
+        for item in items:
+            pending.add(executor.submit(fn, item))
+            if len(pending) >= 2 * self.max_concurrency:
+                done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        for future in futures.as_completed(pending):
+            yield future.result()
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        self.session.close()
+        self.stream_session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncGDCClient:
+    """asyncio front end to a GDCClient, for code that wants to await many requests at once.
+
+    Requests run on the wrapped client's connection pool in worker threads; a semaphore bounds how many are in
+    flight, so `await asyncio.gather(*[client.get_json(url, p) for p in pages])` is safe for any number of pages.
+    """
+
+    def __init__(self, client=None, max_concurrency=None):
+        self.client = client if client is not None else default_client()
+        self.max_concurrency = max_concurrency or self.client.max_concurrency
+        self._executor = futures.ThreadPoolExecutor(max_workers=self.max_concurrency)
+        self._slots = None
+
+    async def _run(self, fn, *args):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.max_concurrency)
+        async with self._slots:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    async def get_json(self, url, params=None):
+        return await self._run(self.client.get_json, url, params)
+
+    async def post_json(self, url, body):
+        return await self._run(self.client.post_json, url, body)
+
+    def close(self):
+        self._executor.shutdown()
+
+
+_default_client = None
+_default_lock = threading.Lock()
+
+
+def default_client():
+    global _default_client
+    with _default_lock:
+        if _default_client is None:
+            _default_client = GDCClient()
+        return _default_client
+
+
+def set_default_client(client):
+    """Replace the shared client, e.g. to change its limits for a run. Returns the previous one."""
+    global _default_client
+    with _default_lock:
+        previous, _default_client = _default_client, client
+        return previous
@@ -1,8 +1,11 @@
-import requests
 import json
 
-for endpt in [ 'cases', 'files', 'annotations']:
-    response = requests.get('https://api.gdc.cancer.gov/%s/_mapping' % endpt)
-    with open ('%s_mapping.json' % endpt, 'w') as f:
-        print(json.dumps(json.loads(response.content.decode('utf8')), indent=2), file=f)
+from gdc_client import default_client
+
+client = default_client()
+endpoints = ['cases', 'files', 'annotations']
+mappings = client.map(lambda endpt: client.get_json('https://api.gdc.cancer.gov/%s/_mapping' % endpt), endpoints)
 
+for endpt, mapping in zip(endpoints, mappings):
+    with open ('%s_mapping.json' % endpt, 'w') as f:
+        print(json.dumps(mapping, indent=2), file=f)
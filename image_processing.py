@@ -14,12 +14,130 @@ import numpy as np
 # 				img.putpixel((x, y), 0)
 # 	return img
 
+TISSUE_GRAY_THRESHOLD = 210  # greyscale values below this are tissue
+
+
+# BATCHED TISSUE CLASSIFICATION. Tiles are stacked into one (N, height, width, 3) uint8 array, or (N, height, width)
+# for greyscale tiles, and every criterion is computed for the whole batch at once; each returns one value per tile.
+SATURATION_THRESHOLD = 7  # percent; stained tissue is at least this saturated, background and shadows are greyer
+PEN_SATURATION = 50  # percent; pen ink is strongly coloured ...
+PEN_MAX_HUE = 235  # ... green to blue (hue 60 to this many degrees; hematoxylin sits at 240 to 250) ...
+PEN_MAX_VALUE = 15  # ... or nearly black (percent)
+MAX_PEN_PERCENTAGE = 5
+MIN_SHARPNESS = 25  # variance of the Laplacian below which a tile is out of focus
+
+
+def tiles_to_array(tiles, mode="RGB"):
+	return np.stack([np.asarray(tile.convert(mode)) for tile in tiles])
+
+
+# same weights and rounding as PIL's convert("L"), which does the work: the batch is converted as one tall image
+def grayscale(batch):
+	if batch.ndim == 3:
+		return batch
+	n, height, width, _ = batch.shape
+	tall = Image.fromarray(np.ascontiguousarray(batch).reshape(n * height, width, 3))
+	return np.asarray(tall.convert("L")).reshape(n, height, width)
+
+
+def _fractions(mask):
+	return np.count_nonzero(mask.reshape(len(mask), -1), axis=1) / mask[0].size
+
+
+def tissue_fractions(batch, threshold=TISSUE_GRAY_THRESHOLD):
+	return _fractions(grayscale(batch) < threshold)
+
+
+# HSV saturation and value in (int16) integer arithmetic: saturation >= s percent is (max - min) * 100 >= s * max
+def _channels(batch):
+	r, g, b = (batch[..., channel].astype(np.int16) for channel in range(3))
+	return r, g, b, np.maximum(np.maximum(r, g), b), np.minimum(np.minimum(r, g), b)
+
+
+def saturated_fractions(batch, threshold=SATURATION_THRESHOLD):
+	_, _, _, maximum, minimum = _channels(batch)
+	return _fractions((maximum - minimum) * 100 >= threshold * maximum)
+
+
+def pen_fractions(batch):
+	r, g, b, maximum, minimum = _channels(batch)
+	saturated = (maximum - minimum) * 100 >= PEN_SATURATION * maximum
+	# hue from 60 (yellow-green) to 180 is where green is the largest channel; from 180 to PEN_MAX_HUE blue is the
+	# largest and hue = 240 + 60 * (r - g) / (max - min)
+	green = g == maximum
+	blue = (b == maximum) & (60 * (r - g) <= (PEN_MAX_HUE - 240) * (maximum - minimum))
+	dark = maximum * 100 < PEN_MAX_VALUE * 255
+	return _fractions((saturated & (green | blue) & (maximum > minimum)) | dark)
+
+
+def sharpness(batch):
+	gray = grayscale(batch).astype(np.int16)
+	laplacian = (gray[:, :-2, 1:-1] + gray[:, 2:, 1:-1] + gray[:, 1:-1, :-2] + gray[:, 1:-1, 2:]
+				 - 4 * gray[:, 1:-1, 1:-1])
+	return laplacian.reshape(len(laplacian), -1).astype(np.float32).var(axis=1)
+
+
+# which tiles of a batch to keep: more than tissue_threshold_percentage tissue, and optionally enough stained
+# (saturated) tissue, little pen ink and in focus. The optional criteria are only computed for tiles still in the
+# running, and saturation and pen need RGB tiles. Returns the keep flags and every tile's tissue percentage
+def keep_tiles(batch, tissue_threshold_percentage, saturation=False, pen=False, blur=False):
+	tissue = tissue_fractions(batch) * 100
+	keep = tissue > tissue_threshold_percentage
+	for enabled, passes in [
+			(saturation, lambda tiles: saturated_fractions(tiles) * 100 > tissue_threshold_percentage),
+			(pen, lambda tiles: pen_fractions(tiles) * 100 <= MAX_PEN_PERCENTAGE),
+			(blur, lambda tiles: sharpness(tiles) >= MIN_SHARPNESS)]:
+		if enabled and keep.any():
+			keep[keep] = passes(batch[keep])
+	return keep, tissue
+
+
 # threshold (optional) for pixels number of pixels that should be tissue
 def calculate_tissue_percentage(img):
-	img = np.array(img.convert("L"))
-	tissue_pixels = np.count_nonzero(img < 210)
-	total_pixels = img.size
-	return (tissue_pixels / total_pixels) * 100
+	return tissue_fractions(tiles_to_array([img], "L"))[0] * 100
+
+
+# OTSU THRESHOLD OF A GREYSCALE IMAGE: THE GREY LEVEL THAT BEST SEPARATES TISSUE FROM BACKGROUND
+def otsu_threshold(gray):
+	histogram = np.bincount(np.asarray(gray, dtype=np.uint8).ravel(), minlength=256).astype(np.float64)
+	levels = np.arange(256)
+	weight_below = np.cumsum(histogram)
+	weight_above = weight_below[-1] - weight_below
+	sum_below = np.cumsum(histogram * levels)
+	with np.errstate(divide="ignore", invalid="ignore"):
+		mean_below = sum_below / weight_below
+		mean_above = (sum_below[-1] - sum_below) / weight_above
+		between_class_variance = weight_below * weight_above * (mean_below - mean_above) ** 2
+	# pixels <= the best split are one class, so the mask threshold (tissue is below it) is one more than that
+	return int(np.nanargmax(between_class_variance)) + 1
+
+
+# TISSUE MASK OF A (LOW RESOLUTION) IMAGE, threshold is a grey level or "otsu"
+def tissue_mask(img, threshold=TISSUE_GRAY_THRESHOLD):
+	gray = np.array(img.convert("L"))
+	if threshold == "otsu":
+		threshold = otsu_threshold(gray)
+	return gray < threshold
+
+
+# FRACTION OF MASK PIXELS IN EVERY CELL OF A GRID, GIVEN THE CELL EDGES IN MASK PIXELS (columns + 1 and rows + 1 of
+# them); cells take in any mask pixel they partly cover. Returns a (rows, columns) array
+def grid_coverage(mask, x_edges, y_edges):
+	height, width = mask.shape
+	integral = np.zeros((height + 1, width + 1), dtype=np.int64)
+	integral[1:, 1:] = mask.cumsum(axis=0).cumsum(axis=1)
+
+	def cells(edges, size):
+		starts = np.clip(np.floor(edges[:-1]).astype(int), 0, size - 1)
+		ends = np.clip(np.maximum(np.ceil(edges[1:]).astype(int), starts + 1), 1, size)
+		return starts, ends
+
+	x0, x1 = cells(np.asarray(x_edges, dtype=np.float64), width)
+	y0, y1 = cells(np.asarray(y_edges, dtype=np.float64), height)
+	y0, y1 = y0[:, None], y1[:, None]
+	counts = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+	return counts / ((y1 - y0) * (x1 - x0))
+
 
 # READ IN SVS, READ A REGION OF IT AND SAVE IT. ONLY NEEDS TO BE DONE ONCE, THEN COMMENT IT OUT
 # slide = openslide.OpenSlide("./slides/9817ec15-605a-40db-b848-2199e5ccbb7b/71208712-2893-4404-9cef-ff090774d057/71208712-2893-4404-9cef-ff090774d057.svs")
@@ -0,0 +1,369 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse
+
+import h5py
+import numpy as np
+import tensorflow as tf
+
+from slide_inference import TOP_K, mean_pool, top_k_pool
+from tile_store import SHARD_SUFFIX, TileStoreWriter
+from tiler import tile_slide
+
+# a local inference service for the model traindata.py saves. The model is loaded once; each request names a slide
+# (an SVS file, which is tiled first, or a tile store directory or shard of one) and its tiles are downscaled and
+# queued. One batcher thread takes tiles from every request in flight, so concurrent requests share batches of up to
+# batch_size (part-full ones when the queue runs dry after max_wait), and each request gets back its tile scores and its
+# pooled slide scores. /metrics reports latency percentiles, throughput and how full the batches were.
+#
+#   python inference_server.py GPUModelLymph_1_64.keras -P 8010
+#   curl -d '{"path": "_tmp/<file_id>", "tiles": false}' localhost:8010/score
+#   curl localhost:8010/metrics
+#
+#   python inference_server.py GPUModelLymph_1_64.keras --score slide.svs    # one slide, without a server
+
+BATCH_SIZE = 32
+MAX_WAIT = 0.01  # seconds the batcher waits for more tiles before running a part-full batch
+CHUNK = 256  # tiles read, downscaled and queued at a time per request
+IN_FLIGHT = 4  # chunks a request has queued at once; the next is read once the oldest is scored
+TILE_SIZE = 1024  # SVS files are tiled as process_slice_upload.py tiles them
+LEVEL = 14
+TISSUE_THRESHOLD = 50
+LATENCY_WINDOW = 1000  # requests the latency percentiles are over
+REQUEST_OPTIONS = {"tiles", "k", "tile_size", "level", "tissue_threshold"}  # besides path, in a /score request
+
+
+class Metrics:
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.counts = {"requests": 0, "errors": 0, "tiles": 0, "batches": 0}
+        self.predict_seconds = 0.0
+
+    def batch(self, tiles, seconds):
+        with self.lock:
+            self.counts["batches"] += 1
+            self.counts["tiles"] += tiles
+            self.predict_seconds += seconds
+
+    def request(self, seconds, error=False):
+        with self.lock:
+            self.counts["requests"] += 1
+            self.counts["errors"] += int(error)
+            if not error:
+                self.latencies.append(seconds)
+
+    def snapshot(self):
+        with self.lock:
+            uptime = time.perf_counter() - self.start
+            latencies = np.array(self.latencies)
+            counts = dict(self.counts)
+            predict_seconds = self.predict_seconds
+        percentiles = np.percentile(latencies, [50, 95, 99]) if len(latencies) else [np.nan] * 3
+        return {
+            **counts,
+            "uptime": uptime,
+            "tiles_per_second": counts["tiles"] / uptime if uptime else 0.0,
+            "latency_p50": float(percentiles[0]),
+            "latency_p95": float(percentiles[1]),
+            "latency_p99": float(percentiles[2]),
+            "batch_fill": counts["tiles"] / (counts["batches"] * self.batch_size) if counts["batches"] else 0.0,
+            "predict_seconds": predict_seconds,
+        }
+
+
+class _Pending:
+    """The tiles of one submit call and the scores filled in as batches finish."""
+
+    def __init__(self, tiles):
+        self.tiles = tiles
+        self.scores = np.empty(len(tiles), dtype=np.float32)
+        self.remaining = len(tiles)
+        self.future = Future()
+
+
+class MicroBatcher:
+    """Runs predict (a function of a uint8 batch of images) on batches of up to batch_size tiles gathered from every
+    submit call in flight. submit returns a Future of the scores of its tiles."""
+
+    def __init__(self, predict, batch_size=BATCH_SIZE, max_wait=MAX_WAIT, metrics=None):
+        self.predict = predict
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.metrics = metrics
+        self.queue = deque()  # (pending, start, stop) slices of submitted tiles
+        self.condition = threading.Condition()
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, tiles):
+        pending = _Pending(tiles)
+        if not len(tiles):
+            pending.future.set_result(pending.scores)
+            return pending.future
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("the batcher is closed")
+            self.queue.append((pending, 0, len(tiles)))
+            self.condition.notify()
+        return pending.future
+
+    def _take(self):
+        """Slices of queued tiles adding up to at most batch_size, waiting up to max_wait for a full batch."""
+        with self.condition:
+            while not self.queue and not self.closed:
+                self.condition.wait()
+            deadline = time.perf_counter() + self.max_wait
+            while sum(stop - start for _, start, stop in self.queue) < self.batch_size and not self.closed:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                self.condition.wait(timeout)
+            taken, room = [], self.batch_size
+            while self.queue and room:
+                pending, start, stop = self.queue.popleft()
+                if stop - start > room:
+                    self.queue.appendleft((pending, start + room, stop))
+                    stop = start + room
+                taken.append((pending, start, stop))
+                room -= stop - start
+            return taken
+
+    def _run(self):
+        while True:
+            taken = self._take()
+            if not taken:
+                return
+            tiles = np.concatenate([pending.tiles[start:stop] for pending, start, stop in taken])
+            count = len(tiles)
+            # padded to a power of two (at most batch_size), so the model is only traced for a few batch shapes
+            size = min(self.batch_size, 1 << (count - 1).bit_length())
+            if count < size:
+                tiles = np.concatenate([tiles, np.zeros((size - count,) + tiles.shape[1:], tiles.dtype)])
+            start_time = time.perf_counter()
+            try:
+                scores = np.asarray(self.predict(tiles), dtype=np.float32).reshape(-1)[:count]
+            except Exception as e:
+                for pending, _, _ in taken:
+                    if not pending.future.done():
+                        pending.future.set_exception(e)
+                continue
+            if self.metrics is not None:
+                self.metrics.batch(count, time.perf_counter() - start_time)
+            offset = 0
+            for pending, start, stop in taken:
+                pending.scores[start:stop] = scores[offset:offset + stop - start]
+                offset += stop - start
+                pending.remaining -= stop - start
+                if pending.remaining == 0 and not pending.future.done():
+                    pending.future.set_result(pending.scores)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+
+def _shard_chunks(path, chunk):
+    with h5py.File(path, "r") as shard:
+        if "index" not in shard:
+            return
+        index = shard["index"][:]
+        for start in range(0, len(index), chunk):
+            yield index[start:start + chunk], shard["tiles"][start:start + chunk]
+
+
+def store_chunks(path, chunk=CHUNK):
+    """(index rows, tiles) of a tile store directory or a single shard, chunk tiles at a time."""
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith(SHARD_SUFFIX):
+                yield from _shard_chunks(os.path.join(path, name), chunk)
+    else:
+        yield from _shard_chunks(path, chunk)
+
+
+def slide_chunks(path, chunk=CHUNK, tile_size=TILE_SIZE, level=LEVEL, tissue_threshold=TISSUE_THRESHOLD,
+                 workers=None):
+    """(index rows, tiles) of a slide: a tile store directory or shard as it is, or an SVS file tiled into a
+    temporary tile store first."""
+    if os.path.isdir(path) or path.endswith(SHARD_SUFFIX):
+        yield from store_chunks(path, chunk)
+        return
+    directory = tempfile.mkdtemp(prefix="inference_")
+    try:
+        tile_slide(path, tile_size, level, tissue_threshold, TileStoreWriter(directory), workers=workers, native=True)
+        yield from store_chunks(directory, chunk)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+class InferenceService:
+    """The model and a MicroBatcher in front of it; score is safe to call from many threads."""
+
+    def __init__(self, model, image_size=None, batch_size=BATCH_SIZE, max_wait=MAX_WAIT):
+        self.model = model
+        self.image_size = image_size or model.input_shape[1]
+        self.metrics = Metrics(batch_size)
+        self.batcher = MicroBatcher(self._predict, batch_size, max_wait, self.metrics)
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        return cls(tf.keras.models.load_model(path), **kwargs)
+
+    def _predict(self, tiles):
+        return self.model.predict_on_batch(tf.cast(tiles, tf.float32))
+
+    def prepare(self, tiles):
+        """Tiles downscaled (area averaging, as tile_dataset.py does for training) to the model's input size."""
+        if tiles.shape[1:3] == (self.image_size, self.image_size):
+            return tiles
+        resized = tf.image.resize(tiles, [self.image_size, self.image_size], method="area")
+        return tf.cast(tf.clip_by_value(tf.round(resized), 0, 255), tf.uint8).numpy()
+
+    def score(self, path, tiles=True, k=TOP_K, **slide_options):
+        """Scores of every tile of a slide (see slide_chunks) and its mean and top-k pooled scores."""
+        start = time.perf_counter()
+        try:
+            pending, scores, indexes = deque(), [], []
+            for index, chunk in slide_chunks(path, **slide_options):
+                if len(pending) >= IN_FLIGHT:
+                    scores.append(pending.popleft().result())
+                indexes.append(index)
+                pending.append(self.batcher.submit(self.prepare(chunk)))
+            scores = np.concatenate(scores + [future.result() for future in pending]) if indexes else np.zeros(0)
+        except Exception:
+            self.metrics.request(time.perf_counter() - start, error=True)
+            raise
+        seconds = time.perf_counter() - start
+        self.metrics.request(seconds)
+        result = {"path": path, "count": len(scores), "seconds": seconds,
+                  "slide": {"mean": mean_pool(scores), "topk": top_k_pool(scores, k)} if len(scores) else None}
+        if tiles:
+            index = np.concatenate(indexes) if indexes else None
+            result["tiles"] = [{"tile_number": int(row["tile_number"]), "x": int(row["x"]), "y": int(row["y"]),
+                                "score": float(score)} for row, score in zip(index, scores)] if len(scores) else []
+        return result
+
+    def close(self):
+        self.batcher.close()
+
+
+def _handler(service):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        disable_nagle_algorithm = True
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode("utf8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path == "/metrics":
+                self._send_json(200, service.metrics.snapshot())
+            elif path == "/health":
+                self._send_json(200, {"status": "ok"})
+            else:
+                self._send_json(404, {"message": "not found"})
+
+        def do_POST(self):
+            if urlparse(self.path).path != "/score":
+                self._send_json(404, {"message": "not found"})
+                return
+            length = int(self.headers.get("Content-Length", 0))
+            try:
+                request = json.loads(self.rfile.read(length).decode("utf8")) if length else {}
+            except ValueError:
+                request = None
+            if not isinstance(request, dict) or not isinstance(request.get("path"), str):
+                self._send_json(400, {"message": "expected a JSON object with a path"})
+                return
+            path = request.pop("path")
+            unknown = set(request) - REQUEST_OPTIONS
+            if unknown:
+                self._send_json(400, {"message": f"unknown options {sorted(unknown)}"})
+                return
+            if not os.path.exists(path):
+                self._send_json(404, {"message": f"no such slide or tile store: {path}"})
+                return
+            try:
+                self._send_json(200, service.score(path, **request))
+            except Exception as e:
+                self._send_json(500, {"message": f"{type(e).__name__}: {e}"})
+
+    return Handler
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class serve:
+    """Run an InferenceService on a local port for the duration of a with block; yields the base url (ending in
+    '/')."""
+
+    def __init__(self, service, host="127.0.0.1", port=0):
+        self.server = _Server((host, port), _handler(service))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Serve (or run once) tile and slide scoring with a trained model.")
+    ap.add_argument("model", help="model saved by traindata.py")
+    ap.add_argument("-H", "--host", default="127.0.0.1")
+    ap.add_argument("-P", "--port", type=int, default=8010)
+    ap.add_argument("-b", "--batch_size", type=int, default=BATCH_SIZE)
+    ap.add_argument("-w", "--max_wait", type=float, default=MAX_WAIT, help="seconds to wait to fill a batch")
+    ap.add_argument("--score", nargs="+", metavar="PATH", help="score these slides and exit instead of serving")
+    args = ap.parse_args()
+
+    service = InferenceService.load(args.model, batch_size=args.batch_size, max_wait=args.max_wait)
+    if args.score:
+        for path in args.score:
+            result = service.score(path, tiles=False)
+            if result["slide"] is None:
+                print(f"{path}: no tissue tiles, {result['seconds']:.1f}s")
+                continue
+            print(f"{path}: {result['count']} tiles, mean {result['slide']['mean']:.3f}, "
+                  f"top-k {result['slide']['topk']:.3f}, {result['seconds']:.1f}s")
+        service.close()
+    else:
+        with serve(service, args.host, args.port) as base_url:
+            print(f"serving {args.model} at {base_url} (POST /score, GET /metrics)")
+            try:
+                while True:
+                    time.sleep(3600)
+            except KeyboardInterrupt:
+                pass
+        service.close()
@@ -0,0 +1,159 @@
+import os
+import sqlite3
+import threading
+import time
+
+# a persistent record of where every slide of a processing run has got to, so that a run that dies part way through
+# can be restarted and only does the unfinished work. Each slide (file_id) moves through queued -> downloaded ->
+# tiled -> uploaded; the ledger keeps its state, where its tiles go, tile counts, seconds spent in each stage and the
+# last error. The destination is fixed when a slide is first queued, so a restart sends the rest of its tiles to the
+# same place.
+#
+#   ledger = JobLedger("slide_jobs.sqlite")
+#   ledger.enqueue([(file_id, destination), ...])   # slides already in the ledger keep their destination
+#   for file_id, destination, state in ledger.unfinished(): ...
+#   ledger.mark(file_id, "downloaded", seconds=12.5)
+#
+#   python job_ledger.py status slide_jobs.sqlite
+
+STATES = ["queued", "downloaded", "tiled", "uploaded"]
+STAGE_STATES = {"download": "downloaded", "tile": "tiled", "upload": "uploaded"}
+DEFAULT_PATH = "slide_jobs.sqlite"
+
+
+class JobLedger:
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS jobs (file_id TEXT PRIMARY KEY, destination TEXT, state TEXT, "
+                         "tiles INTEGER, kept INTEGER, download_seconds REAL, tile_seconds REAL, "
+                         "upload_seconds REAL, queued REAL, started REAL, updated REAL, attempts INTEGER DEFAULT 0, "
+                         "error TEXT)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state)")
+        self._db.commit()
+
+    def _execute(self, sql, args=()):
+        with self._lock:
+            rows = self._db.execute(sql, args).fetchall()
+            self._db.commit()
+        return rows
+
+    def enqueue(self, jobs):
+        """Add (file_id, destination) jobs; ones already in the ledger are left as they are."""
+        now = time.time()
+        with self._lock:
+            self._db.executemany("INSERT OR IGNORE INTO jobs (file_id, destination, state, queued) "
+                                 "VALUES (?, ?, 'queued', ?)", [(file_id, destination, now)
+                                                                for file_id, destination in jobs])
+            self._db.commit()
+
+    def unfinished(self):
+        """(file_id, destination, state) of every job not yet uploaded, in the order they were queued."""
+        return [tuple(row) for row in self._execute("SELECT file_id, destination, state FROM jobs "
+                                                    "WHERE state != 'uploaded' ORDER BY queued, rowid")]
+
+    def job(self, file_id):
+        rows = self._execute("SELECT * FROM jobs WHERE file_id = ?", (file_id,))
+        columns = [column[1] for column in self._execute("PRAGMA table_info(jobs)")]
+        return dict(zip(columns, rows[0])) if rows else None
+
+    def state(self, file_id):
+        rows = self._execute("SELECT state FROM jobs WHERE file_id = ?", (file_id,))
+        return rows[0][0] if rows else None
+
+    def start(self, file_id):
+        self._execute("UPDATE jobs SET started = COALESCE(started, ?), attempts = attempts + 1 WHERE file_id = ?",
+                      (time.time(), file_id))
+
+    def mark(self, file_id, state, seconds=None):
+        """Record that file_id has reached state, after spending seconds in the stage that got it there."""
+        column = {"downloaded": "download_seconds", "tiled": "tile_seconds", "uploaded": "upload_seconds"}.get(state)
+        if column is None or seconds is None:
+            self._execute("UPDATE jobs SET state = ?, updated = ?, error = NULL WHERE file_id = ?",
+                          (state, time.time(), file_id))
+        else:
+            self._execute(f"UPDATE jobs SET state = ?, {column} = ?, updated = ?, error = NULL WHERE file_id = ?",
+                          (state, seconds, time.time(), file_id))
+
+    def count_tiles(self, file_id, tiles, kept):
+        self._execute("UPDATE jobs SET tiles = ?, kept = ? WHERE file_id = ?", (tiles, kept, file_id))
+
+    def fail(self, file_id, error):
+        """Keep the last error of file_id; its state stays where it was, so a restart retries from there."""
+        self._execute("UPDATE jobs SET error = ?, updated = ? WHERE file_id = ?", (str(error), time.time(), file_id))
+
+    def status(self):
+        """Jobs per state, failures, tiles kept, and the rate and ETA of the run so far (from the first slide started
+        to the last one uploaded)."""
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(dict(self._execute("SELECT state, COUNT(*) FROM jobs GROUP BY state")))
+        failed = self._execute("SELECT COUNT(*) FROM jobs WHERE error IS NOT NULL")[0][0]
+        kept, first, last = self._execute("SELECT COALESCE(SUM(kept), 0), MIN(started), MAX(updated) FROM jobs "
+                                          "WHERE state = 'uploaded'")[0]
+        seconds = {stage: self._execute(f"SELECT AVG({stage}_seconds) FROM jobs")[0][0]
+                   for stage in STAGE_STATES}
+        total = sum(counts.values())
+        remaining = total - counts["uploaded"]
+        elapsed = (last - first) if first is not None and last is not None else 0.0
+        rate = counts["uploaded"] / elapsed if elapsed > 0 else None  # slides per second
+        return {
+            "total": total,
+            "states": counts,
+            "failed": failed,
+            "kept_tiles": kept,
+            "mean_seconds": seconds,
+            "slides_per_hour": rate * 3600 if rate else None,
+            "tiles_per_second": kept / elapsed if elapsed > 0 else None,
+            "eta_seconds": remaining / rate if rate else None,
+        }
+
+    def failures(self):
+        return [tuple(row) for row in self._execute("SELECT file_id, state, attempts, error FROM jobs "
+                                                    "WHERE error IS NOT NULL ORDER BY updated")]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def _duration(seconds):
+    if seconds is None:
+        return "-"
+    hours, rest = divmod(int(seconds), 3600)
+    return f"{hours}h{rest // 60:02d}m" if hours else f"{rest // 60}m{rest % 60:02d}s"
+
+
+def format_status(status):
+    states = ", ".join(f"{state} {status['states'][state]}" for state in STATES)
+    rate = status["slides_per_hour"]
+    means = ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in status["mean_seconds"].items()
+                      if seconds is not None)
+    lines = [
+        f"{status['total']} slides: {states}; {status['failed']} with errors",
+        f"{status['kept_tiles']} tiles uploaded" +
+        (f", {status['tiles_per_second']:.1f} tiles/s" if status["tiles_per_second"] else ""),
+        f"{rate:.1f} slides/hour, ETA {_duration(status['eta_seconds'])}" if rate else "no slides uploaded yet",
+    ]
+    if means:
+        lines.append(f"mean time per slide: {means}")
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Report on a slide processing run from its job ledger.")
+    ap.add_argument("command", choices=["status", "failures"])
+    ap.add_argument("ledger", nargs="?", default=DEFAULT_PATH)
+    args = ap.parse_args()
+
+    if not os.path.exists(args.ledger):
+        raise SystemExit(f"no ledger at {args.ledger}")
+    ledger = JobLedger(args.ledger)
+    if args.command == "status":
+        print(format_status(ledger.status()))
+    else:
+        for file_id, state, attempts, error in ledger.failures():
+            print(f"{file_id}\t{state}\t{attempts} attempts\t{error}")
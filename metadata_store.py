@@ -0,0 +1,123 @@
+import json
+import os
+import sqlite3
+import threading
+
+# lookups into reconstructedData.json by file_id, slide_id, case_id or patient_id. Nothing is read until the first
+# lookup, after which every lookup is a dict (or SQLite index) hit rather than a scan over the cohort.
+#
+#   store = MetadataStore("reconstructedData.json")
+#   store.field(file_id, "years_survived")
+#
+# With sqlite_path the records are also kept in an indexed SQLite file, built from the JSON the first time (or
+# whenever the JSON is newer) and queried directly after that, so a process only pays for the records it uses.
+
+KEYS = ["file_id", "slide_id", "case_id", "patient_id"]
+
+
+def record_keys(record):
+    slides = record.get("slides", {})
+    return {
+        "file_id": slides.get("file_id"),
+        "slide_id": slides.get("slide_id"),
+        "case_id": slides.get("case_id"),
+        "patient_id": record.get("patient_id"),
+    }
+
+
+class _MemoryIndex:
+    def __init__(self, records):
+        self.records = records
+        self.index = {key: {} for key in KEYS}
+        for record in records:
+            for key, value in record_keys(record).items():
+                if value is not None:
+                    self.index[key].setdefault(value, []).append(record)
+
+    def lookup(self, key, value):
+        return self.index[key].get(value, [])
+
+    def all(self):
+        return self.records
+
+
+class _SqliteIndex:
+    def __init__(self, path):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def build(path, records):
+        if os.path.exists(path):
+            os.remove(path)
+        db = sqlite3.connect(path)
+        db.execute("CREATE TABLE records (n INTEGER PRIMARY KEY, %s, record TEXT)" % ", ".join(KEYS))
+        rows = []
+        for n, record in enumerate(records):
+            keys = record_keys(record)
+            rows.append([n] + [keys[key] for key in KEYS] + [json.dumps(record)])
+        db.executemany("INSERT INTO records VALUES (%s)" % ", ".join("?" * (len(KEYS) + 2)), rows)
+        for key in KEYS:
+            db.execute(f"CREATE INDEX records_{key} ON records ({key})")
+        db.commit()
+        db.close()
+
+    def lookup(self, key, value):
+        with self.lock:
+            rows = self.db.execute(f"SELECT record FROM records WHERE {key} = ? ORDER BY n", (value,)).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def all(self):
+        with self.lock:
+            rows = self.db.execute("SELECT record FROM records ORDER BY n").fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+
+class MetadataStore:
+    def __init__(self, json_path="reconstructedData.json", sqlite_path=None):
+        self.json_path = json_path
+        self.sqlite_path = sqlite_path
+        self._index = None
+        self._lock = threading.Lock()
+
+    def _load(self):
+        with self._lock:
+            if self._index is None:
+                if self.sqlite_path is None:
+                    self._index = _MemoryIndex(self._read_json())
+                else:
+                    if (not os.path.exists(self.sqlite_path) or
+                            os.path.getmtime(self.json_path) > os.path.getmtime(self.sqlite_path)):
+                        _SqliteIndex.build(self.sqlite_path, self._read_json())
+                    self._index = _SqliteIndex(self.sqlite_path)
+            return self._index
+
+    def _read_json(self):
+        with open(self.json_path, "r") as f:
+            return json.load(f)["data"]
+
+    def records(self):
+        return self._load().all()
+
+    def lookup(self, key, value):
+        """Every record whose key (one of KEYS) is value."""
+        return self._load().lookup(key, value)
+
+    def by_file_id(self, file_id):
+        records = self.lookup("file_id", file_id)
+        return records[0] if records else None
+
+    def by_slide_id(self, slide_id):
+        records = self.lookup("slide_id", slide_id)
+        return records[0] if records else None
+
+    def by_case_id(self, case_id):
+        return self.lookup("case_id", case_id)
+
+    def by_patient_id(self, patient_id):
+        return self.lookup("patient_id", patient_id)
+
+    def field(self, file_id, field):
+        """record[field] for the record of file_id, None if there is no such record or field."""
+        record = self.by_file_id(file_id)
+        return record.get(field) if record is not None else None
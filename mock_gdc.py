@@ -0,0 +1,341 @@
+import hashlib
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+# a small stand-in for the GDC API (https://api.gdc.cancer.gov/) that serves a synthetic cohort, so that the
+# query and download scripts can be exercised and benchmarked without touching the network.
+#
+#   mock = MockGDC(synthetic_cases(1000))
+#   with serve(mock) as url:
+#       ... point the scripts at url + 'cases' / url + 'files' ...
+#   print(mock.requests)
+#
+# File contents can be served from url + 'data/<file_id>' (with Range requests) once added with add_data.
+
+SITES = ["Lymph nodes of axilla or arm", "Skin of trunk", "Skin of lower limb and hip",
+         "Lymph node, NOS", "Connective, subcutaneous and other soft tissues of trunk"]
+SAMPLE_CODES = ["01", "06", "06", "07", "11"]
+STAGES = ["stage i", "stage ii", "stage iia", "stage iii", "stage iiic", "stage iv", "not reported"]
+
+
+def _uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+def synthetic_cases(num_cases, slides_per_case=2, seed=0):
+    """Case hits shaped like the output of the GDC cases endpoint for the fields in query.CASE_FIELDS."""
+    rng = random.Random(seed)
+    cases = []
+    for n in range(num_cases):
+        case_id = _uuid(rng)
+        tss = "%02X" % rng.randrange(256)
+        participant = "%04X" % n
+        dead = rng.random() < 0.4
+        sample_code = rng.choice(SAMPLE_CODES)
+        slides = []
+        for s in range(slides_per_case):
+            slides.append({
+                "slide_id": _uuid(rng),
+                "submitter_id": f"TCGA-{tss}-{participant}-{sample_code}Z-00-DX{s + 1}",
+                "section_location": "Not Reported",
+                "percent_tumor_cells": rng.randrange(0, 100, 5),
+                "percent_stromal_cells": rng.randrange(0, 50, 5),
+                "percent_necrosis": rng.randrange(0, 30, 5),
+                "percent_normal_cells": rng.randrange(0, 20, 5),
+                "percent_lymphocyte_infiltration": rng.randrange(0, 40, 5),
+            })
+        diagnosis = {
+            "age_at_diagnosis": rng.randrange(20 * 365, 90 * 365),
+            "days_to_last_follow_up": None if dead else rng.randrange(30, 6000),
+            "year_of_diagnosis": rng.randrange(1980, 2013),
+            "tumor_stage": rng.choice(STAGES),
+            "tissue_or_organ_of_origin": "Skin, NOS",
+            "site_of_resection_or_biopsy": rng.choice(SITES),
+            "prior_malignancy": rng.choice(["no", "yes"]),
+            "primary_diagnosis": "Malignant melanoma, NOS",
+        }
+        cases.append({
+            "id": case_id,
+            "case_id": case_id,
+            "submitter_id": f"TCGA-{tss}-{participant}",
+            "primary_site": "Skin",
+            "state": "released",
+            "slide_ids": [slide["slide_id"] for slide in slides],
+            "samples": [{"portions": [{"slides": [slide]}]} for slide in slides],
+            "diagnoses": [diagnosis],
+            "demographic": {
+                "vital_status": "Dead" if dead else "Alive",
+                "days_to_death": rng.randrange(30, 6000) if dead else None,
+                "gender": rng.choice(["male", "female"]),
+            },
+        })
+    return cases
+
+
+def synthetic_files(cases, seed=0):
+    """One SVS file hit per slide of the given cases, linked back through cases.samples.portions.slides."""
+    rng = random.Random(seed + 1)
+    files = []
+    for case in cases:
+        for slide_id in case["slide_ids"]:
+            file_id = _uuid(rng)
+            files.append({
+                "id": file_id,
+                "file_id": file_id,
+                "file_name": f"{case['submitter_id']}.{file_id}.svs",
+                "file_size": rng.randrange(50, 2000) * 1024 * 1024,
+                "md5sum": "%032x" % rng.getrandbits(128),
+                "data_format": "SVS",
+                "data_type": "Slide Image",
+                "data_category": "Biospecimen",
+                "access": "open",
+                "state": "released",
+                "cases": [{"samples": [{"portions": [{"slides": [{"slide_id": slide_id}]}]}]}],
+            })
+    return files
+
+
+def synthetic_content(size, seed=0):
+    return random.Random(seed).randbytes(size)
+
+
+def _filter_values(filters, field):
+    # values of every '='/'in' clause on the given field, or None when the field is not filtered on
+    if not filters:
+        return None
+    content = filters.get("content")
+    if isinstance(content, list):
+        found = None
+        for clause in content:
+            values = _filter_values(clause, field)
+            if values is not None:
+                found = (found or set()) | values
+        return found
+    if isinstance(content, dict) and content.get("field") == field and filters.get("op") in ("=", "in"):
+        value = content.get("value")
+        return set(value) if isinstance(value, list) else {value}
+    return None
+
+
+def _select(doc, fields):
+    if not fields:
+        return doc
+    roots = {field.split(".")[0] for field in fields.split(",")}
+    return {key: value for key, value in doc.items() if key in roots or key == "id"}
+
+
+class MockGDC:
+    def __init__(self, cases, files=None, latency=0.0, fail_rate=0.0, seed=0, bandwidth=None, cut_rate=0.0):
+        self.cases = cases
+        self.files = files if files is not None else synthetic_files(cases)
+        self.latency = latency
+        self.fail_rate = fail_rate  # fraction of requests answered with a 429 or 503 instead of a result
+        self.bandwidth = bandwidth  # bytes/sec of each data response, None for as fast as possible
+        self.cut_rate = cut_rate  # fraction of data responses whose connection is dropped half way through the body
+        self.data = {}
+        self.bytes_sent = 0
+        self.requests = 0
+        self.failures = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._files_by_slide = {}
+        for file_hit in self.files:
+            for case in file_hit["cases"]:
+                for sample in case["samples"]:
+                    for portion in sample["portions"]:
+                        for slide in portion["slides"]:
+                            self._files_by_slide.setdefault(slide["slide_id"], []).append(file_hit)
+
+    def add_data(self, file_id, content):
+        """Serve content as the file file_id; the file's hit gets its size and md5sum."""
+        self.data[file_id] = content
+        for file_hit in self.files:
+            if file_hit["file_id"] == file_id:
+                file_hit["file_size"] = len(content)
+                file_hit["md5sum"] = hashlib.md5(content).hexdigest()
+
+    def cut(self):
+        with self._lock:
+            return bool(self.cut_rate) and self._rng.random() < self.cut_rate
+
+    def sent(self, size):
+        with self._lock:
+            self.bytes_sent += size
+
+    def count(self):
+        # counts the request, and returns the error status to answer it with, if any
+        with self._lock:
+            self.requests += 1
+            if self.fail_rate and self._rng.random() < self.fail_rate:
+                self.failures += 1
+                return self._rng.choice([429, 503])
+        return None
+
+    def search(self, endpoint, params):
+        filters = params.get("filters")
+        if isinstance(filters, str):
+            filters = json.loads(filters)
+        if endpoint == "cases":
+            hits = self.cases
+        elif endpoint == "files":
+            slide_ids = _filter_values(filters, "cases.samples.portions.slides.slide_id")
+            if slide_ids is None:
+                hits = self.files
+            else:
+                hits = [file_hit for slide_id in sorted(slide_ids)
+                        for file_hit in self._files_by_slide.get(slide_id, [])]
+        else:
+            return None
+
+        size = int(params.get("size", 10))
+        start = int(params.get("from", 0))
+        page = [_select(hit, params.get("fields")) for hit in hits[start:start + size]]
+        total = len(hits)
+        return {
+            "data": {
+                "hits": page,
+                "pagination": {
+                    "count": len(page),
+                    "total": total,
+                    "size": size,
+                    "from": start,
+                    "page": start // size + 1 if size else 1,
+                    "pages": -(-total // size) if size else 1,
+                    "sort": "",
+                },
+            },
+            "warnings": {},
+        }
+
+
+def _handler(mock):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+        # keep-alive connections otherwise stall on Nagle's algorithm between the header and body writes
+        disable_nagle_algorithm = True
+        wbufsize = 64 * 1024
+
+        def log_message(self, format, *args):
+            pass
+
+        def _send_json(self, status, payload):
+            body = json.dumps(payload).encode("utf8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _search(self, params):
+            error = mock.count()
+            if mock.latency:
+                time.sleep(mock.latency)
+            if error is not None:
+                self._send_json(error, {"message": "injected failure"})
+                return
+            result = mock.search(urlparse(self.path).path.strip("/"), params)
+            if result is None:
+                self._send_json(404, {"message": "not found"})
+            else:
+                self._send_json(200, result)
+
+        def _data(self, file_id):
+            error = mock.count()
+            if mock.latency:
+                time.sleep(mock.latency)
+            if error is not None:
+                self._send_json(error, {"message": "injected failure"})
+                return
+            content = mock.data.get(file_id)
+            if content is None:
+                self._send_json(404, {"message": "not found"})
+                return
+            start, end = 0, len(content)
+            byte_range = self.headers.get("Range")
+            if byte_range:
+                first, _, last = byte_range.replace("bytes=", "").partition("-")
+                start, end = int(first), min(int(last) + 1, len(content)) if last else len(content)
+                if start >= end:
+                    self.send_response(416)
+                    self.send_header("Content-Range", f"bytes */{len(content)}")
+                    self.send_header("Content-Length", "0")
+                    self.end_headers()
+                    return
+            self.send_response(206 if byte_range else 200)
+            self.send_header("Content-Type", "application/octet-stream")
+            self.send_header("Content-Length", str(end - start))
+            self.send_header("Accept-Ranges", "bytes")
+            if byte_range:
+                self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(content)}")
+            self.end_headers()
+            if mock.cut():
+                end = start + (end - start) // 2
+                self.close_connection = True
+            chunk_size = 64 * 1024
+            for offset in range(start, end, chunk_size):
+                chunk = content[offset:min(offset + chunk_size, end)]
+                if mock.bandwidth:
+                    time.sleep(len(chunk) / mock.bandwidth)
+                self.wfile.write(chunk)
+                mock.sent(len(chunk))
+
+        def do_GET(self):
+            path = urlparse(self.path).path
+            if path.startswith("/data/"):
+                self._data(path[len("/data/"):])
+                return
+            query = parse_qs(urlparse(self.path).query)
+            self._search({key: values[-1] for key, values in query.items()})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length", 0))
+            self._search(json.loads(self.rfile.read(length).decode("utf8")) if length else {})
+
+    return Handler
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class serve:
+    """Run a MockGDC on a local port for the duration of a with block; yields the base url (ending in '/')."""
+
+    def __init__(self, mock, host="127.0.0.1", port=0):
+        self.server = _Server((host, port), _handler(mock))
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}/"
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser(description="Serve a synthetic GDC cohort locally.")
+    ap.add_argument("-N", "--num_cases", type=int, default=500)
+    ap.add_argument("-P", "--port", type=int, default=8008)
+    ap.add_argument("-l", "--latency", type=float, default=0.0, help="seconds of delay added to every request")
+    ap.add_argument("-f", "--fail_rate", type=float, default=0.0, help="fraction of requests to fail with 429/503")
+    args = ap.parse_args()
+
+    mock = MockGDC(synthetic_cases(args.num_cases), latency=args.latency, fail_rate=args.fail_rate)
+    with serve(mock, port=args.port) as base_url:
+        print(f"serving {args.num_cases} synthetic cases at {base_url}")
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
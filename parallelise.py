@@ -45,9 +45,20 @@ drive.mount('/content/drive')
 import openslide
 import openslide.deepzoom
 
-df = pd.read_csv("/content/drive/MyDrive/reconstructedData.csv")
-df = df[df['slides__file_id'].notna()]
+from cohort_stats import label_cohort  # from this repo, which must be on the path
+from cohort_table import read_patients
+from image_processing import tiles_to_array, tissue_fractions
+from split_service import Splits
+
+# columnar cohort table written by query.py (Feather or Parquet, whichever is there); only the columns used below
+# are read
+df = read_patients("/content/drive/MyDrive/cohort", columns=["file_id", "years_survived", "biopsy_tissue_type"])
+df = df[df['file_id'].notna()]
 df = df[df['years_survived'].notna()]
+df = label_cohort(df)  # adds survival_label: early (<= 3 years) / late
+# the patient-level train/validation split every stage shares, written once by split_service.py
+splits = Splits.load("/content/drive/MyDrive/cohort/splits.json")
+df["split"] = df["file_id"].map(splits.files)
 df
 
 #Get Lymph nodes 
@@ -56,13 +67,13 @@ df
 
 df_lymph_nodes = df[df.biopsy_tissue_type == "Lymph"]
 
-train_lymph_nodes, validation_lymph_nodes = np.split(df_lymph_nodes.sample(frac=1, random_state=42), 
-                       [int(.8*len(df_lymph_nodes))])
+train_lymph_nodes = df_lymph_nodes[df_lymph_nodes.split == "train"]
+validation_lymph_nodes = df_lymph_nodes[df_lymph_nodes.split == "validation"]
 
-train_lymph_nodes_early = train_lymph_nodes[train_lymph_nodes.years_survived <= 3]
-train_lymph_nodes_late =  train_lymph_nodes[train_lymph_nodes.years_survived > 3]
-validation_lymph_nodes_early = validation_lymph_nodes[validation_lymph_nodes.years_survived <= 3]
-validation_lymph_nodes_late = validation_lymph_nodes[validation_lymph_nodes.years_survived > 3]
+train_lymph_nodes_early = train_lymph_nodes[train_lymph_nodes.survival_label == "early"]
+train_lymph_nodes_late =  train_lymph_nodes[train_lymph_nodes.survival_label == "late"]
+validation_lymph_nodes_early = validation_lymph_nodes[validation_lymph_nodes.survival_label == "early"]
+validation_lymph_nodes_late = validation_lymph_nodes[validation_lymph_nodes.survival_label == "late"]
 
 print(train_lymph_nodes_early.shape[0])
 print(train_lymph_nodes_late.shape[0])
@@ -71,11 +82,11 @@ print(validation_lymph_nodes_late.shape[0])
 print(train_lymph_nodes.shape[0])
 print(validation_lymph_nodes.shape[0])
 
-lymph_training_early = train_lymph_nodes_early["slides__file_id"].to_list()
-lymph_training_late = train_lymph_nodes_late["slides__file_id"].to_list()
+lymph_training_early = train_lymph_nodes_early["file_id"].to_list()
+lymph_training_late = train_lymph_nodes_late["file_id"].to_list()
 
-lymph_validation_early = validation_lymph_nodes_early["slides__file_id"].to_list()
-lymph_validation_late = validation_lymph_nodes_late["slides__file_id"].to_list()
+lymph_validation_early = validation_lymph_nodes_early["file_id"].to_list()
+lymph_validation_late = validation_lymph_nodes_late["file_id"].to_list()
 
 print(lymph_training_early)
 print(lymph_training_late)
@@ -88,14 +99,14 @@ print(lymph_validation_late)
 
 df_skin = df[df.biopsy_tissue_type == "Skin"]
 
-train_skin, validation_skin = np.split(df_skin.sample(frac=1, random_state=42), 
-                       [int(.8*len(df_skin))])
+train_skin = df_skin[df_skin.split == "train"]
+validation_skin = df_skin[df_skin.split == "validation"]
 
 #Label 1: early, Label 2: late
-train_skin_early = train_skin[train_skin.years_survived <= 3]
-train_skin_late =  train_skin[train_skin.years_survived > 3]
-validation_skin_early = validation_skin[validation_skin.years_survived <= 3]
-validation_skin_late = validation_skin[validation_skin.years_survived > 3]
+train_skin_early = train_skin[train_skin.survival_label == "early"]
+train_skin_late =  train_skin[train_skin.survival_label == "late"]
+validation_skin_early = validation_skin[validation_skin.survival_label == "early"]
+validation_skin_late = validation_skin[validation_skin.survival_label == "late"]
 
 print(train_skin_early.shape[0])
 print(train_skin_late.shape[0])
@@ -104,11 +115,11 @@ print(validation_skin_late.shape[0])
 print(train_skin.shape[0])
 print(validation_skin.shape[0])
 
-skin_training_early = train_skin_early["slides__file_id"].to_list()
-skin_training_late = train_skin_late["slides__file_id"].to_list()
+skin_training_early = train_skin_early["file_id"].to_list()
+skin_training_late = train_skin_late["file_id"].to_list()
 
-skin_validation_early = validation_skin_early["slides__file_id"].to_list()
-skin_validation_late = validation_skin_late["slides__file_id"].to_list()
+skin_validation_early = validation_skin_early["file_id"].to_list()
+skin_validation_late = validation_skin_late["file_id"].to_list()
 
 print(skin_training_early)
 print(skin_training_late)
@@ -119,17 +130,9 @@ base_dir = "/content/drive/MyDrive/Data/"
 
 '''Alternative method using OpenSlide Deepzoom'''
 
-#Calculate percentage of tissue in image 
+#Calculate percentage of tissue in image (vectorised, see image_processing.tissue_fractions)
 def calculate_tissue_percentage(img, threshold):
-    img = img.copy().convert("L")   #convert to grayscale
-    tissue_pixels = 0
-    width, height = img.width, img.height
-    total_pixels = width*height
-    for x in range(width):
-        for y in range(height):
-            if (img.getpixel((x,y)) < threshold):     #threshold value to reject white space
-                tissue_pixels += 1
-    return (tissue_pixels / total_pixels) * 100
+    return tissue_fractions(tiles_to_array([img]), threshold)[0] * 100     #threshold value to reject white space
 
 #Information on images
 def slide_info_dzi(dimension, image):
@@ -154,10 +157,14 @@ def crop_dzi(dimension, image, level, directory):
 
   level_count, level_tiles = slide_info_dzi(dimension, image)  
   for x in range(level_tiles[level_count - level][0]):
-    for y in range(level_tiles[level_count - level][1]):
-      tile_rgb = tiles.get_tile((level_count - level), (x, y))    #get tile at each column/row
-      #print(calculate_tissue_percentage(tile_rgb, 200))
-      if(calculate_tissue_percentage(tile_rgb, 200) >= 35):       #calculate tissue percentage
+    column = [tiles.get_tile((level_count - level), (x, y))      #get tile at each row of the column
+              for y in range(level_tiles[level_count - level][1])]
+    #tissue percentage of the whole column at once; edge tiles are a different size, so those go on their own
+    full = [tile for tile in column if tile.size == column[0].size]
+    tissue = list(tissue_fractions(tiles_to_array(full), 200) * 100)
+    tissue += [calculate_tissue_percentage(tile_rgb, 200) for tile_rgb in column[len(full):]]
+    for tile_rgb, tissue_percentage in zip(column, tissue):
+      if(tissue_percentage >= 35):                                #calculate tissue percentage
         tiles_rgb.append(tile_rgb)                                #list to track number of tiles kept
         tile_rgb.save(directory + str(image) + "_" + str(counter) + ".png")     #png image saved to directory
         counter += 1
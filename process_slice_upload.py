@@ -1,87 +1,39 @@
-from random import random
-import requests
-import json
-import subprocess
 import os
-from tqdm import tqdm
 import concurrent.futures
-import tempfile
-import openslide
-from openslide import deepzoom
-from image_processing import calculate_tissue_percentage
-from concurrent import futures
+import functools
+from cohort_stats import TILED_TISSUE_TYPES, label_dir
+from job_ledger import STAGE_STATES, JobLedger, format_status
+from metadata_store import MetadataStore
+from tiler import FolderWriter, format_stats, release_slide, tile_slide
+from slide_downloader import SlideDownloader
+from split_service import load_or_build
+from slide_pipeline import SlidePipeline, format_pipeline_stats, remove
+from tile_store import TileStoreWriter
+from tile_uploader import RcloneUploader, TileSpool, format_upload_stats
 
 # from slice_image import classify_tile, slice_image_parallel2, classify_tile2
 
+TILE_OUTPUT = "png"  # or "hdf5": each slide's tiles are uploaded as a few HDF5 shards instead of a file per tile
+TILE_CODEC = "png"  # codec of the per-tile files, e.g. "png:1" or "jpeg:90", see tile_codec.py
+DOWNLOAD_WORKERS = 4
+TILE_WORKERS = 2
+UPLOAD_WORKERS = 2
+UPLOAD_BATCH = 256  # tiles per rclone copy
+UPLOADER = RcloneUploader(transfers=16)  # tile_uploader.FakeUploader(<dir>) to try things out locally
+DISK_BUDGET = 50 * 1024 ** 3  # bytes of scratch disk for slides and tiles in flight
+LEDGER_PATH = "slide_jobs.sqlite"
+SPLITS_PATH = "splits.json"
 path_to_slides_data = "reconstructedData.json"
 endpoint = "https://api.gdc.cancer.gov/data/"
-f = open(path_to_slides_data, )
-output = json.load(f)
-
-
-def slice_image_parallel2(slide_path: str, tile_size_: int, level: int, tissue_threshold_percentage: int,
-                          output_folder: str, path_to_upload, file_id):
-    slide_ = deepzoom.DeepZoomGenerator(openslide.open_slide(slide_path), tile_size=tile_size_, overlap=1)
-    tiles_info_per_level = slide_.level_tiles
-    # number_of_levels = len(tiles_info_per_level)
-    number_of_widths, number_of_heights = tiles_info_per_level[level]
-    # print(f"level dimensions: {slide_.level_dimensions}")
-    # print(f"tile dimensions: {slide_.get_tile_dimensions(level, (29, 0))}")
-    # print(f"Number of widths: {number_of_widths}")
-    # print(f"Number of heights: {number_of_heights}")
-    # print(f"number of levels: {number_of_levels}")
-    counter = 0
-    # total_slides = number_of_heights * number_of_widths
-    # print(f"total slides: {total_slides}")
-    jobs_instructions = list()
-    for width_index in range(number_of_widths):
-        # width = width_index * tile_size_
-        for height_index in range(number_of_heights):
-            # height = height_index * tile_size_
-            jobs_instructions.append(
-                    (slide_path, counter, width_index, height_index, tile_size_, level, tissue_threshold_percentage,
-                     output_folder, path_to_upload, file_id))
-            counter += 1
-
-    for job in jobs_instructions:
-        classify_tile_rclone(job)
-
-    # p_bar = tqdm(total=len(jobs_instructions))
-    # with futures.ThreadPoolExecutor(max_workers=2) as ex:
-    #     futures_to_jobs = {ex.submit(classify_tile_rclone, job): job for job in jobs_instructions}
-    #     for _ in futures.as_completed(futures_to_jobs):
-    #         p_bar.update(1)
-    #         p_bar.refresh()
-
-
-def classify_tile_rclone(arguments):
-    if not os.path.exists("./_tmp"):
-        os.makedirs("./_tmp")
-    temporary_file = tempfile.NamedTemporaryFile(dir="./_tmp")
-
-    slide_path, tile_number, x, y, tile_size_, level, tissue_threshold_percentage, output_folder, path_to_upload, file_id = arguments
-    try:
-        slide_ = deepzoom.DeepZoomGenerator(openslide.OpenSlide(slide_path), tile_size=tile_size_, overlap=0)
-    except openslide.lowlevel.OpenSlideUnsupportedFormatError:
-        print("svs too large, resolution too high" + slide_path)
-        return
-    tile = slide_.get_tile(level, (x, y))
-    tile_dimensions = slide_.get_tile_dimensions(level, (x, y))
-    if tile_dimensions == (tile_size_, tile_size_):
-        tissue_percentage = calculate_tissue_percentage(tile)
-        if tissue_percentage > tissue_threshold_percentage:
-            # tile.save(os.path.join(output_folder, f"tile{tile_number}.png"))
-            tile.save(temporary_file, "png")
-            # print(path_to_upload)
-            subprocess.run(["rclone", "copyto", temporary_file.name, #"rgoyalLab:/tmp/GCDData_/{path_to_upload}{file_id}_{tile_number}.png", "-q", "--transfers=16"])
-                            f"GCDData:/FinalData_/{path_to_upload}{file_id}_{tile_number}.png", "-q", "--transfers=1"])
-
-def fetch_slides(slides_path):
-    output_list = []
-    with open(slides_path, 'r') as infile:
-        slides_data = json.load(infile)
+store = MetadataStore(path_to_slides_data)
+# slides finished in ./_tmp/manifest.jsonl and still on disk (e.g. a run killed before it noted the download in the
+# ledger) are not fetched again
+downloader = SlideDownloader("./_tmp", endpoint)
 
-    patients = slides_data["data"]  # all slides
+
+def fetch_slides(metadata):
+    output_list = []
+    patients = metadata.records()  # all slides
     for patient in patients:
         patient_id = patient["patient_id"]
         data = patient["slides"]
@@ -94,64 +46,116 @@ def fetch_slides(slides_path):
         if "file_id" not in data:
             print("file ID for " + patient_id + " is missing")
             continue
-        if patient["biopsy_tissue_type"] in ["Lymph", "Skin"]:
+        if patient["biopsy_tissue_type"] in TILED_TISSUE_TYPES:
             output_list.append((data["case_id"], data["slide_id"], data["file_id"]))
     return output_list
 
 
 def locate_field(file_id, field):
-    for patient in output["data"]:
-        if "file_id" in patient["slides"] and file_id == patient["slides"]["file_id"]:
-            return patient[field]
-
-
-def upload_path(tissue_type, years_survived):
-    randomNumber = random()
-
-    if randomNumber < 0.8:
-        if tissue_type == "Skin":
-            if years_survived <= 3:
-                return "skin_train_dir/early/"
-            else:
-                return "skin_train_dir/late/"
-        elif tissue_type == "Lymph":
-            if years_survived <= 3:
-                return "lymph_train_dir/early/"
-            else:
-                return "lymph_train_dir/late/"
-        else:
-            return 0
-    else:
-        if tissue_type == "Skin":
-            if years_survived <= 3:
-                return "skin_validation_dir/early/"
-            else:
-                return "skin_validation_dir/late/"
-        elif tissue_type == "Lymph":
-            if years_survived <= 3:
-                return "lymph_validation_dir/early/"
-            else:
-                return "lymph_validation_dir/late/"
-        else:
-            return 0
+    return store.field(file_id, field)
+
+
+@functools.lru_cache(maxsize=None)
+def cohort_splits():
+    # decided once for the whole cohort and kept in SPLITS_PATH, see split_service.py
+    return load_or_build(SPLITS_PATH, store)
+
+
+def upload_path(file_id, tissue_type, years_survived):
+    split = cohort_splits().file_split(file_id, locate_field(file_id, "patient_id"))
+    if split is None:
+        return 0
+    path = label_dir(tissue_type, years_survived, split)
+    return path if path is not None else 0
 
 
 def download_slide(file_id):
-    if not os.path.exists("./_tmp"):
-        os.makedirs("./_tmp")
-    temporary_file = tempfile.NamedTemporaryFile(dir="./_tmp")
+    # in segments, resuming a partial download left in ./_tmp, and checked against the slide's md5sum
+    record = store.by_file_id(file_id) or {}
+    slide = record.get("slides", {})
+    return downloader.download(file_id, slide.get("file_size"), slide.get("md5sum"))
+
+
+# the three stages of the slide pipeline (see slide_pipeline.py); a job is (file_id, path_to_upload)
+def download_stage(job):
+    file_id, _ = job
+    try:
+        return download_slide(file_id)
+    except Exception:
+        downloader.discard(file_id)  # a partial slide is not on the disk budget
+        raise
+
 
-    r = requests.get(endpoint + file_id, stream=True)
-    total_length = r.headers.get('content-length')
+def tile_spool(file_id):
+    return os.path.join("./_tmp", file_id + "_tiles")
 
-    if total_length is None:  # no content length header
-        temporary_file.write(r.content)
+
+def tile_stage(job, slide_path, executor=None, ledger=None):
+    file_id, _ = job
+    spool = tile_spool(file_id)
+    os.makedirs(spool, exist_ok=True)
+    if TILE_OUTPUT == "hdf5":
+        writer = TileStoreWriter(spool)
+    else:
+        writer = FolderWriter(spool, prefix=file_id + "_", codec=TILE_CODEC)
+    try:
+        stats = tile_slide(slide_path, 1024, 14, 50, writer, executor=executor, native=True)
+    except Exception:
+        remove(spool)
+        raise
+    finally:
+        release_slide(slide_path)
+    print(file_id + ": " + format_stats(stats))
+    if ledger is not None:
+        ledger.count_tiles(file_id, stats["tiles"], stats["kept"])
+    return spool
+
+
+def upload_stage(job, spool):
+    file_id, path_to_upload = job
+    # tile files keep their old <file_id>_<n> names in the label directory, a tile store gets a directory of its own
+    destination = f"GCDData:/FinalData_/{path_to_upload}" + (file_id if TILE_OUTPUT == "hdf5" else "")
+    # in batches of UPLOAD_BATCH, each retried; the spool's manifest skips batches already sent if this is retried
+    uploads = TileSpool(spool, destination, UPLOADER, batch_size=UPLOAD_BATCH)
+    uploads.flush_all(remove=False)
+    print(file_id + ": uploaded " + format_upload_stats(uploads.stats))
+
+
+def resume_point(ledger, job):
+    # a slide that got part way in an earlier run carries on from whatever it left in ./_tmp
+    file_id, _ = job
+    ledger.start(file_id)
+    state = ledger.state(file_id)
+    if state == "tiled" and os.path.isdir(tile_spool(file_id)):
+        return "upload", tile_spool(file_id)
+    if state == "downloaded" and os.path.exists(downloader.path(file_id)):
+        return "tile", downloader.path(file_id)
+    return None
+
+
+def record_stage(ledger, job, stage, seconds, error):
+    if error is None:
+        ledger.mark(job[0], STAGE_STATES[stage], seconds)
     else:
-        chunk_size = 1024 * 1024
-        for content_chunk in r.iter_content(chunk_size=chunk_size):
-            temporary_file.write(content_chunk)
+        ledger.fail(job[0], f"{stage}: {error}")
+
 
-    return temporary_file
+def slide_size(job):
+    record = store.by_file_id(job[0])
+    return (record or {}).get("slides", {}).get("file_size") or 0
+
+
+def slide_jobs(slides):
+    jobs = []
+    for _, _, file_id in slides:
+        biopsy_tissue_type = locate_field(file_id, "biopsy_tissue_type")
+        years_survived = locate_field(file_id, "years_survived")
+        if None in [biopsy_tissue_type, years_survived] or 0 in [biopsy_tissue_type, years_survived]:
+            continue
+        path_to_upload = upload_path(file_id, biopsy_tissue_type, years_survived)
+        if path_to_upload != 0:
+            jobs.append((file_id, path_to_upload))
+    return jobs
 
 # def rclone_mount(file_id):
 #     if not os.path.exists("./_tmp"):
@@ -163,40 +167,24 @@ def download_slide(file_id):
 #
 #     return temporary_file
 
-def download_and_upload(file_id):
-    tile_size = 1024
-
-    biopsy_tissue_type = locate_field(file_id, "biopsy_tissue_type")
-    years_survived = locate_field(file_id, "years_survived")
-    if 0 in [biopsy_tissue_type, years_survived]:
-        return
-    path_to_upload = upload_path(biopsy_tissue_type, years_survived)
-    # print(path_to_upload)
-
-    if path_to_upload == 0:
-        return
-
-    slide_temp_file = download_slide(file_id)
-    slide_file = slide_temp_file.name
-    # print("got here")
-    slice_image_parallel2(slide_file, tile_size, 14, 50, 'tiles', path_to_upload, file_id)
-
-    # subprocess.run(["rclone", "copyto", slide_file.name, f"GCDData:/Data/{file_id}.svs", "-q", "--transfers=1"])
-    # subprocess.run(["/home/rajesh/Downloads/rclone-v1.54.0-linux-amd64/rclone", "copyto", slide_file.name, f"GCDData:/Test/{file_id}.svs", "-q", "--transfers=1"])
-    slide_temp_file.close()
-
-
 if __name__ == "__main__":
     # list of tuples. each tuple contains case_id, slide_id, and file_id
-    slides = fetch_slides(path_to_slides_data)
-
-    # for slide_meta in slides:
-    #     download_and_upload(slide_meta[2])
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-        future_to_slide = {executor.submit(download_and_upload, slide_meta[2]): slide_meta for slide_meta in slides}
-        pbar = tqdm(total=len(future_to_slide))
-        for future in concurrent.futures.as_completed(future_to_slide):
-            # print(future.result())
-            pbar.update(1)
-            pbar.refresh()
+    slides = fetch_slides(store)
+
+    # download -> tile -> upload as a pipeline: DOWNLOAD_WORKERS slides downloading, TILE_WORKERS being tiled (all on
+    # one pool of tiling processes, one per core) and UPLOAD_WORKERS uploading at once, with at most DISK_BUDGET bytes
+    # of slides and tiles in ./_tmp. Every slide's progress is kept in the job ledger, so a rerun skips slides that
+    # are already uploaded and picks the rest up where they stopped (`python job_ledger.py status` to watch a run)
+    ledger = JobLedger(LEDGER_PATH)
+    ledger.enqueue(slide_jobs(slides))
+    jobs = [(file_id, destination) for file_id, destination, _ in ledger.unfinished()]
+    print(f"{len(jobs)} slides to process")
+    tile_pool = concurrent.futures.ProcessPoolExecutor()
+    pipeline = SlidePipeline(download_stage, functools.partial(tile_stage, executor=tile_pool, ledger=ledger),
+                             upload_stage, size=slide_size, download_workers=DOWNLOAD_WORKERS,
+                             tile_workers=TILE_WORKERS, upload_workers=UPLOAD_WORKERS, disk_budget=DISK_BUDGET,
+                             resume=functools.partial(resume_point, ledger),
+                             record=functools.partial(record_stage, ledger))
+    print(format_pipeline_stats(pipeline.run(jobs)))
+    print(format_status(ledger.status()))
+    tile_pool.shutdown()
@@ -4,11 +4,16 @@
 import sys
 import argparse
 
+import copy
 import json
-import requests
 
-import numpy as np
-import statistics
+import pandas as pd
+
+from cohort_stats import cohort_frame, cohort_summary, grouped_summary
+from cohort_table import records_to_tables, write_tables
+from flatten_cases import flatten_hits
+from gdc_client import GDCClient, default_client, set_default_client
+from response_cache import DEFAULT_TTL, ResponseCache
 
 CASE_FIELDS = [
 	'submitter_id',
@@ -83,6 +88,7 @@ FILE_FIELDS = [
 
 	'file_name',
 	'file_size',
+	'md5sum',
 	'type',
 	'data_type',
 	'data_category',
@@ -106,6 +112,11 @@ ENDPOINT = 'https://api.gdc.cancer.gov/'
 CASES_ENDPOINT = ENDPOINT + 'cases'
 FILES_ENDPOINT = ENDPOINT + 'files'
 
+SLIDE_ID_FIELD = 'cases.samples.portions.slides.slide_id'
+SLIDES_PER_REQUEST = 300  # slide IDs per 'in' filter, sent as a POST body since this is far too long for a URL
+FILES_PAGE_SIZE = 1000
+CASES_PAGE_SIZE = 500
+
 CASE_FILTERS = {
 	'op': 'and',
 	'content': [
@@ -149,40 +160,98 @@ CASE_FILTERS = {
 
 def process_args():
 	ap = argparse.ArgumentParser(description='Get metadata from the GDC.')
-	ap.add_argument('-C', '--cases', help='existing JSON file of case query results', default=None)
+	ap.add_argument('-E', '--endpoint', help='base URL of the GDC API (e.g. a local mock_gdc.py)', default=ENDPOINT)
 	ap.add_argument('-O', '--cases_out', help='file to save case query results to', default=None)
 
-	ap.add_argument('-N', '--num_cases', help='maximum number of cases to query for', default=50)
-	ap.add_argument('-p', '--primary', help='primary site of the case', default='Skin')
+	ap.add_argument('-J', '--cases_jsonl', help='file to stream case hits to as JSON Lines', default=None)
+
+	ap.add_argument('-N', '--num_cases', help='maximum number of cases to query for', type=int, default=50)
+	ap.add_argument('-a', '--all_cases', help='page through every matching case, ignoring -N', action='store_true')
+	ap.add_argument('-P', '--page_size', help='cases per request when paging', type=int, default=CASES_PAGE_SIZE)
+	ap.add_argument('-p', '--primary', help='primary site(s) of the case, comma separated, or "all"', default='Skin')
 
 	ap.add_argument('-x', '--no_files', help='exit without querying slide files', action='store_true')
 	ap.add_argument('-n', '--num_slides', help='maximum number of slides to query for', default=None)
 	ap.add_argument('-o', '--slides_out', help='file to save slide query results to', default='slides_out.json')
-	ap.add_argument('-s', '--slides_in', help='file containing slide query results', default=None)
+	ap.add_argument('-T', '--table_dir', help='directory to write the columnar patients/slides tables to',
+					default='cohort')
+	ap.add_argument('--table_format', help='format of the columnar tables', choices=['parquet', 'feather'],
+					default='parquet')
+
+	ap.add_argument('--cache-dir', help='directory to cache API responses in, reused by later runs', default=None)
+	ap.add_argument('--cache-ttl', help='days before a cached response is refetched', type=float,
+					default=DEFAULT_TTL / 86400)
+	ap.add_argument('--offline', help='answer every query from --cache-dir, failing on anything not cached',
+					action='store_true')
 
 	return ap.parse_args()
 
 
-def get_cases(args):
-	if args.cases:
-		with open(args.cases) as f:
-			return json.load(f)
+def case_filters(primary):
+	filters = copy.deepcopy(CASE_FILTERS)
+	if primary == 'all':
+		filters['content'] = filters['content'][1:]
 	else:
-		CASE_FILTERS['content'][0]['content']['value'] = [args.primary]
+		filters['content'][0]['content']['value'] = primary.split(',')
+	return filters
 
-		params = {
-				'filters': json.dumps(CASE_FILTERS),
-				'fields': ','.join(CASE_FIELDS),
-				'format': 'JSON',
-				'size': args.num_cases
-		}
 
-		response = requests.get(CASES_ENDPOINT, params=params)
+def iter_cases(primary, max_cases=None, page_size=CASES_PAGE_SIZE, endpoint=CASES_ENDPOINT, info=None):
+	# yields case hits as their pages arrive: the first page gives pagination.total, then the remaining pages are
+	# fetched concurrently, so hits come out in no particular order. info, if given, is filled in with the
+	# 'total' number of cases being fetched and any 'warnings' from the API
+	if max_cases is not None:
+		page_size = min(page_size, max_cases)
+
+	params = {
+			'filters': json.dumps(case_filters(primary)),
+			'fields': ','.join(CASE_FIELDS),
+			'format': 'JSON',
+	}
+
+	def fetch(page):
+		offset, size = page
+		return default_client().get_json(endpoint, params=dict(params, size=size, **{'from': offset}))
+
+	first = fetch((0, page_size))
+	total = first['data']['pagination']['total']
+	if max_cases is not None:
+		total = min(total, max_cases)
+	if info is not None:
+		info['total'] = total
+		info['warnings'] = first.get('warnings')
+
+	yield from first['data']['hits'][:total]
 
-		return json.loads(response.content.decode('utf8'))
+	pages = [(offset, min(page_size, total - offset)) for offset in range(page_size, total, page_size)]
+	for result in default_client().imap_unordered(fetch, pages):
+		yield from result['data']['hits']
 
 
-def slide_to_files(slide_id):
+def write_jsonl(hits, path):
+	# passes hits through while appending each to path as one JSON line; the file is line buffered so that
+	# downstream stages reading it can start before the query finishes
+	with open(path, 'w', buffering=1) as f:
+		for hit in hits:
+			f.write(json.dumps(hit) + '\n')
+			yield hit
+
+
+def read_jsonl(path):
+	with open(path) as f:
+		for line in f:
+			if line.strip():
+				yield json.loads(line)
+
+
+def print_cache_stats(cache):
+	if cache is not None:
+		stats = cache.stats
+		print('cache: %i hits (%i past their TTL), %i misses' % (stats['hits'] + stats['stale'], stats['stale'],
+																 stats['misses']))
+
+
+def slide_to_files(slide_id, endpoint=FILES_ENDPOINT):
 	filter = {
 			'op': 'and',
 			'content': [
@@ -210,16 +279,102 @@ def slide_to_files(slide_id):
 			'size': 100
 	}
 
-	response = requests.get(FILES_ENDPOINT, params=params)
+	return default_client().get_json(endpoint, params=params)
+
+
+def linked_slide_ids(file_hit):
+	for case in file_hit.get('cases', []):
+		for sample in case.get('samples', []):
+			for portion in sample.get('portions', []):
+				for slide in portion.get('slides', []):
+					yield slide['slide_id']
+
+
+def slide_batch_to_files(slide_ids, page_size=FILES_PAGE_SIZE, endpoint=FILES_ENDPOINT):
+	filter = {
+			'op': 'and',
+			'content': [
+					{
+							'op': 'in',
+							'content': {
+									'field': SLIDE_ID_FIELD,
+									'value': slide_ids
+							}
+					},
+					{
+							'op': '=',
+							'content': {
+									'field': 'data_format',
+									'value': 'SVS'
+							}
+					},
+			]
+	}
+
+	hits = []
+	while True:
+		params = {
+				'filters': filter,
+				'fields': ','.join(FILE_FIELDS + [SLIDE_ID_FIELD]),
+				'format': 'JSON',
+				'size': page_size,
+				'from': len(hits)
+		}
+
+		result = default_client().post_json(endpoint, params)['data']
+		hits += result['hits']
+		if not result['hits'] or len(hits) >= result['pagination']['total']:
+			return hits
+
 
-	return json.loads(response.content.decode('utf8'))
+def slides_to_files(slide_ids, batch_size=SLIDES_PER_REQUEST, page_size=FILES_PAGE_SIZE, endpoint=FILES_ENDPOINT):
+	# batched version of slide_to_files: returns {slide_id: file hits}, i.e. what slide_to_files(slide_id)['data']['hits']
+	# gives for each slide, using one request per batch_size slides (plus extra pages if a batch has more files).
+	# batches are fetched concurrently on the shared client. a file linked to slides in two batches comes back in
+	# both, so hits are keyed on file_id per slide and each file is listed once
+	slides = {slide_id: {} for slide_id in slide_ids}
+	ids = sorted(slides)  # stable batches whatever order the cases arrived in, so cached responses are reused
+	batches = [ids[start:start + batch_size] for start in range(0, len(ids), batch_size)]
+
+	for hits in default_client().map(lambda batch: slide_batch_to_files(batch, page_size, endpoint), batches):
+		for file_hit in hits:
+			# the linking field is only requested for regrouping, drop it so hits look like slide_to_files ones
+			linked = set(linked_slide_ids(file_hit))
+			file_hit.pop('cases', None)
+			for slide_id in linked:
+				if slide_id in slides:
+					slides[slide_id].setdefault(file_hit['file_id'], file_hit)
+
+	return {slide_id: list(files.values()) for slide_id, files in slides.items()}
 
 
 if __name__ == '__main__':
 	args = process_args()
 	# print(args)
 
-	cases = get_cases(args)
+	if args.offline and not args.cache_dir:
+		sys.exit('--offline needs a --cache-dir to read responses from')
+	cache = ResponseCache(args.cache_dir, ttl=args.cache_ttl * 86400) if args.cache_dir else None
+	set_default_client(GDCClient(cache=cache, offline=args.offline))
+
+	info = {}
+	hits = iter_cases(args.primary, None if args.all_cases else args.num_cases, args.page_size,
+					  endpoint=args.endpoint + 'cases', info=info)
+	if args.cases_jsonl:
+		hits = write_jsonl(hits, args.cases_jsonl)
+	# hits are counted as they stream in, and only kept in memory if something below needs them
+	keep = not args.no_files or args.cases_out
+	case_hits = []
+	all_slides = []
+	num_cases = 0
+	for hit in hits:
+		num_cases += 1
+		if keep:
+			case_hits.append(hit)
+		all_slides += hit.get('slide_ids', [])
+		print('\r%i/%i cases' % (num_cases, info['total']), end='', flush=True)
+	print()
+	cases = {'data': {'hits': case_hits}, 'warnings': info['warnings']}
 	if args.cases_out:
 		with open(args.cases_out, 'w') as f:
 			print(json.dumps(cases, indent=2), file=f)
@@ -228,168 +383,42 @@ if __name__ == '__main__':
 		print('NB: warnings returned:')
 		print(cases['warnings'])
 
-	print('%i cases returned' % len(cases['data']['hits']))
-
-	all_slides = []
-	for hit in cases['data']['hits']:
-		all_slides += hit['slide_ids']
-
+	print('%i cases returned' % num_cases)
 	print('%i total slides' % len(all_slides))
 
 	if args.no_files:
 		print('exiting without query slide files')
+		print_cache_stats(cache)
 		sys.exit(0)
 
 	print('querying slide files')
 
+	slide_files = slides_to_files(all_slides, endpoint=args.endpoint + 'files')
 	for hit in cases['data']['hits']:
-		print('#', end='', flush=True)
-		slides = {}
-		for slide in hit['slide_ids']:
-			print('.', end='', flush=True)
-			slides[slide] = slide_to_files(slide)['data']['hits']
-
-		hit['slides'] = slides
+		hit['slides'] = {slide: slide_files[slide] for slide in hit['slide_ids']}
 
-	print()
 	outputFile = args.slides_out
 	with open(outputFile, 'w') as f:
 		print(json.dumps(cases, indent=2), file=f)
 
-	f = open(outputFile, )
-	output = json.load(f)
-
-	alive = 0
-	dead = 0
-	numberOfSlides = 0
-	agesAtDiagnosis = []
-	timeTillDeath = []
-	dict_data = {"data": []}
-	mutation_genes_data = {"case_ids": []}
-	tempSlide = 0
-	totalSize = 0
-	for i in range(0, len(output["data"]["hits"])):  # constructing json
-		if "slide_ids" in output["data"]["hits"][i]:
-			for slide_ids in output["data"]["hits"][i]["slide_ids"]:
-				mutation_genes_data["case_ids"].append(slide_ids)
-		if "demographic" in output["data"]["hits"][i]:
-			if output["data"]["hits"][i]["demographic"]["vital_status"] == "Alive":
-				alive += 1
-			else:
-				dead += 1
-		for data in output["data"]["hits"][i]["samples"]:
-			patient = {}
-			death_years = 0
-			alive_years = 0
-			patient["patient_id"] = output["data"]["hits"][i]["id"]
-			if "slide_ids" in output["data"]["hits"][i]:
-				numberOfSlides += len(output["data"]["hits"][i]["slide_ids"])
-
-			if "demographic" in output["data"]["hits"][i]:
-				if output["data"]["hits"][i]["demographic"]["vital_status"] == "Alive":
-					patient["vital_status"] = "Alive"
-				else:
-					patient["vital_status"] = "Dead"
-				if "days_to_death" in output["data"]["hits"][i]["demographic"]:
-					if output["data"]["hits"][i]["demographic"]["days_to_death"] is not None:
-						death_years = (output["data"]["hits"][i]["demographic"]["days_to_death"] / 365)
-						timeTillDeath.append(death_years)
-						patient["years_to_death"] = death_years
-
-			if "diagnoses" in output["data"]["hits"][i]:
-				if "days_to_last_follow_up" in output["data"]["hits"][i]["diagnoses"][0]:
-					if output["data"]["hits"][i]["diagnoses"][0]["days_to_last_follow_up"] is not None:
-						alive_years = (output["data"]["hits"][i]["diagnoses"][0]["days_to_last_follow_up"] / 365)
-						patient["years_to_last_follow_up"] = alive_years
-				if "age_at_diagnosis" in output["data"]["hits"][i]["diagnoses"][0]:
-					if output["data"]["hits"][i]["diagnoses"][0]["age_at_diagnosis"] is not None:
-						agesAtDiagnosis.append((output["data"]["hits"][i]["diagnoses"][0]["age_at_diagnosis"] / 365))
-						patient["age_at_diagnosis"] = (
-								output["data"]["hits"][i]["diagnoses"][0]["age_at_diagnosis"] / 365)
-				if "year_of_diagnosis" in output["data"]["hits"][i]["diagnoses"][0]:
-					patient["year_of_diagnosis"] = output["data"]["hits"][i]["diagnoses"][0]["year_of_diagnosis"]
-				if "tumor_stage" in output["data"]["hits"][i]["diagnoses"][0]:
-					patient["tumor_stage"] = output["data"]["hits"][i]["diagnoses"][0]["tumor_stage"]
-				if "tissue_or_organ_of_origin" in output["data"]["hits"][i]["diagnoses"][0]:
-					patient["tissue_or_organ_of_origin"] = output["data"]["hits"][i]["diagnoses"][0][
-						"tissue_or_organ_of_origin"]
-				if "site_of_resection_or_biopsy" in output["data"]["hits"][i]["diagnoses"][0]:
-					site = output["data"]["hits"][i]["diagnoses"][0]["site_of_resection_or_biopsy"]
-					patient["site_of_resection_or_biopsy"] = site
-					if "lymph" in site.lower():
-						patient["biopsy_tissue_type"] = "Lymph"
-					elif "skin" in site.lower():
-						patient["biopsy_tissue_type"] = "Skin"
-					else:
-						patient["biopsy_tissue_type"] = "N/A"
-				if "prior_malignancy" in output["data"]["hits"][i]["diagnoses"][0]:
-					patient["prior_malignancy"] = output["data"]["hits"][i]["diagnoses"][0]["prior_malignancy"]
-				if "primary_diagnosis" in output["data"]["hits"][i]["diagnoses"][0]:
-					patient["primary_diagnosis"] = output["data"]["hits"][i]["diagnoses"][0]["primary_diagnosis"]
-			patient["years_survived"] = max(death_years, alive_years)
-			# if "days_to_recurrence" in output["data"]["hits"][i]["diagnoses"][0]:
-			#     if output["data"]["hits"][i]["diagnoses"][0]["days_to_recurrence"] is not None:
-			#         patient["years_to_recurrence"] = (output["data"]["hits"][i]["diagnoses"][0]["days_to_recurrence"] / 365)
-			sample = data["portions"][0]["slides"][0]
-			patient["slides"] = {}
-			currentSlideID = sample["slide_id"]
-			patient["slides"]["slide_id"] = currentSlideID
-			if "slides" in output["data"]["hits"][i]:
-				slideData = output["data"]["hits"][i]["slides"][currentSlideID]
-				if len(slideData) >= 1:
-					if "file_id" in slideData[0]:
-						fileID = slideData[0]["file_id"]
-						patient["slides"]["file_id"] = fileID
-					if "file_size" in slideData[0]:
-						fileSize = slideData[0]["file_size"]
-						patient["slides"]["file_size"] = fileSize
-						totalSize += fileSize
-			if "case_id" in output["data"]["hits"][i]:
-				patient["slides"]["case_id"] = output["data"]["hits"][i]["case_id"]
-			if "percent_stromal_cells" in sample:
-				patient["slides"]["percent_stromal_cells"] = sample["percent_stromal_cells"]
-			if "section_location" in sample:
-				patient["slides"]["section_location"] = sample["section_location"]
-			if "percent_tumor_cells" in sample:
-				patient["slides"]["percent_tumor_cells"] = sample["percent_tumor_cells"]
-			if "percent_neutrophil_infiltration" in sample:
-				patient["slides"]["percent_neutrophil_infiltration"] = sample["percent_neutrophil_infiltration"]
-			if "percent_lymphocyte_infiltration" in sample:
-				patient["slides"]["percent_lymphocyte_infiltration"] = sample["percent_lymphocyte_infiltration"]
-			if "percent_necrosis" in sample:
-				patient["slides"]["percent_necrosis"] = sample["percent_necrosis"]
-			if "percent_normal_cells" in sample:
-				patient["slides"]["percent_normal_cells"] = sample["percent_normal_cells"]
-			if "percent_monocyte_infiltration" in sample:
-				patient["slides"]["percent_monocyte_infiltration"] = sample["percent_monocyte_infiltration"]
-			if "percent_tumor_nuclei" in sample:
-				patient["slides"]["percent_tumor_nuclei"] = sample["percent_tumor_nuclei"]
-			if "submitter_id" in sample:
-				patient["slides"]["submitter_id"] = sample["submitter_id"]
-			codes = (sample["submitter_id"]).split("-", )
-			if codes[0] == "TCGA":
-				sampleCode = (codes[3][0:2])
-				patient["slides"]["SampleCode"] = sampleCode
-				if sampleCode == "01":
-					patient["slides"]["sample_type"] = "Primary Solid Tumor"
-				if sampleCode == "06":
-					patient["slides"]["sample_type"] = "Metastatic"
-				if sampleCode == "07":
-					patient["slides"]["sample_type"] = "Additional Metastatic"
-				if sampleCode == "11":
-					patient["slides"]["sample_type"] = "Solid Tissue Normal"
-			dict_data["data"].append(patient)
-
-	if len(agesAtDiagnosis) > 0:  # print stats
-		print("Alive: " + str(alive) + ", Dead: " + str(dead))
-		print("Median age is: " + str(statistics.median(agesAtDiagnosis)))
-		q3, q1 = np.percentile(agesAtDiagnosis, [75, 25])
-		iqr = q3 - q1
-		print("IQR age is: " + str(iqr))
-	if len(timeTillDeath) > 0:
-		print("Median age till death is: " + str(statistics.median(timeTillDeath)))
-	print(totalSize)
-	# print(mutation_genes_data)
+	records, slide_ids = flatten_hits(cases['data']['hits'])
+	dict_data = {"data": records}
+	mutation_genes_data = {"case_ids": slide_ids}
+
+	patients, slides = records_to_tables(records)
+	cohort = cohort_frame(patients.to_pandas(), slides.to_pandas())
+	summary = cohort_summary(cohort)
+
+	if pd.notna(summary['median_age']):  # print stats, unless there are no ages
+		print("Alive: " + str(summary['alive']) + ", Dead: " + str(summary['dead']))
+		print("Median age is: " + str(summary['median_age']))
+		print("IQR age is: " + str(summary['iqr_age']))
+	if pd.notna(summary['median_years_to_death']):
+		print("Median age till death is: " + str(summary['median_years_to_death']))
+	print(summary['total_file_size'])
+	for by in ['biopsy_tissue_type', 'sample_type', 'tumor_stage']:
+		print(grouped_summary(cohort, by).to_string())
+	print_cache_stats(cache)
 
 	with open("reconstructedData.json", 'w') as new_:  # put data in json
 		print(json.dumps(dict_data, indent=2), file=new_)
@@ -397,6 +426,4 @@ if __name__ == '__main__':
 	with open("case_ids.json", 'w') as case_ids_:  # put slide IDs in json
 		print(json.dumps(mutation_genes_data, indent=2), file=case_ids_)
 
-	f.close()
-	new_.close()
-	case_ids_.close()
+	write_tables(patients, slides, args.table_dir, args.table_format)  # typed, columnar copy of reconstructedData.json
@@ -0,0 +1,104 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+# on-disk cache of GDC API responses, so re-running a query only hits the network for requests it has not seen.
+# Entries are keyed on a hash of the endpoint and the request parameters (filters, fields, size, from, ...), expire
+# after `ttl` seconds, and the least recently used ones are evicted once the cache grows past `max_bytes`. Offline,
+# expired entries are still answered (and kept), since there is nothing to replace them with.
+#
+#   cache = ResponseCache(".gdc_cache")
+#   client = GDCClient(cache=cache)
+
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3
+
+
+class OfflineCacheMiss(LookupError):
+    pass
+
+
+def _canonical(params):
+    # the same query can arrive with filters as a JSON string or an object and fields in any order
+    canonical = dict(params or {})
+    if isinstance(canonical.get("filters"), str):
+        canonical["filters"] = json.loads(canonical["filters"])
+    if isinstance(canonical.get("fields"), str):
+        canonical["fields"] = sorted(canonical["fields"].split(","))
+    for key in ("size", "from"):
+        if key in canonical:
+            canonical[key] = int(canonical[key])
+    return canonical
+
+
+def cache_key(endpoint, params):
+    text = json.dumps({"endpoint": endpoint, "params": _canonical(params)}, sort_keys=True)
+    return hashlib.sha256(text.encode("utf8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, directory, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "responses.sqlite")
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.stats = {"hits": 0, "stale": 0, "misses": 0, "evictions": 0}
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, endpoint TEXT, body BLOB, "
+                         "size INTEGER, created REAL, accessed REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self._db.commit()
+
+    def get(self, endpoint, params, allow_stale=False):
+        """The cached JSON response for this request, or None if there is no live entry. With allow_stale an expired
+        entry is returned rather than deleted."""
+        key = cache_key(endpoint, params)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute("SELECT body, created FROM responses WHERE key = ?", (key,)).fetchone()
+            expired = row is not None and now - row[1] > self.ttl
+            if row is None or (expired and not allow_stale):
+                if row is not None:
+                    self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                    self._db.commit()
+                self.stats["misses"] += 1
+                return None
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self._db.commit()
+            self.stats["stale" if expired else "hits"] += 1
+        return json.loads(zlib.decompress(row[0]).decode("utf8"))
+
+    def put(self, endpoint, params, response):
+        body = zlib.compress(json.dumps(response).encode("utf8"))
+        now = time.time()
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                             (cache_key(endpoint, params), endpoint, body, len(body), now, now))
+            self._evict()
+            self._db.commit()
+
+    def _evict(self):
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.stats["evictions"] += 1
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear_expired(self):
+        with self._lock:
+            self._db.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.close()
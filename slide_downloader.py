@@ -0,0 +1,243 @@
+import hashlib
+import json
+import os
+import threading
+from concurrent import futures
+
+import requests
+
+from gdc_client import default_client
+
+# resumable downloads of GDC data files. Each file is fetched as a few byte ranges on parallel connections into
+# <file_id>.svs.part, with the bytes done so far in each range kept in a sidecar <file_id>.svs.part.json; a download
+# that is interrupted (or a whole run that is killed) picks up from there instead of from byte zero. A finished file
+# is checked against the md5sum from GDC metadata, renamed to <file_id>.svs and added to manifest.jsonl, and files
+# in the manifest are not downloaded again. With skip_if_recorded, files in the manifest are skipped even once they
+# are gone from disk, for scripts that delete each slide when they are done with it.
+#
+#   downloader = SlideDownloader("slides")
+#   path = downloader.download(file_id, size=file_size, md5=md5sum)
+#   downloader.download_many([(file_id, file_size, md5sum), ...], workers=4)
+
+DATA_ENDPOINT = "https://api.gdc.cancer.gov/data/"
+SEGMENTS = 4  # connections per file
+MIN_SEGMENT = 16 * 1024 * 1024  # files smaller than SEGMENTS of these use fewer connections
+CHUNK = 1024 * 1024  # bytes read per write; the sidecar is updated after each
+RETRIES = 5  # times a segment is resumed after its connection drops
+MANIFEST = "manifest.jsonl"
+SUFFIX = ".svs"
+
+
+class ChecksumError(ValueError):
+    pass
+
+
+def file_md5(path, chunk_size=8 * CHUNK):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+def split(size, segments=SEGMENTS, min_segment=MIN_SEGMENT):
+    """[start, end, next byte to fetch] of each segment of a file of size bytes."""
+    count = max(1, min(segments, size // min_segment))
+    bounds = [size * n // count for n in range(count + 1)]
+    return [[start, end, start] for start, end in zip(bounds, bounds[1:])]
+
+
+class _State:
+    """The sidecar of a partial download, rewritten (atomically) as its segments advance."""
+
+    def __init__(self, path, state):
+        self.path = path
+        self.state = state
+        self.lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(path, json.load(f))
+
+    def advance(self, segment, offset):
+        with self.lock:
+            self.state["segments"][segment][2] = offset
+            self.save()
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.state, f)
+        os.replace(self.path + ".tmp", self.path)
+
+
+class SlideDownloader:
+    def __init__(self, directory, endpoint=DATA_ENDPOINT, client=None, segments=SEGMENTS, min_segment=MIN_SEGMENT,
+                 manifest=MANIFEST, retries=RETRIES, skip_if_recorded=False):
+        self.directory = directory
+        self.endpoint = endpoint
+        self.client = client if client is not None else default_client()
+        self.segments = segments
+        self.min_segment = min_segment
+        self.retries = retries
+        self.skip_if_recorded = skip_if_recorded
+        self.manifest_path = os.path.join(directory, manifest) if manifest else None
+        self.lock = threading.Lock()
+        self.stats = {"downloaded": 0, "skipped": 0, "resumed": 0, "bytes": 0, "reconnects": 0}
+        self.completed = self._read_manifest()
+
+    def _read_manifest(self):
+        if self.manifest_path is None or not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path) as f:
+            entries = [json.loads(line) for line in f if line.strip()]
+        return {entry["file_id"]: entry for entry in entries}
+
+    def _record(self, file_id, size, md5):
+        entry = {"file_id": file_id, "size": size, "md5sum": md5}
+        with self.lock:
+            self.completed[file_id] = entry
+            if self.manifest_path is not None:
+                with open(self.manifest_path, "a") as f:
+                    f.write(json.dumps(entry) + "\n")
+
+    def _count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def path(self, file_id):
+        return os.path.join(self.directory, file_id + SUFFIX)
+
+    def _probe(self, file_id):
+        # (size, whether the server takes Range requests) from the first byte of the file
+        with self.client.get(self.endpoint + file_id, headers={"Range": "bytes=0-0"}, stream=True) as response:
+            if response.status_code == 206:
+                return int(response.headers["Content-Range"].rpartition("/")[2]), True
+            return int(response.headers["Content-Length"]), False
+
+    def _start(self, file_id, size, md5):
+        total, ranges = self._probe(file_id)
+        if size is not None and size != total:
+            raise ValueError(f"{file_id}: server has {total} bytes, metadata says {size}")
+        part = self.path(file_id) + ".part"
+        os.makedirs(self.directory, exist_ok=True)
+        with open(part, "wb") as f:
+            f.truncate(total)
+        segments = split(total, self.segments, self.min_segment) if ranges else [[0, total, 0]]
+        state = _State(part + ".json", {"file_id": file_id, "size": total, "md5sum": md5, "ranges": ranges,
+                                        "segments": segments})
+        state.save()
+        return state
+
+    def _fetch(self, file_id, part, state, segment):
+        start, end, offset = state.state["segments"][segment]
+        attempt = 0
+        while offset < end:
+            if not state.state["ranges"]:
+                offset = 0  # no way to resume without ranges; start the whole file again
+            headers = {"Range": f"bytes={offset}-{end - 1}"} if state.state["ranges"] else {}
+            try:
+                with self.client.get(self.endpoint + file_id, headers=headers, stream=True) as response, \
+                        open(part, "r+b") as f:
+                    f.seek(offset)
+                    for chunk in response.iter_content(CHUNK):
+                        chunk = chunk[:end - offset]
+                        f.write(chunk)
+                        f.flush()
+                        offset += len(chunk)
+                        self._count("bytes", len(chunk))
+                        state.advance(segment, offset)
+                        if offset >= end:
+                            break
+                if offset < end:
+                    raise requests.ConnectionError(f"{file_id}: connection closed at byte {offset} of {end}")
+            except (requests.ConnectionError, requests.exceptions.ChunkedEncodingError):
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                self._count("reconnects")
+
+    def download(self, file_id, size=None, md5=None):
+        """Path of the downloaded file, fetching whatever is not already on disk. size and md5 are from metadata
+        (file_size and md5sum) and are checked when given; a file that fails its checksum is deleted. With
+        skip_if_recorded, the path of a file in the manifest is returned whether or not it is still there."""
+        path = self.path(file_id)
+        if file_id in self.completed and (self.skip_if_recorded or os.path.exists(path)):
+            self._count("skipped")
+            return path
+        part = path + ".part"
+        if os.path.exists(part + ".json") and os.path.exists(part):
+            state = _State.load(part + ".json")
+            self._count("resumed")
+        else:
+            state = self._start(file_id, size, md5)
+        segments = range(len(state.state["segments"]))
+        with futures.ThreadPoolExecutor(max_workers=len(segments)) as executor:
+            for future in [executor.submit(self._fetch, file_id, part, state, segment) for segment in segments]:
+                future.result()
+
+        md5 = md5 or state.state.get("md5sum")
+        actual = file_md5(part)
+        if md5 is not None and actual != md5:
+            self.discard(file_id)
+            raise ChecksumError(f"{file_id}: md5 {actual}, expected {md5}")
+        os.replace(part, path)
+        os.remove(part + ".json")
+        self._record(file_id, state.state["size"], actual)
+        self._count("downloaded")
+        return path
+
+    def discard(self, file_id):
+        """Delete a partial download and its sidecar."""
+        part = self.path(file_id) + ".part"
+        for leftover in [part, part + ".json", part + ".json.tmp"]:
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    def download_many(self, files, workers=4, progress=None):
+        """Download every (file_id, size, md5) of files, workers files at a time. Returns {file_id: exception} for the
+        files that failed; the others are in the manifest."""
+        failed = {}
+        with futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            jobs = {executor.submit(self.download, *file): file[0] for file in files}
+            for future in futures.as_completed(jobs):
+                if future.exception() is not None:
+                    failed[jobs[future]] = future.exception()
+                if progress is not None:
+                    progress(jobs[future])
+        return failed
+
+
+def slide_files(store):
+    """(file_id, file_size, md5sum) of every slide in a metadata_store.MetadataStore."""
+    files = []
+    for record in store.records():
+        slide = record["slides"]
+        if "file_id" in slide:
+            files.append((slide["file_id"], slide.get("file_size"), slide.get("md5sum")))
+    return files
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from tqdm import tqdm
+
+    from metadata_store import MetadataStore
+
+    ap = argparse.ArgumentParser(description="Download every slide in reconstructedData.json, resuming partial "
+                                             "downloads and skipping the ones already in the manifest.")
+    ap.add_argument("-d", "--directory", default="slides")
+    ap.add_argument("-i", "--input", default="reconstructedData.json")
+    ap.add_argument("-w", "--workers", type=int, default=4, help="files downloaded at once")
+    ap.add_argument("-s", "--segments", type=int, default=SEGMENTS, help="connections per file")
+    args = ap.parse_args()
+
+    files = slide_files(MetadataStore(args.input))
+    downloader = SlideDownloader(args.directory, segments=args.segments)
+    pbar = tqdm(total=len(files))
+    failed = downloader.download_many(files, args.workers, progress=lambda file_id: pbar.update(1))
+    pbar.close()
+    for file_id, error in failed.items():
+        print(f"{file_id} failed: {error}")
+    print(downloader.stats)
@@ -0,0 +1,311 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from embedding_cache import tile_ids
+from tile_dataset import tile_dataset
+
+# slide-level predictions from tile predictions. Labels belong to patients (years_survived <= 3 is early), so the
+# tiles of a slide are streamed through the backbone and head in large batches and their scores pooled into one
+# score per slide: the mean, the mean of the top k, or an attention-weighted mean with weights from a small gated
+# attention network over the tile embeddings (trained on slides with train_attention). Tiles already in an
+# embedding cache skip the backbone. With early stopping a slide stops being scored as soon as no scores for its
+# remaining tiles could move the pooled score across the threshold (mean and top-k only; attention weights are
+# unbounded, so an unseen tile can always change the outcome).
+#
+#   scorer = SlideScorer(inception_backbone(299), keras.models.load_model("head.keras"), 299)
+#   predictions = scorer.score_slides(index[index.split == "validation"], pooling="topk")
+#   slide_metrics(predictions)
+#
+#   python slide_inference.py /tmp/GCDData/ head.keras -t lymph -p topk --metadata reconstructedData.json
+
+POOLING = ["mean", "topk", "attention"]
+BATCH_SIZE = 256
+TOP_K = 16
+THRESHOLD = 0.5  # pooled scores above it are late (label 1)
+
+
+def slide_ids(index):
+    """The slide (GDC file_id) of each row of a tile index: tiles are <file_id>_<n>.<ext>, tile stores are the
+    shards of a <file_id> directory."""
+    return np.array([os.path.basename(os.path.dirname(path)) if row >= 0 else
+                     os.path.basename(path).rsplit("_", 1)[0] for path, row in zip(index["path"], index["row"])],
+                    dtype=object)
+
+
+def mean_pool(scores):
+    return float(np.mean(scores))
+
+
+def top_k_pool(scores, k=TOP_K):
+    k = min(k, len(scores))
+    return float(np.mean(np.partition(scores, len(scores) - k)[len(scores) - k:]))
+
+
+def attention_pool(scores, logits):
+    weights = np.exp(logits - np.max(logits))
+    return float(np.sum(weights * scores) / np.sum(weights))
+
+
+def pooled_bounds(pooling, scores, remaining, k=TOP_K):
+    """Lowest and highest pooled score a slide can still end up with, given the scores seen so far and the number
+    of tiles not scored yet (each with a score in [0, 1])."""
+    if pooling == "mean":
+        total, n = float(np.sum(scores)), len(scores) + remaining
+        return total / n, (total + remaining) / n
+    if pooling == "topk":
+        k = min(k, len(scores) + remaining)
+        top = np.sort(scores)[::-1][:k]
+        ones = min(remaining, k)
+        return float(np.sum(top)) / k, (ones + float(np.sum(top[:k - ones]))) / k
+    return 0.0, 1.0
+
+
+def attention_model(embedding_size, hidden=128):
+    """Gated attention (Ilse et al. 2018): one attention logit per tile embedding."""
+    inputs = tf.keras.Input(shape=(embedding_size,))
+    values = tf.keras.layers.Dense(hidden, activation="tanh")(inputs)
+    gates = tf.keras.layers.Dense(hidden, activation="sigmoid")(inputs)
+    logits = tf.keras.layers.Dense(1)(tf.keras.layers.Multiply()([values, gates]))
+    return tf.keras.Model(inputs, logits)
+
+
+def train_attention(attention, bags, epochs=20, learning_rate=1e-3, seed=0):
+    """Fit attention on slides, given as (tile embeddings, tile scores, slide label) bags, so that the
+    attention-weighted mean of the (fixed) tile scores predicts the slide label. Returns the loss per epoch."""
+    optimizer = tf.keras.optimizers.Adam(learning_rate)
+    loss_fn = tf.keras.losses.BinaryCrossentropy()
+    rng = np.random.default_rng(seed)
+
+    @tf.function(reduce_retracing=True)
+    def step(embeddings, scores, label):
+        with tf.GradientTape() as tape:
+            weights = tf.nn.softmax(tf.squeeze(attention(embeddings, training=True), -1))
+            loss = loss_fn([label], [tf.reduce_sum(weights * scores)])
+        optimizer.apply_gradients(zip(tape.gradient(loss, attention.trainable_variables),
+                                      attention.trainable_variables))
+        return loss
+
+    losses = []
+    for _ in range(epochs):
+        losses.append(float(np.mean([step(tf.constant(bags[i][0], tf.float32), tf.constant(bags[i][1], tf.float32),
+                                          tf.constant(float(bags[i][2]))) for i in rng.permutation(len(bags))])))
+    return losses
+
+
+class SlideScorer:
+    def __init__(self, backbone, head, image_size, batch_size=BATCH_SIZE, preprocess=None, attention=None,
+                 cache=None):
+        self.backbone = backbone
+        self.head = head
+        self.image_size = image_size
+        self.batch_size = batch_size
+        self.preprocess = preprocess
+        self.attention = attention
+        self.cache = cache  # an EmbeddingCache built with the same backbone, or None
+
+    def _batches(self, index, root_dir):
+        """(embeddings, tile scores, attention logits or None) in batches for the rows of a slide's tile index,
+        cached embeddings first."""
+        cached = np.zeros(len(index), dtype=bool)
+        if self.cache is not None:
+            ids = tile_ids(index, root_dir)
+            cached = np.array([tile_id in self.cache for tile_id in ids], dtype=bool)
+            for start in range(0, cached.sum(), self.batch_size):
+                yield self._score(self.cache.embeddings(ids[cached][start:start + self.batch_size]))
+        if not cached.all():
+            dataset = tile_dataset(index[~cached], batch_size=self.batch_size, image_size=self.image_size,
+                                   shuffle=False, preprocess=self.preprocess)
+            for images, _ in dataset:
+                yield self._score(np.asarray(self.backbone.predict_on_batch(images)))
+
+    def _score(self, embeddings):
+        scores = np.asarray(self.head.predict_on_batch(embeddings), dtype=np.float64).reshape(-1)
+        logits = None
+        if self.attention is not None:
+            logits = np.asarray(self.attention.predict_on_batch(embeddings), dtype=np.float64).reshape(-1)
+        return embeddings, scores, logits
+
+    def tile_scores(self, index, root_dir=None):
+        """Embeddings, tile scores and attention logits (None without an attention model) of every tile of
+        index."""
+        batches = list(self._batches(index, root_dir))
+        logits = np.concatenate([batch[2] for batch in batches]) if self.attention is not None else None
+        return np.concatenate([batch[0] for batch in batches]), np.concatenate([batch[1] for batch in batches]), logits
+
+    def score_slide(self, index, pooling="mean", k=TOP_K, threshold=THRESHOLD, early_stop=True, root_dir=None):
+        """Pooled score and prediction (1 late, 0 early) of one slide from the rows of its tile index, and how many of
+        its tiles were scored."""
+        if pooling not in POOLING:
+            raise ValueError(f"pooling must be one of {POOLING}, not {pooling!r}")
+        if pooling == "attention" and self.attention is None:
+            raise ValueError("attention pooling needs an attention model")
+        start = time.perf_counter()
+        scores, logits, stopped = [], [], False
+        seen = 0
+        for _, batch_scores, batch_logits in self._batches(index, root_dir):
+            scores.append(batch_scores)
+            logits.append(batch_logits)
+            seen += len(batch_scores)
+            if early_stop and pooling != "attention" and seen < len(index):
+                low, high = pooled_bounds(pooling, np.concatenate(scores), len(index) - seen, k)
+                if low > threshold or high <= threshold:
+                    stopped = True
+                    break
+        scores = np.concatenate(scores)
+        if pooling == "mean":
+            score = mean_pool(scores)
+        elif pooling == "topk":
+            score = top_k_pool(scores, k)
+        else:
+            score = attention_pool(scores, np.concatenate(logits))
+        # a slide that stopped early is decided by its bounds; its score is the pooled score of the tiles seen
+        prediction = int(low > threshold) if stopped else int(score > threshold)
+        return {"score": score, "prediction": prediction, "tiles": len(index), "tiles_scored": seen,
+                "stopped_early": stopped, "seconds": time.perf_counter() - start}
+
+    def score_slides(self, index, pooling="mean", k=TOP_K, threshold=THRESHOLD, early_stop=True, root_dir=None,
+                     progress=None):
+        """DataFrame with one row per slide of a tile index: slide_id, split, label, score, prediction, tiles,
+        tiles_scored, stopped_early and seconds."""
+        index = index.assign(slide_id=slide_ids(index))
+        rows = []
+        for slide_id, tiles in index.groupby("slide_id", sort=True):
+            result = self.score_slide(tiles, pooling, k, threshold, early_stop, root_dir)
+            rows.append({"slide_id": slide_id, "split": tiles["split"].iloc[0], "label": int(tiles["label"].iloc[0]),
+                         **result})
+            if progress is not None:
+                progress(slide_id, result)
+        columns = ["slide_id", "split", "label", "score", "prediction", "tiles", "tiles_scored", "stopped_early",
+                   "seconds"]
+        return pd.DataFrame(rows, columns=columns)
+
+
+def attention_bags(scorer, index, root_dir=None):
+    """(embeddings, tile scores, label) of every slide of a tile index, to train an attention model on."""
+    index = index.assign(slide_id=slide_ids(index))
+    bags = []
+    for _, tiles in index.groupby("slide_id", sort=True):
+        embeddings, scores, _ = scorer.tile_scores(tiles, root_dir)
+        bags.append((embeddings, scores, int(tiles["label"].iloc[0])))
+    return bags
+
+
+def roc_auc(labels, scores):
+    """Area under the ROC curve from ranks (ties count a half); nan with only one class."""
+    labels = np.asarray(labels, dtype=bool)
+    positives, negatives = labels.sum(), (~labels).sum()
+    if positives == 0 or negatives == 0:
+        return np.nan
+    ranks = pd.Series(scores).rank().to_numpy()
+    return float((ranks[labels].sum() - positives * (positives + 1) / 2) / (positives * negatives))
+
+
+def concordance_index(years_survived, scores, events=None):
+    """Harrell's C between slide scores and survival time: of the pairs where the shorter survival ended in death,
+    the fraction where the shorter survivor has the lower score (a higher score means late, i.e. longer)."""
+    times = np.asarray(years_survived, dtype=np.float64)
+    scores = np.asarray(scores, dtype=np.float64)
+    events = np.ones(len(times), dtype=bool) if events is None else np.asarray(events, dtype=bool)
+    known = ~np.isnan(times)
+    times, scores, events = times[known], scores[known], events[known]
+    comparable = (times[:, None] < times[None, :]) & events[:, None]
+    if not comparable.any():
+        return np.nan
+    concordant = (scores[:, None] < scores[None, :]) + 0.5 * (scores[:, None] == scores[None, :])
+    return float(concordant[comparable].sum() / comparable.sum())
+
+
+def slide_metrics(predictions):
+    """Slide-level metrics of score_slides' predictions, with c_index when they have years_survived (and
+    vital_status) columns."""
+    labels = predictions["label"].to_numpy()
+    scores = predictions["score"].to_numpy(dtype=np.float64)
+    predicted = predictions["prediction"].to_numpy() == 1
+    late, early = labels == 1, labels == 0
+    clipped = np.clip(scores, 1e-7, 1 - 1e-7)
+    metrics = {
+        "slides": len(predictions),
+        "accuracy": float(np.mean(predicted == late)) if len(labels) else np.nan,
+        "sensitivity": float(np.mean(predicted[late])) if late.any() else np.nan,  # late slides called late
+        "specificity": float(np.mean(~predicted[early])) if early.any() else np.nan,
+        "auc": roc_auc(late, scores),
+        "log_loss": float(-np.mean(late * np.log(clipped) + early * np.log(1 - clipped))) if len(labels) else np.nan,
+        "tiles_scored": float(predictions["tiles_scored"].sum() / max(predictions["tiles"].sum(), 1)),
+    }
+    if "years_survived" in predictions:
+        events = predictions["vital_status"].eq("Dead") if "vital_status" in predictions else None
+        metrics["c_index"] = concordance_index(predictions["years_survived"], scores, events)
+    return metrics
+
+
+def add_survival(predictions, store):
+    """predictions with years_survived and vital_status from a MetadataStore, by slide file_id."""
+    return predictions.assign(
+        years_survived=[store.field(slide_id, "years_survived") for slide_id in predictions["slide_id"]],
+        vital_status=[store.field(slide_id, "vital_status") for slide_id in predictions["slide_id"]])
+
+
+if __name__ == "__main__":
+    import argparse
+    import json
+
+    from tensorflow import keras
+
+    from embedding_cache import EmbeddingCache, inception_backbone
+    from tile_dataset import load_index
+
+    ap = argparse.ArgumentParser(description="Score slides by pooling their tile predictions.")
+    ap.add_argument("root_dir", help="directory with the <tissue>_<split>_dir/<label>/ tile trees")
+    ap.add_argument("head", help="the head saved by traindata.py")
+    ap.add_argument("-t", "--tissue", default="lymph")
+    ap.add_argument("-p", "--pooling", choices=POOLING, default="mean")
+    ap.add_argument("-k", "--top_k", type=int, default=TOP_K)
+    ap.add_argument("-s", "--split", default="validation", help="split to score, or 'all'")
+    ap.add_argument("-b", "--batch_size", type=int, default=BATCH_SIZE)
+    ap.add_argument("--image_size", type=int, default=299)
+    ap.add_argument("--threshold", type=float, default=THRESHOLD)
+    ap.add_argument("--no_early_stop", action="store_true")
+    ap.add_argument("--cache", help="embedding cache to reuse (default <root_dir>/<tissue>_embeddings.h5 if present)")
+    ap.add_argument("--attention", help="attention model for -p attention; trained on the train split and saved "
+                                        "here if it does not exist")
+    ap.add_argument("--metadata", help="reconstructedData.json, to add the concordance index")
+    ap.add_argument("-o", "--output", help="predictions CSV (default <root_dir>/<tissue>_slide_predictions.csv)")
+    args = ap.parse_args()
+
+    index = load_index(args.root_dir, args.tissue)
+    backbone = inception_backbone(args.image_size)
+    head = keras.models.load_model(args.head)
+    cache_path = args.cache or os.path.join(args.root_dir, f"{args.tissue}_embeddings.h5")
+    cache = EmbeddingCache(cache_path, backbone, args.image_size) if os.path.exists(cache_path) else None
+    scorer = SlideScorer(backbone, head, args.image_size, args.batch_size, cache=cache)
+
+    if args.pooling == "attention":
+        if not args.attention:
+            ap.error("-p attention needs --attention")
+        if os.path.exists(args.attention):
+            scorer.attention = keras.models.load_model(args.attention)
+        else:
+            bags = attention_bags(scorer, index[index.split == "train"], args.root_dir)
+            scorer.attention = attention_model(bags[0][0].shape[1])
+            losses = train_attention(scorer.attention, bags)
+            print(f"attention trained on {len(bags)} slides, loss {losses[0]:.3f} -> {losses[-1]:.3f}")
+            scorer.attention.save(args.attention)
+
+    scored = index if args.split == "all" else index[index.split == args.split]
+    predictions = scorer.score_slides(scored, args.pooling, args.top_k, args.threshold, not args.no_early_stop,
+                                      args.root_dir, progress=lambda slide_id, result: print(
+                                          f"{slide_id}: {result['score']:.3f} from {result['tiles_scored']} of "
+                                          f"{result['tiles']} tiles"))
+    if args.metadata:
+        from metadata_store import MetadataStore
+        predictions = add_survival(predictions, MetadataStore(args.metadata))
+    output = args.output or os.path.join(args.root_dir, f"{args.tissue}_slide_predictions.csv")
+    predictions.to_csv(output, index=False)
+    metrics = {split: slide_metrics(group) for split, group in predictions.groupby("split")}
+    with open(os.path.splitext(output)[0] + "_metrics.json", "w") as f:
+        json.dump(metrics, f, indent=1)
+    print(pd.DataFrame(metrics).to_string())
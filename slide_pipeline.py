@@ -0,0 +1,209 @@
+import os
+import queue
+import shutil
+import threading
+import time
+import traceback
+
+# download -> tile -> upload, as three stages with their own worker threads and bounded queues between them, so the
+# network, the CPUs and the upload link are all busy at once. Every slide on scratch disk (downloaded, or tiled and
+# waiting to be uploaded) counts against a disk budget, and downloads only start while the budget has room, so
+# scratch use stays bounded however far ahead downloading gets.
+#
+# The stages are plain functions of a job (anything, e.g. a file_id):
+#   download(job) -> path of the downloaded slide
+#   tile(job, slide_path) -> path of its tiles (a file or directory); the slide is deleted once it is tiled
+#   upload(job, tiles_path); the tiles are deleted once they are uploaded
+# and size(job) is the expected size of the download, reserved from the budget before it starts. A stage that fails
+# leaves its input on disk, still charged to the budget, so that a restart can resume the job from there; once those
+# leftovers would take up more than keep_failed of the budget, the input of a failed stage is deleted instead.
+#
+# For restarts, resume(job) can say a job is already part way through: ("tile", slide_path) or ("upload",
+# tiles_path) to pick it up at that stage with what is already on disk, or None to start from the download. record(job,
+# stage, seconds, error) is called after every stage, with error None when it succeeded, e.g. to keep a job_ledger.
+
+DEFAULT_DISK_BUDGET = 50 * 1024 ** 3
+QUEUE_SIZE = 2  # slides waiting between two stages
+KEEP_FAILED = 0.5  # fraction of the disk budget that the slides and tiles of failed stages may keep for a rerun
+STAGE_NAMES = ["download", "tile", "upload"]
+
+_DONE = object()
+
+
+def disk_usage(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path) if os.path.exists(path) else 0
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(path) for name in names)
+
+
+def remove(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path, ignore_errors=True)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+class DiskBudget:
+    """Bytes of scratch disk in use. acquire blocks until there is room (a slide larger than the whole budget still
+    goes through once nothing but kept leftovers is on disk); charge records bytes that are already on disk, and keep
+    turns charged bytes into leftovers of a failed stage, which stay charged for the rest of the run."""
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.used = 0
+        self.kept = 0
+        self.peak = 0
+        self.condition = threading.Condition()
+
+    def acquire(self, size):
+        with self.condition:
+            self.condition.wait_for(lambda: self.used <= self.kept or self.used + size <= self.budget)
+            self._add(size)
+
+    def keep(self, size, limit):
+        """Whether size more bytes of leftovers fit under limit; if so they are kept."""
+        with self.condition:
+            if self.kept + size > limit:
+                return False
+            self.kept += size
+            return True
+
+    def charge(self, size):
+        with self.condition:
+            self._add(size)
+
+    def settle(self, reserved, actual):
+        """Swap a reservation for the bytes that actually ended up on disk."""
+        with self.condition:
+            self._add(actual - reserved)
+            self.condition.notify_all()
+
+    def _add(self, size):
+        self.used += size
+        self.peak = max(self.peak, self.used)
+
+    def release(self, size):
+        with self.condition:
+            self.used -= size
+            self.condition.notify_all()
+
+
+class SlidePipeline:
+    def __init__(self, download, tile, upload, size=None, download_workers=4, tile_workers=2, upload_workers=2,
+                 disk_budget=DEFAULT_DISK_BUDGET, queue_size=QUEUE_SIZE, log=print, resume=None, record=None,
+                 keep_failed=KEEP_FAILED):
+        self.stages = {"download": download, "tile": tile, "upload": upload}
+        self.size = size or (lambda job: 0)
+        self.workers = {"download": download_workers, "tile": tile_workers, "upload": upload_workers}
+        self.budget = DiskBudget(disk_budget)
+        self.keep_limit = keep_failed * disk_budget
+        self.queue_size = queue_size
+        self.log = log
+        self.resume = resume or (lambda job: None)
+        self.record = record
+        self.stats = {stage: {"done": 0, "failed": 0, "seconds": 0.0} for stage in STAGE_NAMES}
+        self.lock = threading.Lock()
+
+    def _run_stage(self, stage, job, *args):
+        """(result of the stage, whether it succeeded)."""
+        start = time.perf_counter()
+        error = None
+        try:
+            result = self.stages[stage](job, *args)
+            outcome = "done"
+        except Exception as e:
+            self.log(f"{stage} failed for {job}:\n{traceback.format_exc()}")
+            result, outcome, error = None, "failed", e
+        seconds = time.perf_counter() - start
+        with self.lock:
+            self.stats[stage][outcome] += 1
+            self.stats[stage]["seconds"] += seconds
+        if self.record is not None:
+            self.record(job, stage, seconds, error)
+        return result, error is None
+
+    def _failed(self, path, size):
+        # left on disk and on the budget for resume to pick up next run, while the leftovers fit under keep_failed
+        if not self.budget.keep(size, self.keep_limit):
+            remove(path)
+            self.budget.release(size)
+
+    def _download(self, jobs, downloaded, tiled):
+        for job in iter(jobs.get, _DONE):
+            resumed = self.resume(job)
+            if resumed is not None:
+                # already on disk, so charged rather than reserved
+                stage, path = resumed
+                size = disk_usage(path)
+                self.budget.charge(size)
+                (downloaded if stage == "tile" else tiled).put((job, path, size))
+                continue
+            reserved = self.size(job)
+            self.budget.acquire(reserved)
+            path, ok = self._run_stage("download", job)
+            if not ok:
+                self.budget.release(reserved)
+                continue
+            actual = disk_usage(path)
+            self.budget.settle(reserved, actual)
+            downloaded.put((job, path, actual))
+
+    def _tile(self, downloaded, tiled):
+        for job, slide_path, slide_size in iter(downloaded.get, _DONE):
+            tiles_path, ok = self._run_stage("tile", job, slide_path)
+            if not ok:
+                self._failed(slide_path, slide_size)
+                continue
+            remove(slide_path)
+            tiles_size = disk_usage(tiles_path)
+            self.budget.charge(tiles_size)
+            tiled.put((job, tiles_path, tiles_size))
+            self.budget.release(slide_size)
+
+    def _upload(self, tiled):
+        for job, tiles_path, tiles_size in iter(tiled.get, _DONE):
+            _, ok = self._run_stage("upload", job, tiles_path)
+            if not ok:
+                self._failed(tiles_path, tiles_size)
+                continue
+            remove(tiles_path)
+            self.budget.release(tiles_size)
+
+    def run(self, jobs):
+        """Push every job through the three stages; returns per-stage stats, the peak disk use and wall time."""
+        start = time.perf_counter()
+        jobs_queue = queue.Queue()
+        downloaded = queue.Queue(self.queue_size)
+        tiled = queue.Queue(self.queue_size)
+        stages = [
+            ("download", self._download, (jobs_queue, downloaded, tiled), downloaded),
+            ("tile", self._tile, (downloaded, tiled), tiled),
+            ("upload", self._upload, (tiled,), None),
+        ]
+        for job in jobs:
+            jobs_queue.put(job)
+        for _ in range(self.workers["download"]):
+            jobs_queue.put(_DONE)
+        # each stage is started, then once all its threads are done the next stage is told it will get nothing more
+        threads = []
+        for stage, target, args, _ in stages:
+            threads.append([threading.Thread(target=target, args=args, name=f"{stage}-{n}", daemon=True)
+                            for n in range(self.workers[stage])])
+            for thread in threads[-1]:
+                thread.start()
+        for (stage, _, _, output), stage_threads in zip(stages, threads):
+            for thread in stage_threads:
+                thread.join()
+            if output is not None:
+                next_stage = STAGE_NAMES[STAGE_NAMES.index(stage) + 1]
+                for _ in range(self.workers[next_stage]):
+                    output.put(_DONE)
+        return dict(self.stats, peak_disk=self.budget.peak, kept_disk=self.budget.kept,
+                    wall=time.perf_counter() - start)
+
+
+def format_pipeline_stats(stats):
+    stages = ", ".join(f"{stage} {stats[stage]['done']} done/{stats[stage]['failed']} failed "
+                       f"({stats[stage]['seconds']:.1f}s busy)" for stage in STAGE_NAMES)
+    return (f"{stages}; peak scratch disk {stats['peak_disk'] / 1024 ** 3:.2f} GB, "
+            f"{stats['kept_disk'] / 1024 ** 3:.2f} GB left by failed stages; {stats['wall']:.1f}s")
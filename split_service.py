@@ -0,0 +1,131 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from cohort_stats import label_cohort
+
+# the train/validation split, decided once per patient for the whole cohort and kept in splits.json, so every tiler
+# and loader puts a slide in the same split (and all of a patient's slides in one split) with a dict lookup.
+# Patients are stratified by biopsy tissue type and survival label: within each stratum they are ordered by a hash of
+# (seed, patient_id) and the first VALIDATION_FRACTION of them go to validation. Patients missing from the file
+# (added to the cohort after it was written) fall back to the same hash, compared with the fraction directly.
+#
+#   splits = load_or_build("splits.json", MetadataStore("reconstructedData.json"))
+#   splits.file_split(file_id), splits.split(patient_id)   # "train" or "validation"
+#
+#   python split_service.py            # writes splits.json if there isn't one, and prints the split per stratum
+
+VALIDATION_FRACTION = 0.2
+SEED = "gdc-splits-v1"
+SPLITS = ["train", "validation"]
+DEFAULT_PATH = "splits.json"
+
+
+def patient_hash(patient_id, seed=SEED):
+    """A number in [0, 1) fixed by patient_id and seed."""
+    digest = hashlib.sha256(f"{seed}:{patient_id}".encode("utf8")).digest()
+    return int.from_bytes(digest[:8], "big") / 2 ** 64
+
+
+def cohort_records_frame(store):
+    """patient_id, file_id, biopsy_tissue_type and years_survived of every record in a MetadataStore."""
+    return pd.DataFrame([{"patient_id": record.get("patient_id"),
+                          "file_id": record.get("slides", {}).get("file_id"),
+                          "biopsy_tissue_type": record.get("biopsy_tissue_type"),
+                          "years_survived": record.get("years_survived")} for record in store.records()])
+
+
+def stratified_splits(df, validation_fraction=VALIDATION_FRACTION, seed=SEED):
+    """Split of each patient (a Series indexed by patient_id) of a frame of records with patient_id,
+    biopsy_tissue_type and years_survived. A patient is stratified by their most common (tissue type, survival
+    label) across their records."""
+    df = label_cohort(df[df["patient_id"].notna()])
+    strata = (df["biopsy_tissue_type"].astype(object).fillna("") + "/" +
+              df["survival_label"].astype(object).fillna(""))
+    patients = strata.groupby(df["patient_id"]).agg(lambda values: values.value_counts().index[0]).rename("stratum")
+    patients = patients.to_frame()
+    patients["hash"] = [patient_hash(patient_id, seed) for patient_id in patients.index]
+    rank = patients.groupby("stratum")["hash"].rank(method="first")
+    size = patients.groupby("stratum")["hash"].transform("size")
+    validation = rank <= np.round(size * validation_fraction)
+    return pd.Series(np.where(validation, "validation", "train"), index=patients.index, name="split")
+
+
+class Splits:
+    def __init__(self, patients, files, validation_fraction=VALIDATION_FRACTION, seed=SEED):
+        self.patients = patients  # patient_id -> split
+        self.files = files  # file_id -> split
+        self.validation_fraction = validation_fraction
+        self.seed = seed
+
+    @classmethod
+    def build(cls, df, validation_fraction=VALIDATION_FRACTION, seed=SEED):
+        patients = stratified_splits(df, validation_fraction, seed)
+        files = df[df["file_id"].notna() & df["patient_id"].notna()]
+        return cls(patients.to_dict(), dict(zip(files["file_id"], files["patient_id"].map(patients))),
+                   validation_fraction, seed)
+
+    def split(self, patient_id):
+        split = self.patients.get(patient_id)
+        if split is None:
+            return "validation" if patient_hash(patient_id, self.seed) < self.validation_fraction else "train"
+        return split
+
+    def file_split(self, file_id, patient_id=None):
+        """Split of a slide file; None for a file not in the splits unless its patient_id is given."""
+        split = self.files.get(file_id)
+        if split is None and patient_id is not None:
+            return self.split(patient_id)
+        return split
+
+    def save(self, path):
+        with open(path + ".tmp", "w") as f:
+            json.dump({"seed": self.seed, "validation_fraction": self.validation_fraction,
+                       "patients": self.patients, "files": self.files}, f, indent=1, sort_keys=True)
+        os.replace(path + ".tmp", path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            data = json.load(f)
+        return cls(data["patients"], data["files"], data["validation_fraction"], data["seed"])
+
+
+def load_or_build(path, store, validation_fraction=VALIDATION_FRACTION, seed=SEED):
+    """The splits in path, building them from the cohort in store (a MetadataStore) and writing them there first if
+    path does not exist yet."""
+    if os.path.exists(path):
+        return Splits.load(path)
+    splits = Splits.build(cohort_records_frame(store), validation_fraction, seed)
+    splits.save(path)
+    return splits
+
+
+def split_summary(df, splits):
+    """Records and patients per (tissue type, survival label, split)."""
+    df = label_cohort(df[df["patient_id"].notna()])
+    df = df.assign(split=df["patient_id"].map(splits.split))
+    groups = df.groupby(["biopsy_tissue_type", "survival_label", "split"], observed=True)
+    return pd.DataFrame({"records": groups.size(), "patients": groups["patient_id"].nunique()})
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from metadata_store import MetadataStore
+
+    ap = argparse.ArgumentParser(description="Write (once) and summarise the patient-level train/validation split.")
+    ap.add_argument("-i", "--input", default="reconstructedData.json")
+    ap.add_argument("-o", "--output", default=DEFAULT_PATH)
+    ap.add_argument("-v", "--validation_fraction", type=float, default=VALIDATION_FRACTION)
+    ap.add_argument("--rebuild", action="store_true", help="replace an existing splits file")
+    args = ap.parse_args()
+
+    if args.rebuild and os.path.exists(args.output):
+        os.remove(args.output)
+    store = MetadataStore(args.input)
+    splits = load_or_build(args.output, store, args.validation_fraction)
+    print(split_summary(cohort_records_frame(store), splits).to_string())
@@ -0,0 +1,38 @@
+import numpy as np
+
+# writes a synthetic whole-slide image that OpenSlide can open (a tiled, pyramidal "generic TIFF"): a white
+# background with a few purple tissue blobs, so that tilers see the usual mix of background and tissue tiles.
+# Used by the tiling benchmarks; needs tifffile, which is only a benchmark dependency.
+#
+#   write_synthetic_slide("synthetic.tiff", 16384, 12288)
+
+
+def synthetic_image(width, height, blobs=12, seed=0):
+    rng = np.random.default_rng(seed)
+    image = np.full((height, width, 3), 245, dtype=np.uint8)
+    # tissue blobs are drawn on a coarse grid and scaled up, so this stays cheap for large slides
+    scale = 16
+    ys, xs = np.mgrid[0:-(-height // scale), 0:-(-width // scale)]
+    mask = np.zeros(ys.shape, dtype=bool)
+    for _ in range(blobs):
+        cy, cx = rng.uniform(0, ys.shape[0]), rng.uniform(0, xs.shape[1])
+        ry, rx = rng.uniform(0.04, 0.15) * ys.shape[0], rng.uniform(0.04, 0.15) * xs.shape[1]
+        mask |= ((ys - cy) / ry) ** 2 + ((xs - cx) / rx) ** 2 < 1
+    mask = np.repeat(np.repeat(mask, scale, axis=0), scale, axis=1)[:height, :width]
+    texture = rng.integers(0, 60, size=(height // 4 + 1, width // 4 + 1), dtype=np.uint8)
+    texture = np.repeat(np.repeat(texture, 4, axis=0), 4, axis=1)[:height, :width]
+    for channel, base in enumerate((170, 90, 160)):
+        image[..., channel][mask] = base + texture[mask] // (channel + 1)
+    return image
+
+
+def write_synthetic_slide(path, width=16384, height=12288, tile=256, levels=4, seed=0):
+    import tifffile
+
+    image = synthetic_image(width, height, seed=seed)
+    with tifffile.TiffWriter(path, bigtiff=True) as tif:
+        for level in range(levels):
+            # OpenSlide only takes later directories as pyramid levels if they are marked reduced resolution
+            tif.write(image, tile=(tile, tile), compression="zlib", photometric="rgb", subfiletype=1 if level else 0)
+            image = image[::2, ::2]
+    return path
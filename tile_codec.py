@@ -0,0 +1,86 @@
+import io
+import time
+from concurrent import futures
+
+import numpy as np
+from PIL import Image
+
+# how tiles are encoded for output. A codec is a short string: "png" or "png:<compress level 0-9>", "jpeg:<quality>",
+# "webp:<quality>", or "raw" (the uint8 RGB array itself). Tiles are always encoded as RGB; any alpha channel is
+# dropped first. EncoderPool runs encodes on threads (PIL releases the GIL while it compresses), so a tiling worker
+# can read and classify its next tiles while the last ones are being encoded.
+
+DEFAULT_CODEC = "png"
+PNG_COMPRESS_LEVEL = 6  # PIL's default
+JPEG_QUALITY = 90
+WEBP_QUALITY = 90
+ENCODE_THREADS = 2
+
+FORMATS = {"png": "PNG", "jpeg": "JPEG", "webp": "WEBP"}
+EXTENSIONS = {"png": ".png", "jpeg": ".jpg", "webp": ".webp", "raw": ".npy"}
+DEFAULT_SETTINGS = {"png": PNG_COMPRESS_LEVEL, "jpeg": JPEG_QUALITY, "webp": WEBP_QUALITY}
+
+
+def parse_codec(codec):
+    """(name, setting) of a codec string, e.g. ("jpeg", 90); setting is None for raw."""
+    name, _, setting = codec.lower().partition(":")
+    if name == "jpg":
+        name = "jpeg"
+    if name not in EXTENSIONS:
+        raise ValueError(f"unknown codec {codec!r}, expected one of {', '.join(EXTENSIONS)}")
+    if name == "raw":
+        return name, None
+    return name, int(setting) if setting else DEFAULT_SETTINGS[name]
+
+
+def extension(codec):
+    return EXTENSIONS[parse_codec(codec)[0]]
+
+
+def encode(tile, codec=DEFAULT_CODEC):
+    """tile (a PIL image) as bytes in the given codec, or as a uint8 RGB array for "raw"."""
+    name, setting = parse_codec(codec)
+    if tile.mode != "RGB":
+        tile = tile.convert("RGB")
+    if name == "raw":
+        return np.asarray(tile)
+    buffer = io.BytesIO()
+    if name == "png":
+        tile.save(buffer, "PNG", compress_level=setting)
+    else:
+        tile.save(buffer, FORMATS[name], quality=setting)
+    return buffer.getvalue()
+
+
+def decode(data, codec=DEFAULT_CODEC):
+    """The uint8 RGB array of an encoded tile."""
+    if parse_codec(codec)[0] == "raw":
+        return np.asarray(data)
+    return np.asarray(Image.open(io.BytesIO(data)).convert("RGB"))
+
+
+def _timed_encode(tile, codec):
+    start = time.perf_counter()
+    data = encode(tile, codec)
+    return data, time.perf_counter() - start
+
+
+class EncoderPool:
+    """Encodes tiles on `threads` threads; submit returns a future of (data, seconds spent encoding)."""
+
+    def __init__(self, codec=DEFAULT_CODEC, threads=ENCODE_THREADS):
+        parse_codec(codec)
+        self.codec = codec
+        self.executor = futures.ThreadPoolExecutor(max_workers=threads)
+
+    def submit(self, tile):
+        return self.executor.submit(_timed_encode, tile, self.codec)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
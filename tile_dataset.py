@@ -0,0 +1,170 @@
+import os
+import threading
+
+import h5py
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+from tile_codec import decode
+from tile_store import SHARD_SUFFIX
+
+# a tf.data input pipeline for training on tiles. The tiles of a label directory tree (<tissue>_<split>_dir/<label>/,
+# as process_slice_upload.py uploads them) are listed once into an index, <tissue>_tile_index.parquet in the root,
+# with one row per tile: an image file, or a row of an HDF5 tile store (a directory of tile_store.py shards under the
+# label directory). tile_dataset decodes tiles on parallel tf.data workers, downscales them, optionally caches the
+# result, and batches and prefetches.
+#
+#   index = load_index(root_dir, "lymph")
+#   train = tile_dataset(index[index.split == "train"], batch_size=32, image_size=299)
+#   model.fit(train, ...)
+
+LABELS = ["early", "late"]  # label 0 and 1, as flow_from_directory numbers the class directories
+SPLITS = ["train", "validation"]
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".npy")
+TF_DECODED = (".png", ".jpg", ".jpeg")  # decoded by TensorFlow ops; the others through tile_codec.decode
+INDEX_NAME = "tile_index.parquet"
+AUTOTUNE = tf.data.AUTOTUNE
+SHUFFLE_BUFFER = 1024  # decoded tiles shuffled when the dataset is cached
+
+
+def _shard_rows(path):
+    with h5py.File(path, "r") as shard:
+        return len(shard["index"]) if "index" in shard else 0
+
+
+def build_index(root_dir, tissue):
+    """DataFrame of every tile under root_dir/<tissue>_<split>_dir/<label>/: path, row (the row in an HDF5 shard, -1
+    for an image file), label (0 early, 1 late) and split."""
+    rows = []
+    for split in SPLITS:
+        for label, label_name in enumerate(LABELS):
+            directory = os.path.join(root_dir, f"{tissue}_{split}_dir", label_name)
+            if not os.path.isdir(directory):
+                continue
+            for entry in sorted(os.scandir(directory), key=lambda entry: entry.name):
+                if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    rows.append((entry.path, -1, label, split))
+                elif entry.is_dir():
+                    for name in sorted(os.listdir(entry.path)):
+                        if name.endswith(SHARD_SUFFIX):
+                            path = os.path.join(entry.path, name)
+                            rows.extend((path, row, label, split) for row in range(_shard_rows(path)))
+    return pd.DataFrame(rows, columns=["path", "row", "label", "split"]).astype({"row": np.int64, "label": np.int64})
+
+
+def load_index(root_dir, tissue, rebuild=False):
+    """The tile index of root_dir for tissue, built and written to root_dir/<tissue>_tile_index.parquet the first
+    time (or with rebuild=True, after tiles have been added)."""
+    path = os.path.join(root_dir, f"{tissue}_{INDEX_NAME}")
+    if os.path.exists(path) and not rebuild:
+        return pd.read_parquet(path)
+    index = build_index(root_dir, tissue)
+    index.to_parquet(path)
+    return index
+
+
+_shards = {}
+_shards_lock = threading.Lock()
+
+
+def _read_store_tile(path, row):
+    # h5py serialises calls into HDF5 anyway, so one open handle per shard is shared by every reader thread
+    path = path.decode("utf8") if isinstance(path, bytes) else path
+    with _shards_lock:
+        if path not in _shards:
+            _shards[path] = h5py.File(path, "r")
+        shard = _shards[path]
+    return shard["tiles"][int(row)]
+
+
+def _read_other_file(path):
+    path = path.decode("utf8")
+    if path.endswith(".npy"):
+        return np.load(path)
+    with open(path, "rb") as f:
+        return decode(f.read())
+
+
+def _decode_file(path):
+    # PNG and JPEG are decoded by TensorFlow ops, which release the GIL, so map workers decode in parallel
+    extension = tf.strings.lower(tf.strings.regex_replace(path, r"^.*(\.[^.]*)$", r"\1"))
+    return tf.cond(tf.reduce_any(tf.equal(extension, TF_DECODED)),
+                   lambda: tf.io.decode_image(tf.io.read_file(path), channels=3, expand_animations=False),
+                   lambda: tf.numpy_function(_read_other_file, [path], tf.uint8))
+
+
+def _resize(image, image_size):
+    image.set_shape([None, None, 3])
+    if image_size is None:
+        return image
+    # area averaging, so downscaled tiles keep fine texture rather than aliasing; kept as uint8 until batched, so a
+    # cache holds a quarter of the bytes
+    resized = tf.image.resize(image, [image_size, image_size], method="area")
+    return tf.cast(tf.clip_by_value(tf.round(resized), 0, 255), tf.uint8)
+
+
+def inception_scale(images):
+    """Pixel values in [-1, 1], as InceptionV3 was trained on."""
+    return images / 127.5 - 1.0
+
+
+def dataset_order(index):
+    """The rows of index in the order tile_dataset yields them without shuffling: image files, then tile store
+    rows."""
+    return pd.concat([index[index["row"] < 0], index[index["row"] >= 0]])
+
+
+def tile_dataset(index, batch_size=32, image_size=299, shuffle=True, cache=None, parallel=AUTOTUNE,
+                 preprocess=None, repeat=False, seed=0):
+    """tf.data.Dataset of (images, labels) batches from the rows of a tile index. Images are float32, image_size
+    square (None keeps the tile size), with values 0-255 unless preprocess (e.g. inception_scale) maps them.
+    cache="" caches decoded, resized tiles in memory and a path caches them in files there, so only the first epoch
+    decodes; parallel is the number of decoding workers."""
+    if shuffle:
+        # the cache keeps the order of the first epoch, which a SHUFFLE_BUFFER only reorders locally, so the rows are
+        # shuffled once up front (and again every epoch below when nothing is cached)
+        index = index.sample(frac=1, random_state=seed)
+    files = index[index["row"] < 0]
+    stored = index[index["row"] >= 0]
+    parts = []
+    if len(files):
+        dataset = tf.data.Dataset.from_tensor_slices((files["path"].to_numpy(), files["label"].to_numpy()))
+        if shuffle and cache is None:
+            # shuffling paths is cheap, so the whole index is shuffled before anything is decoded
+            dataset = dataset.shuffle(len(files), seed=seed, reshuffle_each_iteration=True)
+        parts.append(dataset.map(lambda path, label: (_resize(_decode_file(path), image_size), label),
+                                 num_parallel_calls=parallel, deterministic=not shuffle))
+    if len(stored):
+        dataset = tf.data.Dataset.from_tensor_slices((stored["path"].to_numpy(), stored["row"].to_numpy(),
+                                                      stored["label"].to_numpy()))
+        if shuffle and cache is None:
+            dataset = dataset.shuffle(len(stored), seed=seed, reshuffle_each_iteration=True)
+        parts.append(dataset.map(lambda path, row, label: (
+            _resize(tf.numpy_function(_read_store_tile, [path, row], tf.uint8), image_size), label),
+            num_parallel_calls=parallel, deterministic=not shuffle))
+    if not parts:
+        raise ValueError("the tile index is empty")
+
+    if shuffle and len(parts) > 1:
+        # image files and tile store rows interleaved as in the shuffled index, rather than one after the other
+        choices = tf.data.Dataset.from_tensor_slices((index["row"] >= 0).to_numpy().astype(np.int64))
+        dataset = tf.data.Dataset.choose_from_datasets(parts, choices)
+    else:
+        dataset = parts[0]
+        for part in parts[1:]:
+            dataset = dataset.concatenate(part)
+    if cache is not None:
+        dataset = dataset.cache(cache)
+        if shuffle:
+            dataset = dataset.shuffle(SHUFFLE_BUFFER, seed=seed, reshuffle_each_iteration=True)
+    if repeat:
+        dataset = dataset.repeat()
+    preprocess = preprocess or (lambda images: images)
+    dataset = dataset.batch(batch_size).map(lambda images, labels: (preprocess(tf.cast(images, tf.float32)), labels),
+                                            num_parallel_calls=parallel)
+    return dataset.prefetch(AUTOTUNE)
+
+
+def steps_per_epoch(index, batch_size):
+    return -(-len(index) // batch_size)
@@ -0,0 +1,118 @@
+import os
+
+import h5py
+import numpy as np
+
+from tiler import TileWriter
+
+# a slide's kept tiles as a handful of HDF5 shards instead of one PNG file per tile. A store is a directory of shards,
+# each holding raw uint8 RGB tiles (one compressed chunk per tile, so any tile can be read on its own) and an index
+# of (tile_number, x, y, tissue) rows. tile_slide writes one shard per band of rows through TileStoreWriter, so worker
+# processes never share a file; more tiles can be appended to any shard later.
+#
+#   tile_slide(slide_path, 1024, 14, 50, TileStoreWriter("tiles/<file_id>"))
+#   store = TileStore("tiles/<file_id>")
+#   store.index["tissue"], store[0], store.tile(tile_number)
+
+SHARD_SUFFIX = ".h5"
+INDEX_DTYPE = np.dtype([("tile_number", "<i8"), ("x", "<i4"), ("y", "<i4"), ("tissue", "<f4")])
+COMPRESSION = "lzf"  # fast; "gzip" is smaller and slower, None stores tiles uncompressed
+FLUSH_TILES = 32  # tiles buffered in memory before they are written to the shard
+
+
+class TileShard:
+    """One shard file, opened for appending (mode "a") or rewritten from scratch (mode "w")."""
+
+    def __init__(self, path, mode="a", compression=COMPRESSION):
+        self.path = path
+        self.file = h5py.File(path, mode)
+        self.compression = compression
+        self.pending = []
+
+    def _create(self, tile_shape):
+        self.file.create_dataset("tiles", shape=(0,) + tile_shape, maxshape=(None,) + tile_shape, dtype=np.uint8,
+                                 chunks=(1,) + tile_shape, compression=self.compression)
+        self.file.create_dataset("index", shape=(0,), maxshape=(None,), dtype=INDEX_DTYPE, chunks=(1024,))
+
+    def append(self, tile_number, x, y, tissue_percentage, pixels):
+        self.pending.append(((tile_number, x, y, tissue_percentage), pixels))
+        if len(self.pending) >= FLUSH_TILES:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        if "tiles" not in self.file:
+            self._create(self.pending[0][1].shape)
+        tiles, index = self.file["tiles"], self.file["index"]
+        start, count = len(index), len(self.pending)
+        tiles.resize(start + count, axis=0)
+        index.resize(start + count, axis=0)
+        tiles[start:] = np.stack([pixels for _, pixels in self.pending])
+        index[start:] = np.array([row for row, _ in self.pending], dtype=INDEX_DTYPE)
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+class TileStoreWriter(TileWriter):
+    """Writes each band of tile_slide's kept tiles to its own shard, rows_<first>-<last>.h5, in directory."""
+
+    codec = "raw"
+
+    def __init__(self, directory, compression=COMPRESSION):
+        self.directory = directory
+        self.compression = compression
+        self.shard = None
+
+    def open_band(self, first_row, last_row):
+        os.makedirs(self.directory, exist_ok=True)
+        # a band that is tiled again replaces its shard rather than adding duplicate tiles to it
+        path = os.path.join(self.directory, f"rows_{first_row:05d}-{last_row:05d}{SHARD_SUFFIX}")
+        self.shard = TileShard(path, "w", self.compression)
+
+    def write(self, tile_number, data, x, y, tissue_percentage):
+        self.shard.append(tile_number, x, y, tissue_percentage, data)
+
+    def close_band(self):
+        if self.shard is not None:
+            self.shard.close()
+            self.shard = None
+
+
+class TileStore:
+    """Read access to every tile in a store directory, in shard order: store[i] is the i-th tile's pixels, index the
+    (tile_number, x, y, tissue) rows of all of them."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        names = sorted(name for name in os.listdir(directory) if name.endswith(SHARD_SUFFIX))
+        self.shards = [h5py.File(os.path.join(directory, name), "r") for name in names]
+        self.shards = [shard for shard in self.shards if "index" in shard]
+        indexes = [shard["index"][:] for shard in self.shards]
+        self.index = np.concatenate(indexes) if indexes else np.zeros(0, INDEX_DTYPE)
+        # position of each tile: which shard, and which row of it
+        self._shard = np.concatenate([np.full(len(index), n) for n, index in enumerate(indexes)] or [[]]).astype(int)
+        self._row = np.concatenate([np.arange(len(index)) for index in indexes] or [[]]).astype(int)
+        self._by_tile_number = {tile_number: i for i, tile_number in enumerate(self.index["tile_number"])}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, i):
+        return self.shards[self._shard[i]]["tiles"][self._row[i]]
+
+    def tile(self, tile_number):
+        return self[self._by_tile_number[tile_number]]
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,158 @@
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent import futures
+
+# uploading tiles in batches. Tiles are written to a local spool directory (one per slide) and each batch of them goes
+# up in a single uploader call, e.g. one `rclone copy --transfers=N` rather than one rclone process per tile, so
+# process start-up and the remote handshake are paid per batch. Failed batches are retried with backoff, and every
+# uploaded file is added to the spool's manifest, so a spool that is flushed again (after a crash, say) only sends
+# what is not already up.
+#
+#   spool = TileSpool("_tmp/<file_id>_tiles", "GCDData:/FinalData_/<label dir>", RcloneUploader(transfers=16))
+#   spool.add("<file_id>_0.png", data)   # uploads a batch every batch_size tiles
+#   spool.close()                        # uploads the rest
+#
+# An uploader is anything with upload(source_dir, names, destination); FakeUploader copies to a local directory with
+# a simulated per-call and per-file cost, for testing and for bench_tile_uploader.py.
+
+BATCH_SIZE = 256  # tiles per uploader call
+TRANSFERS = 16  # files rclone copies at once within a batch
+RETRIES = 3
+BACKOFF = 1.0  # seconds before the first retry, doubling after each
+MANIFEST = "_uploaded.txt"
+
+
+class UploadError(RuntimeError):
+    pass
+
+
+class RcloneUploader:
+    def __init__(self, transfers=TRANSFERS, rclone="rclone", args=("-q",)):
+        self.transfers = transfers
+        self.rclone = rclone
+        self.args = list(args)
+
+    def upload(self, source_dir, names, destination):
+        # --files-from restricts the copy to this batch; the rest of the spool may still be being written
+        with tempfile.NamedTemporaryFile("w", suffix=".txt") as files_from:
+            files_from.write("\n".join(names) + "\n")
+            files_from.flush()
+            result = subprocess.run([self.rclone, "copy", source_dir, destination, "--files-from", files_from.name,
+                                     f"--transfers={self.transfers}", "--no-traverse"] + self.args)
+        if result.returncode != 0:
+            raise UploadError(f"rclone copy to {destination} exited with {result.returncode}")
+
+
+class FakeUploader:
+    """Copies files to root/<destination> (with ':' in destination treated as '/'), sleeping `latency` per call and
+    `per_file` per file on `transfers` threads; fail_rate is the fraction of calls that raise UploadError."""
+
+    def __init__(self, root, latency=0.0, per_file=0.0, transfers=TRANSFERS, fail_rate=0.0, seed=0):
+        self.root = root
+        self.latency = latency
+        self.per_file = per_file
+        self.transfers = transfers
+        self.fail_rate = fail_rate
+        self.calls = 0
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _copy(self, source, target):
+        if self.per_file:
+            time.sleep(self.per_file)
+        shutil.copyfile(source, target)
+
+    def upload(self, source_dir, names, destination):
+        with self._lock:
+            self.calls += 1
+            fail = self.fail_rate and self._rng.random() < self.fail_rate
+        time.sleep(self.latency)
+        if fail:
+            raise UploadError(f"injected failure uploading to {destination}")
+        target_dir = os.path.join(self.root, destination.replace(":", "/").lstrip("/"))
+        os.makedirs(target_dir, exist_ok=True)
+        with futures.ThreadPoolExecutor(max_workers=self.transfers) as executor:
+            list(executor.map(lambda name: self._copy(os.path.join(source_dir, name), os.path.join(target_dir, name)),
+                              names))
+
+
+class TileSpool:
+    """A local directory of tiles waiting to go to destination. Several spools (e.g. one per band, in different
+    processes) can share a directory: each uploads only the files added through it, plus, with flush_all, whatever
+    else is in the directory and not yet in the manifest."""
+
+    def __init__(self, directory, destination, uploader, batch_size=BATCH_SIZE, retries=RETRIES, backoff=BACKOFF):
+        self.directory = directory
+        self.destination = destination
+        self.uploader = uploader
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self.pending = []
+        self.stats = {"files": 0, "bytes": 0, "batches": 0, "retries": 0, "seconds": 0.0}
+        os.makedirs(directory, exist_ok=True)
+
+    def uploaded(self):
+        path = os.path.join(self.directory, MANIFEST)
+        if not os.path.exists(path):
+            return set()
+        with open(path) as f:
+            return {line.strip() for line in f if line.strip()}
+
+    def add(self, name, data):
+        with open(os.path.join(self.directory, name), "wb") as f:
+            f.write(data)
+        self.pending.append(name)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def _upload(self, names):
+        start = time.perf_counter()
+        for attempt in range(self.retries + 1):
+            try:
+                self.uploader.upload(self.directory, names, self.destination)
+                break
+            except (UploadError, OSError):
+                if attempt >= self.retries:
+                    raise
+                self.stats["retries"] += 1
+                time.sleep(self.backoff * 2 ** attempt)
+        # appends of a few lines are not interleaved between processes sharing the spool
+        with open(os.path.join(self.directory, MANIFEST), "a") as f:
+            f.write("".join(name + "\n" for name in names))
+        self.stats["files"] += len(names)
+        self.stats["bytes"] += sum(os.path.getsize(os.path.join(self.directory, name)) for name in names)
+        self.stats["batches"] += 1
+        self.stats["seconds"] += time.perf_counter() - start
+
+    def flush(self, remove=True):
+        """Upload the tiles added since the last flush, in batches, deleting them afterwards unless remove=False."""
+        pending, self.pending = self.pending, []
+        for first in range(0, len(pending), self.batch_size):
+            batch = pending[first:first + self.batch_size]
+            self._upload(batch)
+            if remove:
+                for name in batch:
+                    os.remove(os.path.join(self.directory, name))
+
+    def flush_all(self, remove=True):
+        """Upload every file in the directory that is not in the manifest yet, e.g. tiles written by other spools."""
+        done = self.uploaded()
+        self.pending = sorted(set(self.pending) | {name for name in os.listdir(self.directory)
+                                                   if name != MANIFEST and name not in done
+                                                   and os.path.isfile(os.path.join(self.directory, name))})
+        self.flush(remove)
+
+    def close(self):
+        self.flush()
+
+
+def format_upload_stats(stats):
+    rate = stats["files"] / stats["seconds"] if stats["seconds"] else 0.0
+    return (f"{stats['files']} files ({stats['bytes'] / 1024 ** 2:.1f} MB) in {stats['batches']} batches, "
+            f"{stats['retries']} retries, {stats['seconds']:.1f}s, {rate:.0f} files/s")
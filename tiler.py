@@ -0,0 +1,532 @@
+import abc
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent import futures
+
+import openslide
+from openslide import deepzoom
+
+import numpy as np
+from PIL import Image
+
+from image_processing import TISSUE_GRAY_THRESHOLD, grid_coverage, keep_tiles, tiles_to_array, tissue_mask
+from tile_codec import DEFAULT_CODEC, ENCODE_THREADS, EncoderPool, extension
+
+# shared tiling code for slice_image.py and process_slice_upload.py.
+#
+# Opening a slide parses the SVS header and TIFF directories, which costs far more than reading a tile, so tile
+# workers get their OpenSlide/DeepZoomGenerator from open_deepzoom, which keeps the handles of the last few slides
+# each thread (and so each worker process) has used open and hands them back on later calls.
+
+SLIDES_PER_THREAD = 2
+SHARED_CACHE_BYTES = 256 * 1024 * 1024
+
+_local = threading.local()
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def _cache():
+    """One OpenSlide tile cache for every handle in the process (OpenSlide >= 4.0), so that threads reading the same
+    slide share decoded tiles instead of each keeping its own copy; None where it is not supported."""
+    global _shared_cache
+    if not hasattr(openslide, "OpenSlideCache"):
+        return None
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            try:
+                _shared_cache = openslide.OpenSlideCache(SHARED_CACHE_BYTES)
+            except openslide.OpenSlideVersionError:
+                _shared_cache = False
+        return _shared_cache or None
+
+
+def _thread_slides():
+    slides = getattr(_local, "slides", None)
+    if slides is None:
+        slides = _local.slides = OrderedDict()
+    return slides
+
+
+def open_deepzoom(slide_path, tile_size, overlap=0):
+    """This thread's DeepZoomGenerator for slide_path, opening the slide only on first use."""
+    return open_slide(slide_path, tile_size, overlap)[1]
+
+
+def open_slide(slide_path, tile_size, overlap=0):
+    """This thread's (OpenSlide, DeepZoomGenerator) pair for slide_path, opening the slide only on first use."""
+    slides = _thread_slides()
+    key = (slide_path, tile_size, overlap)
+    if key in slides:
+        slides.move_to_end(key)
+        return slides[key]
+
+    # a slide whose file has gone (a deleted temporary copy) is closed here rather than held open until evicted
+    for gone in [key for key in slides if not os.path.exists(key[0])]:
+        slides.pop(gone)[0].close()
+    slide = openslide.OpenSlide(slide_path)
+    cache = _cache()
+    if cache is not None:
+        slide.set_cache(cache)
+    slides[key] = (slide, deepzoom.DeepZoomGenerator(slide, tile_size=tile_size, overlap=overlap))
+    while len(slides) > SLIDES_PER_THREAD:
+        _, (oldest, _) = slides.popitem(last=False)
+        oldest.close()
+    return slides[key]
+
+
+def release_slide(slide_path):
+    """Close this thread's handles on slide_path, e.g. before deleting a temporary copy of the slide."""
+    slides = _thread_slides()
+    for key in [key for key in slides if key[0] == slide_path]:
+        slides.pop(key)[0].close()
+
+
+# Process-pool tiling engine. A slide's tile grid at one DeepZoom level is cut into bands of whole rows and every
+# band is a task for a worker process, which reads, classifies, PNG-encodes and writes its tiles and sends back only
+# its timings, so tiling scales with the number of cores instead of being held to one by the GIL. Tile numbers are
+# the ones slice_image.py has always used (column-major: x * rows + y), and edge tiles smaller than tile_size are
+# skipped as before.
+#
+#   stats = tile_slide("slide.svs", 1024, 14, 50, FolderWriter("tiles"), workers=32)
+
+STAGES = ["read", "classify", "encode", "write"]
+BANDS_PER_WORKER = 4
+CLASSIFY_BATCH = 16
+REGION_COLUMNS = 8  # tiles per read_region call when reading a native level
+MASK_MAX_SIZE = 4096  # larger lowest levels are replaced by a thumbnail of at most this size
+MASK_MARGIN = 10  # tiles are read if their mask coverage is within this many percentage points of the threshold
+
+
+class TileWriter(abc.ABC):
+    """Where tile_slide's kept tiles go. Writers are pickled to the worker processes, where each band of rows is
+    written between open_band and close_band, with the tiles encoded as `codec` (see tile_codec.py)."""
+
+    codec = DEFAULT_CODEC
+
+    def open_band(self, first_row, last_row):
+        pass
+
+    @abc.abstractmethod
+    def write(self, tile_number, data, x, y, tissue_percentage):
+        pass
+
+    def close_band(self):
+        pass
+
+
+class FolderWriter(TileWriter):
+    """Writes each kept tile to folder/<prefix><tile_number>.png (or .jpg, .webp, .npy, following codec)."""
+
+    def __init__(self, folder, prefix="tile", codec=DEFAULT_CODEC):
+        self.folder = folder
+        self.prefix = prefix
+        self.codec = codec
+
+    def write(self, tile_number, data, x, y, tissue_percentage):
+        path = os.path.join(self.folder, f"{self.prefix}{tile_number}{extension(self.codec)}")
+        if isinstance(data, np.ndarray):
+            np.save(path, data)
+        else:
+            with open(path, "wb") as f:
+                f.write(data)
+
+
+def low_resolution_image(slide):
+    """The slide's lowest pyramid level (or a thumbnail, if that is large) as RGB on a white background."""
+    lowest = slide.level_count - 1
+    size = slide.level_dimensions[lowest]
+    if max(size) > MASK_MAX_SIZE:
+        return slide.get_thumbnail((MASK_MAX_SIZE, MASK_MAX_SIZE))
+    region = slide.read_region((0, 0), lowest, size)
+    image = Image.new("RGB", size, (255, 255, 255))
+    image.paste(region, mask=region.split()[3])
+    return image
+
+
+def tissue_tiles(slide_path, tile_size, level, tissue_threshold_percentage, mask_threshold=TISSUE_GRAY_THRESHOLD,
+                 margin=MASK_MARGIN):
+    """(rows, columns) bool array over the tile grid of a DeepZoom level, True for the tiles worth reading: those
+    whose coverage by a tissue mask of the low resolution image (threshold a grey level or "otsu") is within margin
+    percentage points of tissue_threshold_percentage. The margin covers tissue that blurs into the background when
+    the slide is scaled down."""
+    generator = open_deepzoom(slide_path, tile_size)
+    return _mask_tiles(_slide_mask(slide_path, mask_threshold), generator, tile_size, level,
+                       tissue_threshold_percentage, margin)
+
+
+def _slide_mask(slide_path, mask_threshold=TISSUE_GRAY_THRESHOLD):
+    slide = openslide.OpenSlide(slide_path)
+    try:
+        return tissue_mask(low_resolution_image(slide), mask_threshold)
+    finally:
+        slide.close()
+
+
+def _mask_tiles(mask, generator, tile_size, level, tissue_threshold_percentage, margin=MASK_MARGIN):
+    columns, rows = generator.level_tiles[level]
+    width, height = generator.level_dimensions[level]
+    x_edges = np.minimum(np.arange(columns + 1) * tile_size, width) * mask.shape[1] / width
+    y_edges = np.minimum(np.arange(rows + 1) * tile_size, height) * mask.shape[0] / height
+    return grid_coverage(mask, x_edges, y_edges) * 100 > tissue_threshold_percentage - margin
+
+
+def native_level(slide, generator, level):
+    """The slide level that DeepZoom level `level` is read from, if DeepZoom reads its full tiles from it without
+    rescaling, so that read_row can read them straight from that level and get the same pixels; None if not."""
+    downsample = 2 ** (generator.level_count - 1 - level)
+    slide_level = slide.get_best_level_for_downsample(downsample)  # as DeepZoomGenerator picks it
+    if slide_level == 0:
+        return None  # DeepZoom reads level 0 tiles without rescaling anyway, and faster than read_row
+    level_downsample = slide.level_downsamples[slide_level]
+    tile_size = generator.get_tile_dimensions(level, (0, 0))[0]
+    # DeepZoom reads ceil(tile_size * downsample / level_downsample) pixels of the slide level per tile and rescales
+    # them to tile_size, so a level whose downsample is not exactly the DeepZoom level's is rescaled
+    if math.ceil(tile_size * downsample / level_downsample) != tile_size:
+        return None
+    # and reads fewer at the edges of the slide level, which must hold every full tile
+    full = [size // tile_size * tile_size for size in generator.level_dimensions[level]]
+    if any(size > level_size for size, level_size in zip(full, slide.level_dimensions[slide_level])):
+        return None
+    return slide_level
+
+
+def deepzoom_level(slide_path, tile_size, magnification=None, microns_per_pixel=None):
+    """The DeepZoom level to tile for an objective magnification (e.g. 10) or a resolution in microns per pixel: the
+    natively stored level closest to it, so that tile_slide(..., native=True) can read it without resampling."""
+    slide, generator = open_slide(slide_path, tile_size)
+    if microns_per_pixel is not None:
+        base = slide.properties.get(openslide.PROPERTY_NAME_MPP_X)
+        wanted = microns_per_pixel / float(base) if base else None
+    else:
+        base = slide.properties.get(openslide.PROPERTY_NAME_OBJECTIVE_POWER)
+        wanted = float(base) / magnification if base else None
+    if wanted is None:
+        raise ValueError(f"{slide_path} does not record its resolution")
+    downsample = min(slide.level_downsamples, key=lambda level_downsample: abs(np.log(level_downsample / wanted)))
+    return generator.level_count - 1 - int(round(np.log2(downsample)))
+
+
+def read_row(slide, generator, level, y, columns, slide_level=None):
+    """(x, tile) for the given columns of row y of a DeepZoom level. Without slide_level every tile comes from
+    DeepZoomGenerator.get_tile; with it (see native_level), runs of up to REGION_COLUMNS adjacent tiles are read from
+    that slide level in one read_region call and cut up, with no rescaling."""
+    if slide_level is None:
+        for x in columns:
+            yield x, generator.get_tile(level, (x, y))
+        return
+    tile_size = generator.get_tile_dimensions(level, (0, 0))[0]
+    downsample = slide.level_downsamples[slide_level]
+    runs = []
+    for x in columns:
+        if runs and x == runs[-1][-1] + 1 and len(runs[-1]) < REGION_COLUMNS:
+            runs[-1].append(x)
+        else:
+            runs.append([x])
+    for run in runs:
+        location = (int(run[0] * tile_size * downsample), int(y * tile_size * downsample))
+        region = slide.read_region(location, slide_level, (len(run) * tile_size, tile_size))
+        # on a white background, as DeepZoomGenerator does
+        region = Image.composite(region, Image.new("RGB", region.size, (255, 255, 255)), region).convert("RGB")
+        for i, x in enumerate(run):
+            yield x, region.crop((i * tile_size, 0, (i + 1) * tile_size, tile_size))
+
+
+def tile_bands(rows, band_rows):
+    return [(start, min(start + band_rows, rows)) for start in range(0, rows, band_rows)]
+
+
+def _classify_and_encode(batch, stats, tissue_threshold_percentage, filters, encoder, pending):
+    start = time.perf_counter()
+    # greyscale is all the tissue test needs; the colour criteria need the RGB tiles
+    mode = "RGB" if filters.get("saturation") or filters.get("pen") else "L"
+    keep, tissue = keep_tiles(tiles_to_array([tile for *_, tile in batch], mode), tissue_threshold_percentage,
+                              **filters)
+    stats["classify"] += time.perf_counter() - start
+    for (tile_number, x, y, tile), kept, tissue_percentage in zip(batch, keep, tissue):
+        if kept:
+            pending.append((tile_number, x, y, float(tissue_percentage), encoder.submit(tile)))
+    return keep, tissue
+
+
+def _write_encoded(pending, stats, writer, wait=False):
+    """Write the tiles at the front of pending whose encoding has finished (all of them, if wait)."""
+    while pending and (wait or pending[0][-1].done()):
+        tile_number, x, y, tissue_percentage, encoded = pending.pop(0)
+        data, seconds = encoded.result()
+        stats["encode"] += seconds
+        start = time.perf_counter()
+        writer.write(tile_number, data, x, y, tissue_percentage)
+        stats["write"] += time.perf_counter() - start
+        stats["kept"] += 1
+
+
+def _tile_band(job):
+    (slide_path, tile_size, level, tissue_threshold_percentage, filters, native, encode_threads, writer, first_row,
+     last_row, candidates) = job
+    stats = dict.fromkeys(STAGES, 0.0)
+    stats["tiles"] = stats["kept"] = stats["skipped"] = 0
+    slide, generator = open_slide(slide_path, tile_size)
+    slide_level = native_level(slide, generator, level) if native else None
+    columns, rows = generator.level_tiles[level]
+    batch, pending = [], []
+    writer.open_band(first_row, last_row)
+    try:
+        with EncoderPool(writer.codec, encode_threads) as encoder:
+            for y in range(first_row, last_row):
+                to_read = []
+                for x in range(columns):
+                    if generator.get_tile_dimensions(level, (x, y)) != (tile_size, tile_size):
+                        continue
+                    if candidates is not None and not candidates[y - first_row, x]:
+                        stats["skipped"] += 1
+                        continue
+                    to_read.append(x)
+                stats["tiles"] += len(to_read)
+                tiles = read_row(slide, generator, level, y, to_read, slide_level)
+                while True:
+                    start = time.perf_counter()
+                    x, tile = next(tiles, (None, None))
+                    stats["read"] += time.perf_counter() - start
+                    if tile is None:
+                        break
+                    batch.append((x * rows + y, x, y, tile))
+                    if len(batch) == CLASSIFY_BATCH:
+                        _classify_and_encode(batch, stats, tissue_threshold_percentage, filters, encoder, pending)
+                        batch = []
+                        _write_encoded(pending, stats, writer)
+            if batch:
+                _classify_and_encode(batch, stats, tissue_threshold_percentage, filters, encoder, pending)
+            _write_encoded(pending, stats, writer, wait=True)
+    finally:
+        start = time.perf_counter()
+        writer.close_band()
+        stats["write"] += time.perf_counter() - start
+    return stats
+
+
+def tile_slide(slide_path, tile_size, level, tissue_threshold_percentage, writer, workers=None, band_rows=None,
+               executor=None, progress=None, skip_background=True, filters=None, native=False,
+               encode_threads=ENCODE_THREADS):
+    """Tile one DeepZoom level of slide_path, writing tiles above the tissue threshold with writer (a TileWriter, e.g.
+    FolderWriter or tile_store.TileStoreWriter). Bands of band_rows rows (default: about BANDS_PER_WORKER bands per
+    worker) go to executor, or to a pool of `workers` processes made for this slide. progress(tiles) is called as
+    each band finishes, with the number of grid positions it covered. With skip_background, tiles that a low
+    resolution tissue mask shows to be background (see tissue_tiles) are never read; they are counted as skipped.
+    Tiles are classified CLASSIFY_BATCH at a time by image_processing.keep_tiles, with filters (e.g.
+    {"pen": True, "blur": True}) turning on its optional criteria. With native, tiles are read straight from the
+    slide level that stores `level` (see read_row) when DeepZoom would read the same pixels from it (see
+    native_level), and through DeepZoom otherwise. Kept tiles are encoded in writer.codec on encode_threads threads
+    per worker while the worker reads on.
+    Returns the tile counts, seconds per stage summed over workers (plus the mask pre-pass), and wall time."""
+    start = time.perf_counter()
+    workers = workers or os.cpu_count()
+    slide, generator = open_slide(slide_path, tile_size)
+    columns, rows = generator.level_tiles[level]
+    band_rows = band_rows or max(1, -(-rows // (workers * BANDS_PER_WORKER)))
+    mask_start = time.perf_counter()
+    candidates = tissue_tiles(slide_path, tile_size, level, tissue_threshold_percentage) if skip_background else None
+    mask_time = time.perf_counter() - mask_start
+    row_bands = tile_bands(rows, band_rows)
+    jobs = [(slide_path, tile_size, level, tissue_threshold_percentage, filters or {}, native, encode_threads, writer,
+             first, last, None if candidates is None else candidates[first:last])
+            for first, last in row_bands]
+
+    own_executor = executor is None
+    if own_executor:
+        executor = futures.ProcessPoolExecutor(max_workers=workers)
+    stats = dict.fromkeys(STAGES, 0.0)
+    stats.update(tiles=0, kept=0, skipped=0, bands=len(jobs), mask=mask_time,
+                 slide_level=native_level(slide, generator, level) if native else None)
+    try:
+        bands = {executor.submit(_tile_band, job): band for band, job in zip(row_bands, jobs)}
+        for future in futures.as_completed(bands):
+            band = future.result()
+            for key in STAGES + ["tiles", "kept", "skipped"]:
+                stats[key] += band[key]
+            if progress is not None:
+                first, last = bands[future]
+                progress(columns * (last - first))
+    finally:
+        if own_executor:
+            executor.shutdown()
+    stats["wall"] = time.perf_counter() - start
+    return stats
+
+
+# Multi-resolution tiling. tile_slide_levels tiles several DeepZoom levels of a slide in one pass: bands of rows of
+# the coarsest level go to the workers, and each worker tiles its band at every level from coarse to fine while that
+# part of the slide is in OpenSlide's cache. A tile at a finer level is only read if the tile above it at the
+# previous level has enough tissue for it to pass the threshold: a child covers 1/f**2 of its parent (f = 2 ** the
+# level difference), so a parent under threshold / f**2 (less GATE_MARGIN, for blur) cannot hold a kept child. Each
+# level's tiles go to its own writer, and the returned index has a row for every tile read, with the tile number of
+# its parent at the previous level; tile numbers are column-major within each level, as in tile_slide.
+#
+#   writers = {level: FolderWriter(f"tiles/level_{level}") for level in [12, 13, 14]}
+#   stats = tile_slide_levels("slide.svs", 1024, [12, 13, 14], 50, writers, workers=32)
+#   stats["index"]  # level, tile_number, x, y, tissue, kept, parent
+
+GATE_MARGIN = 5  # percentage points
+LEVEL_INDEX_DTYPE = np.dtype([("level", "<i4"), ("tile_number", "<i8"), ("x", "<i4"), ("y", "<i4"),
+                              ("tissue", "<f4"), ("kept", "?"), ("parent", "<i8")])
+
+
+def gate_percentage(tissue_threshold_percentage, factor, margin=GATE_MARGIN):
+    """Least tissue percentage a tile needs for its factor x factor children at a finer level to be read."""
+    return max(0.0, tissue_threshold_percentage / factor ** 2 - margin)
+
+
+def _tile_band_levels(job):
+    (slide_path, tile_size, levels, tissue_threshold_percentage, gates, filters, native, encode_threads, writers,
+     first_row, last_row, candidates) = job
+    stats = dict.fromkeys(STAGES, 0.0)
+    stats["tiles"] = stats["kept"] = stats["skipped"] = 0
+    stats["levels"] = {level: {"tiles": 0, "kept": 0, "skipped": 0} for level in levels}
+    slide, generator = open_slide(slide_path, tile_size)
+    index, gated, parent_rows = [], None, None
+    for n, level in enumerate(levels):
+        scale = 2 ** (level - levels[0])
+        factor = 2 ** (level - levels[n - 1]) if n else 1
+        columns, rows = generator.level_tiles[level]
+        first, last = min(first_row * scale, rows), min(last_row * scale, rows)
+        slide_level = native_level(slide, generator, level) if native else None
+        writer, level_stats = writers[level], stats["levels"][level]
+        tissue_by_tile, edges, batch, pending = {}, set(), [], []
+
+        def classify(batch):
+            keep, tissue = _classify_and_encode(batch, stats, tissue_threshold_percentage, filters, encoder, pending)
+            for (tile_number, x, y, _), kept, tissue_percentage in zip(batch, keep, tissue):
+                tissue_by_tile[x, y] = tissue_percentage
+                parent = (x // factor) * parent_rows + y // factor if n else -1
+                index.append((level, tile_number, x, y, tissue_percentage, kept, parent))
+                level_stats["kept"] += int(kept)
+
+        writer.open_band(first, last)
+        try:
+            with EncoderPool(writer.codec, encode_threads) as encoder:
+                for y in range(first, last):
+                    to_read = []
+                    for x in range(columns):
+                        if generator.get_tile_dimensions(level, (x, y)) != (tile_size, tile_size):
+                            # edge tiles are never read, so their children are never gated
+                            edges.add((x, y))
+                            continue
+                        if candidates is not None and not candidates[n][y - first, x] or \
+                                n and (x // factor, y // factor) not in gated:
+                            level_stats["skipped"] += 1
+                            continue
+                        to_read.append(x)
+                    level_stats["tiles"] += len(to_read)
+                    tiles = read_row(slide, generator, level, y, to_read, slide_level)
+                    while True:
+                        start = time.perf_counter()
+                        x, tile = next(tiles, (None, None))
+                        stats["read"] += time.perf_counter() - start
+                        if tile is None:
+                            break
+                        batch.append((x * rows + y, x, y, tile))
+                        if len(batch) == CLASSIFY_BATCH:
+                            classify(batch)
+                            batch = []
+                            _write_encoded(pending, stats, writer)
+                if batch:
+                    classify(batch)
+                _write_encoded(pending, stats, writer, wait=True)
+        finally:
+            start = time.perf_counter()
+            writer.close_band()
+            stats["write"] += time.perf_counter() - start
+        if n + 1 < len(levels):
+            gated = {tile for tile, tissue_percentage in tissue_by_tile.items() if tissue_percentage >= gates[n + 1]}
+            gated |= edges
+        parent_rows = rows
+    stats["tiles"] = sum(level_stats["tiles"] for level_stats in stats["levels"].values())
+    stats["skipped"] = sum(level_stats["skipped"] for level_stats in stats["levels"].values())
+    stats["index"] = np.array(index, dtype=LEVEL_INDEX_DTYPE)
+    return stats
+
+
+def tile_slide_levels(slide_path, tile_size, levels, tissue_threshold_percentage, writers, workers=None,
+                      band_rows=None, executor=None, progress=None, skip_background=True, filters=None, native=False,
+                      encode_threads=ENCODE_THREADS, gates=None):
+    """Tile several DeepZoom levels of slide_path in one pass (see above), writing each level's kept tiles with
+    writers[level]. Background tiles are skipped with one tissue mask for every level as in tile_slide, and
+    finer tiles under a coarser tile with less tissue than its gate (gate_percentage of the two levels, or the
+    matching entry of gates, one per level after the first) are never read; both count as skipped. The other
+    arguments are as for tile_slide, with bands made of rows of the coarsest level. Returns tile_slide's stats, plus
+    per-level tile counts under "levels" and the index of every tile read (LEVEL_INDEX_DTYPE, by level and tile
+    number) under "index"."""
+    start = time.perf_counter()
+    levels = sorted(set(levels))
+    workers = workers or os.cpu_count()
+    slide, generator = open_slide(slide_path, tile_size)
+    columns, rows = generator.level_tiles[levels[0]]
+    band_rows = band_rows or max(1, -(-rows // (workers * BANDS_PER_WORKER)))
+    if gates is None:
+        gates = [gate_percentage(tissue_threshold_percentage, 2 ** (fine - coarse))
+                 for coarse, fine in zip(levels, levels[1:])]
+    gates = [None] + list(gates)
+    mask_start = time.perf_counter()
+    candidates = None
+    if skip_background:
+        # one mask for every level; coarser tiles are read if they could be kept or could hold a kept child
+        mask = _slide_mask(slide_path)
+        candidates = [_mask_tiles(mask, generator, tile_size, level, min([tissue_threshold_percentage] + gates[n + 1:]))
+                      for n, level in enumerate(levels)]
+    mask_time = time.perf_counter() - mask_start
+
+    def band_candidates(first, last):
+        if candidates is None:
+            return None
+        return [level_candidates[first * 2 ** (level - levels[0]):last * 2 ** (level - levels[0])]
+                for level, level_candidates in zip(levels, candidates)]
+
+    row_bands = tile_bands(rows, band_rows)
+    jobs = [(slide_path, tile_size, levels, tissue_threshold_percentage, gates, filters or {}, native, encode_threads,
+             writers, first, last, band_candidates(first, last)) for first, last in row_bands]
+
+    own_executor = executor is None
+    if own_executor:
+        executor = futures.ProcessPoolExecutor(max_workers=workers)
+    stats = dict.fromkeys(STAGES, 0.0)
+    stats.update(tiles=0, kept=0, skipped=0, bands=len(jobs), mask=mask_time,
+                 levels={level: {"tiles": 0, "kept": 0, "skipped": 0} for level in levels})
+    indexes = []
+    try:
+        bands = {executor.submit(_tile_band_levels, job): band for band, job in zip(row_bands, jobs)}
+        for future in futures.as_completed(bands):
+            band = future.result()
+            for key in STAGES + ["tiles", "kept", "skipped"]:
+                stats[key] += band[key]
+            for level, counts in band["levels"].items():
+                for key, count in counts.items():
+                    stats["levels"][level][key] += count
+            indexes.append(band["index"])
+            if progress is not None:
+                first, last = bands[future]
+                progress(columns * (last - first))
+    finally:
+        if own_executor:
+            executor.shutdown()
+    index = np.concatenate(indexes) if indexes else np.zeros(0, LEVEL_INDEX_DTYPE)
+    stats["index"] = index[np.lexsort((index["tile_number"], index["level"]))]
+    stats["wall"] = time.perf_counter() - start
+    return stats
+
+
+def format_level_stats(stats):
+    levels = ", ".join(f"level {level}: {counts['kept']}/{counts['tiles'] + counts['skipped']} kept, "
+                       f"{counts['skipped']} skipped by the mask or gating" for level, counts in stats["levels"].items())
+    return f"{format_stats(stats)}; {levels}"
+
+
+def format_stats(stats):
+    busy = sum(stats[stage] for stage in STAGES) or 1.0
+    stages = ", ".join(f"{stage} {stats[stage]:.1f}s ({100 * stats[stage] / busy:.0f}%)" for stage in STAGES)
+    tiles = stats["tiles"] + stats["skipped"]
+    return (f"{stats['kept']}/{tiles} tiles kept in {stats['wall']:.1f}s ({tiles / max(stats['wall'], 1e-9):.1f} "
+            f"tiles/s), {stats['skipped']} get_tile calls skipped by the tissue mask ({stats['mask']:.2f}s); "
+            f"worker time: {stages}")
@@ -13,12 +13,11 @@ import random
 from PIL import Image
 import os
 import tensorflow as tf
-from tensorflow.python.keras.preprocessing.image import ImageDataGenerator
-from tensorflow.python.keras import layers
-from tensorflow.python.keras.applications.inception_v3 import InceptionV3
-from tensorflow.python.keras.optimizers import RMSprop
 from tensorflow import keras
 
+from embedding_cache import EmbeddingCache, full_model, head_model, inception_backbone
+from tile_dataset import load_index, steps_per_epoch
+
 
 np.random.seed(0)
 # torch.cuda.empty_cache()
@@ -38,41 +37,38 @@ width, height = im.size
 lymph_train_dir = f"{root_dir}lymph_train_dir"
 lymph_validation_dir = f"{root_dir}lymph_validation_dir"
 
-# Add our data-augmentation parameters to ImageDataGenerator
-train_datagen = ImageDataGenerator()
-test_datagen = ImageDataGenerator()
-
-b_s = 1 # batch_size
-len_train = len(os.listdir(lymph_train_dir + "/early")) + len(os.listdir(lymph_train_dir + "/late"))
-validation_steps = len(os.listdir(lymph_validation_dir + "/early")) + len(os.listdir(lymph_validation_dir + "/late"))//b_s
+b_s = 32 # batch_size
+image_size = 299 # tiles are downscaled from 1024px as they are loaded
+# every tile under lymph_train_dir and lymph_validation_dir, listed once into lymph_tile_index.parquet (pass
+# rebuild=True after adding tiles); tiles are decoded on parallel tf.data workers, see tile_dataset.py
+index = load_index(root_dir, "lymph")
+train_index = index[index.split == "train"]
+validation_index = index[index.split == "validation"]
+len_train = len(train_index)
+s_s = steps_per_epoch(train_index, b_s)
+validation_steps = steps_per_epoch(validation_index, b_s)
 print(f"Validation steps: {validation_steps}")
-# len_train
-s_s = len_train//b_s
 print("Batch size: " + str(b_s))
 print("Sample size: " + str(len_train))
 print("Steps per epoch: " + str(s_s))
 
-train_generator = train_datagen.flow_from_directory(lymph_train_dir, batch_size = b_s, class_mode = 'binary', target_size = (1024, 1024))
-validation_generator = test_datagen.flow_from_directory(lymph_validation_dir, batch_size = b_s, class_mode = 'binary', target_size = (1024, 1024))
-
-base_model = InceptionV3(input_shape = (1024, 1024, 3), include_top = False, weights = 'imagenet')
-
-for layer in base_model.layers:
-    layer.trainable = False
-
-x = layers.Flatten()(base_model.output)
-x = layers.Dense(64, activation='relu')(x)
-x = layers.Dropout(0.2)(x)
-x = layers.Dense(1, activation='sigmoid')(x)
-
-model = tf.keras.models.Model(base_model.input, x)
+# the InceptionV3 base is frozen, so each tile is pushed through it once and its pooled embedding kept in
+# lymph_embeddings.h5 (tiles added since the last run are embedded on the way); only the head trains, from the cache
+base_model = inception_backbone(image_size)
+with EmbeddingCache(f"{root_dir}lymph_embeddings.h5", base_model, image_size) as cache:
+    train_features, train_labels = cache.features(train_index, root_dir)
+    validation_features, validation_labels = cache.features(validation_index, root_dir)
+    print(f"embeddings: {cache.stats['computed']} computed, {cache.stats['cached']} cached")
 
-model.compile(optimizer = RMSprop(lr=0.001), loss = 'binary_crossentropy', metrics = ['acc'])
+head = head_model(train_features.shape[1])
+head.compile(optimizer = keras.optimizers.RMSprop(learning_rate=0.001), loss = 'binary_crossentropy', metrics = ['acc'])
 print("model compiled")
 
-inc_history = model.fit_generator(train_generator, validation_data = validation_generator, steps_per_epoch = s_s, epochs = 10, validation_steps=validation_steps)
+inc_history = head.fit(train_features, train_labels, batch_size = b_s, validation_data = (validation_features, validation_labels), epochs = 10)
 print("model trained")
 
-model.save("/scratch0/NOT_BACKED_UP/tmp/GPUModelLymph_1_64")
+model = full_model(base_model, head)  # takes tiles again, for inference
+model.save("/scratch0/NOT_BACKED_UP/tmp/GPUModelLymph_1_64.keras")
+head.save("/scratch0/NOT_BACKED_UP/tmp/GPUModelLymph_1_64_head.keras")  # for slide_inference.py
 
 # model = keras.models.load_model('model')